@@ -0,0 +1,154 @@
+import time
+import hashlib
+import threading
+import numpy as np
+from collections import OrderedDict
+from config import answer_cache_threshold, answer_cache_ttl_seconds, answer_cache_max_entries, answer_cache_eviction
+from embedding_cache import text_hash
+
+
+def answer_cache_key(note_set, patient_narrative="", retriever_type="base"):
+    """
+    Key of the answers given on a note set. The patient narrative is part of the key, because it
+    takes part in the relevance check, and so is the retriever type, which selects the context.
+    """
+    return f"{note_set}:{retriever_type}:" + hashlib.sha256(patient_narrative.encode("utf-8")).hexdigest()[:16]
+
+
+class AnswerCache:
+    """
+    Cache of the answers (`response` and `note_texts`) of the workflow.
+
+    Answers are stored per note set key with the hash of the normalized combined question text. With
+    `threshold` None (the default), a lookup only returns the answer of the same question. With a
+    threshold, answers are also stored with the normalized question embedding, and a lookup returns
+    the answer of the most similar cached question if its cosine similarity reaches the threshold.
+    Negations barely move sentence embeddings ("is the drain infected" / "is the drain not
+    infected"), so only set a threshold after checking it on your questions. Entries expire after
+    `ttl_seconds`; beyond `max_entries`, the least recently used ("lru") or the oldest ("fifo")
+    entry is evicted.
+    """
+
+    def __init__(self, threshold=answer_cache_threshold, ttl_seconds=answer_cache_ttl_seconds, max_entries=answer_cache_max_entries, eviction=answer_cache_eviction):
+        if eviction not in ("lru", "fifo"):
+            raise ValueError("Invalid eviction policy. Choose from: 'lru', 'fifo'.")
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.eviction = eviction
+        # entry id -> (key, question hash, normalized vector or None, answer, created)
+        self._entries = OrderedDict()
+        self._by_key = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def semantic(self):
+        """Whether lookups match similar questions (and therefore need the question embedding)."""
+        return self.threshold is not None
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        return vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+    def _remove(self, entry_id):
+        key = self._entries.pop(entry_id)[0]
+        ids = self._by_key[key]
+        ids.remove(entry_id)
+        if not ids:
+            del self._by_key[key]
+
+    def _hit(self, entry_id, similarity):
+        if self.eviction == "lru":
+            self._entries.move_to_end(entry_id)
+        self.hits += 1
+        return {**self._entries[entry_id][3], "similarity": similarity}
+
+    def lookup(self, key, question, question_vector=None):
+        """
+        Return the cached answer of the same question on the same note set or, with a threshold, of
+        the most similar one, or None.
+
+        Args:
+        - question (str): The combined question text.
+        - question_vector (list[float]): Its embedding, required with a threshold.
+
+        Returns:
+        - dict: The cached answer with the matched question's cosine `similarity` (1.0 for the same
+          question), or None on a miss.
+        """
+        question_hash = text_hash(question)
+        now = time.time()
+        with self._lock:
+            for entry_id in [i for i in self._by_key.get(key, []) if now - self._entries[i][4] > self.ttl_seconds]:
+                self._remove(entry_id)
+            ids = self._by_key.get(key, [])
+            for entry_id in reversed(ids):
+                if self._entries[entry_id][1] == question_hash:
+                    return self._hit(entry_id, 1.0)
+            if self.semantic and question_vector is not None:
+                vectors = [(i, self._entries[i][2]) for i in ids if self._entries[i][2] is not None]
+                if vectors:
+                    similarities = np.stack([vector for _, vector in vectors]) @ self._normalize(question_vector)
+                    best = int(np.argmax(similarities))
+                    if similarities[best] >= self.threshold:
+                        return self._hit(vectors[best][0], float(similarities[best]))
+            self.misses += 1
+            return None
+
+    def store(self, key, question, answer, question_vector=None):
+        """
+        Cache the answer of a question on a note set.
+        """
+        vector = self._normalize(question_vector) if self.semantic and question_vector is not None else None
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (key, text_hash(question), vector, dict(answer), time.time())
+            self._by_key.setdefault(key, []).append(entry_id)
+            while len(self._entries) > self.max_entries:
+                # Least recently used first with "lru" (hits move entries to the end), oldest first with "fifo"
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, key=None):
+        """Drop the answers of one note set key, or all answers."""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+                self._by_key.clear()
+                return
+            for entry_id in list(self._by_key.get(key, [])):
+                self._remove(entry_id)
+
+    def stats(self):
+        """
+        Return the hit/miss counters, hit rate, evictions and number of cached answers.
+        """
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+        }
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_answer_cache():
+    """
+    Return the process-wide answer cache, creating it on first use.
+    """
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = AnswerCache()
+        return _default_cache
@@ -2,11 +2,16 @@ import streamlit as st
 import os
 import warnings
 from main import (
-    process_query,
+    process_query_stream,
     create_docs_n_nodes,
     create_index,
-    load_embed_model,
-    initialize_chroma_client
+    update_index,
+    note_excerpt_docs,
+    note_excerpts_fingerprint,
+    get_note_set_cache,
+    get_embed_model,
+    get_chroma_client,
+    vector_store_backend
 )
 
 # Fix PyTorch/Streamlit watcher issue
@@ -21,8 +26,9 @@ if "index" not in st.session_state:
     st.session_state.index = None
     st.session_state.nodes = None
     st.session_state.note_excerpts = None
-    st.session_state.chroma_client = initialize_chroma_client("chromadb")
-    st.session_state.embed_model = load_embed_model("BAAI_bge")
+    # Shared with the workflow through the model registry, so the embedding model is loaded only once
+    st.session_state.chroma_client = get_chroma_client() if vector_store_backend == "chroma" else None
+    st.session_state.embed_model = get_embed_model()
     st.session_state.chat_history = []
     st.session_state.patient_narrative = ""
 
@@ -40,15 +46,31 @@ with st.sidebar:
                 for i, val in enumerate(note_input.strip().splitlines())
                 if val.strip()
             }
-            docs, nodes = create_docs_n_nodes(note_excerpts)
-            index = create_index(st.session_state.chroma_client, docs, st.session_state.embed_model)
+            if st.session_state.index is None:
+                docs, nodes = create_docs_n_nodes(note_excerpts)
+                index = create_index(st.session_state.chroma_client, docs, st.session_state.embed_model, nodes=nodes, backend=vector_store_backend)
+                message = "✅ Notes indexed and patient narrative saved."
+            else:
+                # Only the added or edited lines are encoded; the previous index is left as it is
+                index, nodes, changes = update_index(
+                    st.session_state.chroma_client, st.session_state.index, st.session_state.nodes, st.session_state.note_excerpts,
+                    note_excerpts, st.session_state.embed_model, backend=vector_store_backend
+                )
+                message = (f"✅ Notes updated ({changes['added']} added, {changes['removed']} removed, "
+                           f"{changes['unchanged']} unchanged) and patient narrative saved.")
+                docs = note_excerpt_docs(note_excerpts)
+
+            # Questions on these notes reuse this index, and the retrievers and query engines built on it
+            get_note_set_cache().put(
+                note_excerpts_fingerprint(note_excerpts, st.session_state.embed_model), ("documents", vector_store_backend), (docs, nodes, index)
+            )
 
             st.session_state.index = index
             st.session_state.nodes = nodes
             st.session_state.note_excerpts = note_excerpts
             st.session_state.patient_narrative = patient_narr.strip()
 
-            st.success("✅ Notes indexed and patient narrative saved.")
+            st.success(message)
         except Exception as e:
             st.error(f"❌ Failed to load notes: {e}")
 
@@ -75,35 +97,35 @@ if st.session_state.index and st.session_state.patient_narrative:
         if not patient_q_input.strip() and not clinical_q_input.strip():
             st.warning("Please enter at least one question.")
         else:
-            with st.spinner("Evaluating relevance and generating response..."):
-                input_payload = {
-                    "note_excerpts": st.session_state.note_excerpts,
-                    "patient_question": {"0": patient_q_input.strip()},
-                    "clinical_question": clinical_q_input.strip(),
-                    "patient_narrative": st.session_state.patient_narrative
-                }
-
-                response = process_query(input_payload)
-
-                if not response["error"] and response.get("response"):
-                    answer = response["response"]
-                    sources = response["note_texts"]
+            input_payload = {
+                "note_excerpts": st.session_state.note_excerpts,
+                "patient_question": {"0": patient_q_input.strip()},
+                "clinical_question": clinical_q_input.strip(),
+                "patient_narrative": st.session_state.patient_narrative
+            }
+            user_message = f"**Patient Q:** {patient_q_input}\n**Clinical Q:** {clinical_q_input}"
 
-                    st.chat_message("user").markdown(
-                        f"**Patient Q:** {patient_q_input}\n**Clinical Q:** {clinical_q_input}"
-                    )
-                    st.chat_message("assistant").markdown(
-                        answer + "\n\n📄 **Supporting Notes**:\n" + f"```\n{sources}\n```"
-                    )
+            with st.spinner("Evaluating relevance and retrieving supporting notes..."):
+                response, token_stream = process_query_stream(input_payload)
 
+            if token_stream is not None:
+                st.chat_message("user").markdown(user_message)
+
+                # Render the answer token by token, then append the supporting notes
+                with st.chat_message("assistant"):
+                    answer = st.write_stream(token_stream)
+                    sources = response["note_texts"]
+                    st.markdown("📄 **Supporting Notes**:\n" + f"```\n{sources}\n```")
+
+                if not response["error"] and answer:
                     # Update history
-                    st.session_state.chat_history.append((
-                        "user", f"**Patient Q:** {patient_q_input}\n**Clinical Q:** {clinical_q_input}"
-                    ))
+                    st.session_state.chat_history.append(("user", user_message))
                     st.session_state.chat_history.append((
                         "assistant", answer + "\n\n📄 **Supporting Notes**:\n" + f"```\n{sources}\n```"
                     ))
                 else:
-                    st.error("🚫 Input deemed irrelevant or an error occurred.")
+                    st.error("🚫 An error occurred while generating the response.")
+            else:
+                st.error("🚫 Input deemed irrelevant or an error occurred.")
 else:
     st.info("⬅️ Please load patient notes and narrative from the sidebar to begin.")
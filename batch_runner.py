@@ -0,0 +1,308 @@
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from xml.etree import ElementTree
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from itertools import islice
+from main import build_workflow, create_initial_state, console
+from config import relevance_gate, relevance_batch_max_cases, relevance_batch_concurrency
+from question_relevance import batch_question_relevance
+from model_registry import get_embed_model
+from tracing import percentile, request_trace, trace_node, set_quiet, set_export_path
+
+# Steps that call an LLM (remote OpenRouter or the Ollama server) vs. steps that run locally (embedding, indexing)
+LLM_STEPS = {"Question Relevance", "Response Generator"}
+LOCAL_STEPS = {"Document Loader", "Retriever"}
+
+
+def normalize_case(case):
+    """
+    Normalize an ArchEHR case into the input format of `process_query`.
+
+    Accepts both the `sample_data.json` shape ("clinician_question") and the pipeline shape ("clinical_question").
+    """
+    return {
+        "note_excerpts": case.get("note_excerpts", case.get("note_excerpt_sentences", {})),
+        "patient_question": case.get("patient_question", {}),
+        "clinical_question": case.get("clinical_question", case.get("clinician_question", "")),
+        "patient_narrative": case.get("patient_narrative", ""),
+    }
+
+
+def iter_cases(path):
+    """
+    Stream (case_id, case) pairs from a `sample_data.json`-style file, a JSONL file or an ArchEHR XML file.
+
+    Args:
+    - path (str): Path to a .json file (dict of case_id -> case, or list of cases), a .jsonl file (one case per line)
+      or an ArchEHR .xml file (parsed incrementally, one <case> at a time).
+
+    Yields:
+    - tuple: The case id (str) and the raw case dictionary.
+    """
+    if path.endswith(".xml"):
+        yield from iter_xml_cases(path)
+    elif path.endswith(".jsonl"):
+        with open(path) as f:
+            for line_no, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                case = json.loads(line)
+                case_id = case.get("case_id", case.get("id", case.get("request_id", line_no)))
+                yield str(case_id), case
+    else:
+        with open(path) as f:
+            data = json.load(f)
+        items = data.items() if isinstance(data, dict) else enumerate(data, 1)
+        for case_id, case in items:
+            yield str(case.get("case_id", case_id)), case
+
+
+def _xml_text(element, path):
+    found = element.find(path)
+    return found.text.strip() if found is not None and found.text else ""
+
+
+def iter_xml_cases(path):
+    """
+    Stream (case_id, case) pairs from an ArchEHR XML file (the format parsed in `data_processing/preprocess.ipynb`),
+    clearing every parsed <case> so that memory use does not grow with the file size.
+    """
+    for _, element in ElementTree.iterparse(path, events=("end",)):
+        if element.tag != "case":
+            continue
+        case = {
+            "patient_narrative": _xml_text(element, "patient_narrative"),
+            "clinician_question": _xml_text(element, "clinician_question"),
+            "patient_question": {
+                phrase.get("id", str(i)): phrase.text.strip()
+                for i, phrase in enumerate(element.findall("patient_question/phrase")) if phrase.text
+            },
+            "note_excerpt_sentences": {
+                sentence.get("id", str(i)): sentence.text.strip()
+                for i, sentence in enumerate(element.findall("note_excerpt_sentences/sentence")) if sentence.text
+            },
+        }
+        yield str(element.get("id", "")), case
+        element.clear()
+
+
+def load_completed(output_path):
+    """
+    Read the ids of cases already completed in the output file, so that a crashed run can be resumed.
+    Cases whose record has an error are not completed and run again; their new record is appended.
+    """
+    completed = set()
+    if not os.path.exists(output_path):
+        return completed
+    with open(output_path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+                if not record.get("error"):
+                    completed.add(str(record["case_id"]))
+            except (ValueError, KeyError, AttributeError):
+                # Ignore a partially written last line
+                continue
+    return completed
+
+
+class BatchRunner:
+    """
+    Runs many cases through the EHR workflow over a bounded worker pool.
+
+    LLM steps and local steps have separate concurrency limits, so that the embedding/indexing of
+    one case overlaps with the LLM calls of others instead of running strictly one after the other.
+    """
+
+    def __init__(self, output_path, workers=8, llm_concurrency=4, local_concurrency=2, retriever_type="base", speculative=False,
+                 batch_relevance=False):
+        self.output_path = output_path
+        self.workers = workers
+        self.retriever_type = retriever_type
+        self.batch_relevance = batch_relevance
+        self.relevance_stats = {}
+        self.llm_limit = threading.BoundedSemaphore(llm_concurrency)
+        self.local_limit = threading.BoundedSemaphore(local_concurrency)
+        self.write_lock = threading.Lock()
+        self.stage_latencies = {}
+        self.workflow = build_workflow(self._wrap_node, speculative=speculative).compile()
+
+    def _wrap_node(self, step_name, node_fn):
+        limit = self.llm_limit if step_name in LLM_STEPS else self.local_limit
+
+        node_fn = trace_node(step_name, node_fn)
+
+        def wrapped(state):
+            with limit:
+                start = time.perf_counter()
+                state = node_fn(state)
+                state.setdefault("timings", {})[step_name] = time.perf_counter() - start
+            return state
+        return wrapped
+
+    def run_case(self, case_id, case, relevance=None):
+        """
+        Run a single case through the workflow and return its result record.
+
+        Args:
+        - relevance (tuple): A (decision, tier, score) decided beforehand by the batched relevance check.
+        """
+        start = time.perf_counter()
+        try:
+            with request_trace("batch_case", case_id=case_id):
+                # The case id lets the document loader use the embeddings ingested into the embedding store
+                state = create_initial_state({**normalize_case(case), "case_id": case_id}, self.retriever_type)
+                if relevance is not None:
+                    state["relevance"], state["relevance_tier"], state["relevance_score"] = relevance
+                result = self.workflow.invoke(state)
+            record = {
+                "case_id": case_id,
+                "relevance": result.get("relevance", ""),
+                "relevance_tier": result.get("relevance_tier", ""),
+                "relevance_score": result.get("relevance_score"),
+                "response": result.get("response", ""),
+                "note_texts": result.get("note_texts", ""),
+                "error": bool(result.get("error")),
+                "synthesis_stats": result.get("synthesis_stats", {}),
+                "timings": result.get("timings", {}),
+            }
+        except Exception as e:
+            record = {"case_id": case_id, "relevance": "", "response": "", "note_texts": "", "error": True, "exception": str(e), "timings": {}}
+        record["elapsed"] = time.perf_counter() - start
+        return record
+
+    def _write(self, out_file, record):
+        with self.write_lock:
+            out_file.write(json.dumps(record) + "\n")
+            out_file.flush()
+            for step_name, seconds in record["timings"].items():
+                self.stage_latencies.setdefault(step_name, []).append(seconds)
+
+    def _check_relevance(self, chunk):
+        inputs = []
+        for _, case in chunk:
+            case = normalize_case(case)
+            inputs.append((case["patient_question"], case["patient_narrative"], case["note_excerpts"]))
+        embed_model = get_embed_model() if relevance_gate == "tiered" else None
+        results, stats = batch_question_relevance(inputs, embed_model)
+        for name, value in stats.items():
+            self.relevance_stats[name] = self.relevance_stats.get(name, 0) + value
+        return results
+
+    def _with_relevance(self, cases):
+        # Yield (case_id, case, relevance) triples, deciding the relevance of a chunk of cases at a time
+        cases = iter(cases)
+        chunk_size = max(self.workers * 2, relevance_batch_max_cases * relevance_batch_concurrency)
+        while True:
+            chunk = list(islice(cases, chunk_size))
+            if not chunk:
+                return
+            if not self.batch_relevance:
+                yield from ((case_id, case, None) for case_id, case in chunk)
+                continue
+            yield from ((case_id, case, relevance) for (case_id, case), relevance in zip(chunk, self._check_relevance(chunk)))
+
+    def run(self, cases, resume=True):
+        """
+        Run all cases, writing one JSON line per finished case to the output file.
+
+        Args:
+        - cases (iterable): (case_id, case) pairs, e.g. from `iter_cases`.
+        - resume (bool): Skip cases already present in the output file.
+
+        Returns:
+        - dict: The run summary (case counts, throughput and per-stage latency).
+        """
+        completed = load_completed(self.output_path) if resume else set()
+        done = errors = 0
+        start = time.perf_counter()
+
+        with open(self.output_path, "a" if resume else "w") as out_file, ThreadPoolExecutor(max_workers=self.workers) as pool:
+            in_flight = set()
+            pending = ((case_id, case) for case_id, case in cases if case_id not in completed)
+            for case_id, case, relevance in self._with_relevance(pending):
+                # Keep the number of queued cases bounded so that large inputs are streamed
+                if len(in_flight) >= self.workers * 2:
+                    finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        record = future.result()
+                        self._write(out_file, record)
+                        done += 1
+                        errors += record["error"]
+                in_flight.add(pool.submit(self.run_case, case_id, case, relevance))
+
+            for future in wait(in_flight).done:
+                record = future.result()
+                self._write(out_file, record)
+                done += 1
+                errors += record["error"]
+
+        elapsed = time.perf_counter() - start
+        return {
+            "cases": done,
+            "skipped": len(completed),
+            "errors": errors,
+            "elapsed": elapsed,
+            "cases_per_sec": done / elapsed if elapsed else 0.0,
+            "relevance": dict(self.relevance_stats),
+            "stages": {
+                step_name: {
+                    "count": len(values),
+                    "mean": sum(values) / len(values),
+                    "p50": percentile(values, 50),
+                    "p95": percentile(values, 95),
+                    "max": max(values),
+                }
+                for step_name, values in self.stage_latencies.items()
+            },
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run ArchEHR cases through the EHR workflow in parallel.")
+    parser.add_argument("input", help="Path to a sample_data.json-style file or a JSONL file of cases.")
+    parser.add_argument("--output", default="batch_results.jsonl", help="JSONL file the results are appended to.")
+    parser.add_argument("--workers", type=int, default=8, help="Maximum number of cases in flight.")
+    parser.add_argument("--llm-concurrency", type=int, default=4, help="Maximum concurrent LLM steps.")
+    parser.add_argument("--local-concurrency", type=int, default=2, help="Maximum concurrent embedding/indexing steps.")
+    parser.add_argument("--retriever-type", default="base", choices=["base", "bm25", "auto_merger", "hybrid", "multi_query"])
+    parser.add_argument("--speculative", action="store_true", help="Run relevance and document loading/retrieval concurrently.")
+    parser.add_argument("--batch-relevance", action="store_true", help="Check the relevance of several cases per LLM request.")
+    parser.add_argument("--quiet", action="store_true", help="Disable the per-step console output of the workflow.")
+    parser.add_argument("--trace-output", default=None, help="JSONL file the per-case traces are appended to.")
+    parser.add_argument("--no-resume", action="store_true", help="Overwrite the output file instead of resuming.")
+    args = parser.parse_args(argv)
+
+    set_quiet(args.quiet)
+    if args.trace_output:
+        set_export_path(args.trace_output)
+
+    runner = BatchRunner(
+        args.output,
+        workers=args.workers,
+        llm_concurrency=args.llm_concurrency,
+        local_concurrency=args.local_concurrency,
+        retriever_type=args.retriever_type,
+        speculative=args.speculative,
+        batch_relevance=args.batch_relevance,
+    )
+    summary = runner.run(iter_cases(args.input), resume=not args.no_resume)
+
+    console.print(f"[bold green]Processed {summary['cases']} cases ({summary['skipped']} resumed, {summary['errors']} errors) "
+                  f"in {summary['elapsed']:.1f}s - {summary['cases_per_sec']:.2f} cases/sec[/bold green]")
+    if summary["relevance"]:
+        stats = summary["relevance"]
+        console.print(f"  Relevance: {stats['cases']} cases checked by the LLM in {stats['llm_calls']} calls "
+                      f"({stats['packs']} packs, {stats['fallbacks']} single-case fallbacks, {stats['prompt_tokens']} prompt tokens)")
+    for step_name, stats in summary["stages"].items():
+        console.print(f"  {step_name}: mean {stats['mean']:.3f}s, p50 {stats['p50']:.3f}s, p95 {stats['p95']:.3f}s, max {stats['max']:.3f}s")
+    return summary
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
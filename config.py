@@ -1,5 +1,44 @@
 llm_model= "ahmgam/medllama3-v20"
 OPENROUTER_API = "<api-key>" # Replace with your OpenRouter API key
+relevance_llm_model = "deepseek/deepseek-r1:free"
+embed_model_name = "BAAI_bge"
+
+# LLM gateway shared by response generation (Ollama) and the relevance check (OpenRouter, falling back
+# to Ollama): keep-alive connection pools, per-backend concurrency limits, retries with jittered
+# exponential backoff (read timeouts are not retried), and optionally a hedged duplicate request when a
+# call exceeds the backend's p95 latency (`llm_hedge_delay` seconds until enough calls were observed).
+# Hedging adds load on the backend, e.g. the local Ollama server, so it is opt-in.
+ollama_base_url = "http://localhost:11434"
+openrouter_base_url = "https://openrouter.ai/api/v1"
+relevance_fallback_to_ollama = True
+llm_request_timeout = 120.0
+llm_connect_timeout = 5.0
+llm_max_connections = 16
+llm_backend_concurrency = {"ollama": 4, "openrouter": 8}
+llm_max_retries = 2
+llm_backoff_base = 0.5
+llm_backoff_max = 8.0
+llm_hedging = False
+llm_hedge_delay = 30.0
+
+# Embedding backend: "torch" (HuggingFace/PyTorch) or "onnx" (ONNX Runtime via fastembed, optionally int8-quantized).
+embed_backend = "torch"
+embed_quantize = False
+embed_batch_size = 32
+embed_threads = None
+
+# Micro-batching of embedding requests across concurrent queries (opt-in): requests are collected for up to
+# embedding_batch_wait_ms (or embedding_max_batch_size texts) and encoded in length-bucketed forward passes.
+# It only pays off with many concurrent queries; a single caller just waits the extra milliseconds.
+embedding_batching = False
+embedding_batch_wait_ms = 5
+embedding_max_batch_size = 128
+embedding_bucket_size = 32
+chroma_db_dir = "chromadb"
+
+# Embedding store written by `ingest.py` (None disables it): when a query carries a `case_id` that was ingested
+# with the same embedding model, the stored vectors of its unchanged sentences are used instead of re-encoding them.
+embedding_store_dir = None
 
 summary_prompt = (
         "You are a clinical bot designed to answer queries based strictly on the provided context.\n"
@@ -15,6 +54,25 @@ summary_prompt = (
         "Answer: "
     )
 
+refine_prompt = (
+        "You are a clinical bot designed to answer queries based strictly on the provided context.\n"
+        "The original query is: {query_str}\n"
+        "The existing answer is: {existing_answer}\n"
+        "Refine the existing answer (only if needed) using the additional context below.\n"
+        "---------------------\n"
+        "{context_msg}\n"
+        "---------------------\n"
+        "Given the new context and **not prior knowledge**, refine the existing answer so that it stays **concise and to-the-point**.\n"
+        "If the new context is not relevant to the query, return the existing answer unchanged.\n"
+        "Limit your response to a maximum of **two to three sentences**.\n"
+        "Refined Answer: "
+    )
+
+# Response synthesis: "refine" makes one LLM call per retrieved node, "packed" packs the retrieved nodes
+# into as few prompts as fit the context window (usually a single call).
+synthesis_mode = "refine"
+llm_context_window = 4096
+llm_num_output = 256
 
 embed_models = {
     "mpnet": "sentence-transformers/all-mpnet-base-v2",
@@ -24,4 +82,69 @@ embed_models = {
     "BAAI_bge": "BAAI/bge-base-en-v1.5",
     "MiniLM": "sentence-transformers/all-MiniLM-L6-v2",
     "GTE_base": "thenlper/gte-base",
-}
\ No newline at end of file
+}
+
+# Question relevance gate: "tiered" checks the BGE similarity between the question and the notes first
+# and only calls the LLM in the ambiguous band between the two thresholds; "llm" always calls the LLM.
+# The similarity ignores the patient narrative, and the thresholds below are uncalibrated placeholders:
+# keep "llm" until they were derived with `calibrate_relevance_thresholds` on labeled data (see README).
+relevance_gate = "llm"
+relevance_accept_threshold = 0.75
+relevance_reject_threshold = 0.45
+
+# Batched relevance check of offline runs: several cases are packed into one LLM request up to a
+# prompt token budget, and the packs are sent concurrently.
+relevance_batch_token_budget = 3000
+relevance_batch_max_cases = 8
+relevance_batch_concurrency = 4
+# Decisions of the batched check are cached in memory by the hash of the case's relevance prompt, so that
+# duplicate cases and repeated runs in the same process do not call the LLM again (0 disables the cache).
+relevance_cache_size = 4096
+
+# Run the relevance check and the document loading/retrieval concurrently, discarding the retrieval if the inputs are not relevant.
+speculative_mode = False
+
+# Vector store of the per-query index: "chroma" persists the embeddings in ChromaDB and reuses the collection
+# of a note set across queries and processes. "numpy" (opt-in) keeps them in memory with no disk I/O, but an
+# index only lives as long as the note set cache entry and metadata filters are not supported.
+vector_store_backend = "chroma"
+
+# Hybrid retriever: weight of the dense ranking (BM25 gets the rest) and fusion method ("rrf" or "score").
+hybrid_dense_weight = 0.5
+hybrid_fusion = "rrf"
+
+# Multi-query retriever ("multi_query"): the patient sub-questions and the clinical question are embedded in one
+# batch and each contributes its `multi_query_top_k` best sentences; the union is capped at the retriever's top_k.
+multi_query_top_k = 3
+
+# Adaptive context selection after retrieval: the ranking is cut at the first score drop larger than
+# `prune_score_gap` (relative to the top score) or below `prune_min_score` (None disables it), sentences
+# with a cosine similarity above `prune_duplicate_threshold` to a higher ranked one are dropped, and the
+# remaining ones are kept up to `prune_token_budget` tokens. At least `prune_min_nodes` nodes are kept.
+# The score cut only applies to cosine-scored retrievers (base, auto_merger, multi_query), not to bm25 or
+# hybrid. Opt-in until its effect on answer quality has been measured.
+context_pruning = False
+prune_score_gap = 0.3
+prune_min_score = None
+prune_duplicate_threshold = 0.95
+prune_token_budget = 1500
+prune_min_nodes = 1
+
+# Number of note sets whose built index, retrievers and query engines are kept for follow-up questions.
+note_set_cache_size = 32
+
+# Answer cache (opt-in): the same question on the same notes, narrative and retriever type gets the cached
+# answer. With a threshold, a question whose embedding has at least this cosine similarity with a cached
+# question also does; for clinical questions that is unsafe without checking it first, since negations
+# barely change the embedding. Entries expire after the TTL; beyond the maximum size, the least recently
+# used ("lru") or oldest ("fifo") answer is evicted.
+answer_cache_enabled = False
+answer_cache_threshold = None
+answer_cache_ttl_seconds = 60 * 60
+answer_cache_max_entries = 1024
+answer_cache_eviction = "lru"
+
+# Observability: quiet_mode switches off the Rich step/agent output of the workflow; finished request traces
+# (per-step latency, LLM calls, tokens, embedding cache hits) are appended to trace_export_path as JSON lines.
+quiet_mode = False
+trace_export_path = None
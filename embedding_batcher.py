@@ -0,0 +1,159 @@
+import time
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import Future, InvalidStateError
+from config import embedding_batch_wait_ms, embedding_max_batch_size, embedding_bucket_size
+
+
+class EmbeddingBatcher:
+    """
+    In-process micro-batching scheduler for one embedding model.
+
+    Embedding requests from all in-flight queries are collected for up to `max_wait_ms` (or until
+    `max_batch_size` texts are queued), deduplicated, sorted by length into buckets so that texts in
+    one forward pass need little padding, encoded, and the vectors are scattered back to the callers.
+    """
+
+    def __init__(self, embed_model, max_wait_ms=embedding_batch_wait_ms, max_batch_size=embedding_max_batch_size, bucket_size=embedding_bucket_size):
+        self.embed_model = embed_model
+        self.max_wait = max_wait_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.bucket_size = bucket_size
+        self._queue = deque()
+        self._queued_texts = 0
+        self._condition = threading.Condition()
+        self._batch_sizes = deque(maxlen=10000)
+        self._forward_passes = 0
+        self._requests = 0
+        self._worker = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+        self._worker.start()
+
+    def submit(self, texts):
+        """
+        Queue texts for embedding.
+
+        Returns:
+        - Future: Resolves to the list of embeddings, in the order of `texts`.
+        """
+        future = Future()
+        if not texts:
+            future.set_result([])
+            return future
+        with self._condition:
+            self._queue.append((list(texts), future))
+            self._queued_texts += len(texts)
+            self._requests += 1
+            self._condition.notify()
+        return future
+
+    def embed(self, texts):
+        """Embed texts through the shared batches, blocking until the vectors are ready."""
+        return self.submit(texts).result()
+
+    async def aembed(self, texts):
+        """Embed texts through the shared batches without blocking the event loop."""
+        return await asyncio.wrap_future(self.submit(texts))
+
+    def _next_batch(self):
+        with self._condition:
+            while not self._queue:
+                self._condition.wait()
+            # Wait a few milliseconds for other requests to join, unless the batch is already full
+            deadline = time.monotonic() + self.max_wait
+            while self._queued_texts < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+
+            batch, size, taken = [], 0, 0
+            while self._queue and (not batch or size + len(self._queue[0][0]) <= self.max_batch_size):
+                texts, future = self._queue.popleft()
+                taken += len(texts)
+                # Requests whose caller was cancelled (e.g. an asyncio task awaiting `aembed`) are dropped
+                if future.set_running_or_notify_cancel():
+                    batch.append((texts, future))
+                    size += len(texts)
+            self._queued_texts -= taken
+            return batch
+
+    def _encode(self, texts):
+        unique = sorted(set(texts), key=len)
+        vectors = {}
+        # Length-bucketed forward passes: similar lengths are padded together
+        for i in range(0, len(unique), self.bucket_size):
+            bucket = unique[i:i + self.bucket_size]
+            vectors.update(zip(bucket, self.embed_model.get_text_embedding_batch(bucket)))
+            self._forward_passes += 1
+        return vectors
+
+    @staticmethod
+    def _resolve(future, result=None, error=None):
+        try:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+        except InvalidStateError:
+            # Already resolved or cancelled
+            pass
+
+    def _run(self):
+        # The worker must never die, otherwise every later request would wait forever
+        while True:
+            batch = []
+            try:
+                batch = self._next_batch()
+                if not batch:
+                    continue
+                texts = [text for request_texts, _ in batch for text in request_texts]
+                self._batch_sizes.append(len(texts))
+                vectors = self._encode(texts)
+                for request_texts, future in batch:
+                    self._resolve(future, [vectors[text] for text in request_texts])
+            except Exception as e:
+                for _, future in batch:
+                    self._resolve(future, error=e)
+
+    def stats(self):
+        """
+        Return the scheduler metrics: current queue depth (requests and texts), number of requests,
+        batches and forward passes, and the mean/max batch size.
+        """
+        with self._condition:
+            queue_depth, queued_texts = len(self._queue), self._queued_texts
+        sizes = list(self._batch_sizes)
+        return {
+            "queue_depth": queue_depth,
+            "queued_texts": queued_texts,
+            "requests": self._requests,
+            "batches": len(sizes),
+            "forward_passes": self._forward_passes,
+            "mean_batch_size": sum(sizes) / len(sizes) if sizes else 0.0,
+            "max_batch_size": max(sizes) if sizes else 0,
+        }
+
+
+_batchers = {}
+_batchers_lock = threading.Lock()
+
+
+def get_batcher(embed_model):
+    """
+    Return the shared batcher of an embedding model, starting it on first use.
+    """
+    with _batchers_lock:
+        key = id(embed_model)
+        if key not in _batchers:
+            _batchers[key] = EmbeddingBatcher(embed_model)
+        return _batchers[key]
+
+
+def batcher_stats():
+    """
+    Return the metrics of every running batcher, keyed by embedding model name.
+    """
+    with _batchers_lock:
+        batchers = list(_batchers.values())
+    return {batcher.embed_model.model_name: batcher.stats() for batcher in batchers}
@@ -0,0 +1,301 @@
+import os
+import asyncio
+import hashlib
+import threading
+import unicodedata
+from array import array
+from collections import OrderedDict
+from llama_index.core.schema import MetadataMode
+from tracing import span, record
+from config import embedding_batching
+from embedding_batcher import get_batcher
+
+EMBEDDING_CACHE_DIR = "embedding_cache"
+
+
+def normalize_text(text):
+    """
+    Normalize a sentence before hashing so that cosmetic differences do not cause cache misses.
+
+    Args:
+    - text (str): The raw sentence.
+
+    Returns:
+    - str: The NFC-normalized text with collapsed whitespace.
+    """
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def text_hash(text):
+    """
+    Content hash of the normalized text, used as the cache key together with the model name.
+    """
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+
+
+def model_dir_name(model_name):
+    """
+    Convert an embedding model name (e.g. "BAAI/bge-base-en-v1.5") into a safe directory name.
+    """
+    return model_name.replace("/", "__").replace(":", "_")
+
+
+class EmbeddingCache:
+    """
+    Persistent embedding cache keyed by (embedding model name, normalized text hash).
+
+    Vectors are stored on local disk as raw float32 files, one file per sentence, with an
+    in-memory LRU in front of it. When the on-disk size exceeds `max_disk_bytes`, the least
+    recently used files are evicted.
+    """
+
+    def __init__(self, cache_dir=EMBEDDING_CACHE_DIR, max_memory_items=20000, max_disk_bytes=512 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_memory_items = max_memory_items
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = OrderedDict()
+        self._disk_bytes = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, model_name, key):
+        return os.path.join(self.cache_dir, model_dir_name(model_name), key[:2], key + ".f32")
+
+    def _remember(self, mem_key, embedding):
+        self._memory[mem_key] = embedding
+        self._memory.move_to_end(mem_key)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+    def get(self, model_name, text):
+        """
+        Look up the embedding of a text for the given model.
+
+        Returns:
+        - list[float] | None: The cached embedding, or None on a miss.
+        """
+        key = text_hash(text)
+        mem_key = (model_name, key)
+        with self._lock:
+            if mem_key in self._memory:
+                self._memory.move_to_end(mem_key)
+                self.hits += 1
+                return self._memory[mem_key]
+
+            path = self._path(model_name, key)
+            try:
+                with open(path, "rb") as f:
+                    values = array("f")
+                    values.frombytes(f.read())
+                # Touch the file so that disk eviction follows access order
+                os.utime(path, None)
+            except (OSError, ValueError):
+                self.misses += 1
+                return None
+
+            embedding = values.tolist()
+            self._remember(mem_key, embedding)
+            self.hits += 1
+            return embedding
+
+    def put(self, model_name, text, embedding):
+        """
+        Store the embedding of a text for the given model in memory and on disk.
+        """
+        key = text_hash(text)
+        path = self._path(model_name, key)
+        data = array("f", embedding).tobytes()
+        with self._lock:
+            self._remember((model_name, key), list(embedding))
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                previous = os.path.getsize(path) if os.path.exists(path) else 0
+                tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                print(f"Warning: Could not write embedding cache entry {path}: {e}")
+                return
+            if self._disk_bytes is not None:
+                self._disk_bytes += len(data) - previous
+            self._evict_if_needed()
+
+    def _cache_files(self):
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith(".f32"):
+                    yield os.path.join(root, name)
+
+    def _evict_if_needed(self):
+        if self._disk_bytes is None:
+            self._disk_bytes = sum(os.path.getsize(path) for path in self._cache_files())
+        if self._disk_bytes <= self.max_disk_bytes:
+            return
+
+        # Evict least recently used files until we are back under 90% of the budget
+        target = int(self.max_disk_bytes * 0.9)
+        entries = []
+        for path in self._cache_files():
+            try:
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+            except OSError:
+                continue
+        entries.sort()
+        for _, size, path in entries:
+            if self._disk_bytes <= target:
+                break
+            try:
+                os.remove(path)
+                self._disk_bytes -= size
+            except OSError:
+                continue
+
+    def stats(self):
+        """
+        Return hit/miss counters for the cache.
+        """
+        return {"hits": self.hits, "misses": self.misses, "memory_items": len(self._memory), "disk_bytes": self._disk_bytes}
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_embedding_cache():
+    """
+    Return the process-wide embedding cache, creating it on first use.
+    """
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = EmbeddingCache()
+        return _default_cache
+
+
+def embed_texts(embed_model, texts, cache=None):
+    """
+    Embed a list of texts, calling the encoder only for cache misses.
+
+    Args:
+    - embed_model: The llama_index embedding model.
+    - texts (list[str]): The texts to embed.
+    - cache (EmbeddingCache, optional): The cache to use. Defaults to the process-wide cache.
+
+    Returns:
+    - list[list[float]]: One embedding per input text, in order.
+    """
+    cache = cache or get_embedding_cache()
+    model_name = embed_model.model_name
+    embeddings = [cache.get(model_name, text) for text in texts]
+
+    # Deduplicate misses so that repeated sentences are encoded only once
+    missing = list(dict.fromkeys(text for text, emb in zip(texts, embeddings) if emb is None))
+    record(cache_hits=len(texts) - sum(emb is None for emb in embeddings), nodes_embedded=len(missing))
+    if missing:
+        with span("Embedding", texts=len(missing)):
+            if embedding_batching:
+                # Shared micro-batches with the other in-flight requests
+                vectors = get_batcher(embed_model).embed(missing)
+            else:
+                vectors = embed_model.get_text_embedding_batch(missing)
+            new_embeddings = dict(zip(missing, vectors))
+        for text, embedding in new_embeddings.items():
+            cache.put(model_name, text, embedding)
+        embeddings = [emb if emb is not None else new_embeddings[text] for text, emb in zip(texts, embeddings)]
+    return embeddings
+
+
+async def aembed_texts(embed_model, texts, cache=None):
+    """
+    Async version of `embed_texts`, using the async embedding API for cache misses. The cache lookups
+    and writes read and write files, so they run in a worker thread.
+    """
+    cache = cache or get_embedding_cache()
+    model_name = embed_model.model_name
+    embeddings = await asyncio.to_thread(lambda: [cache.get(model_name, text) for text in texts])
+
+    missing = list(dict.fromkeys(text for text, emb in zip(texts, embeddings) if emb is None))
+    record(cache_hits=len(texts) - sum(emb is None for emb in embeddings), nodes_embedded=len(missing))
+    if missing:
+        with span("Embedding", texts=len(missing)):
+            if embedding_batching:
+                vectors = await get_batcher(embed_model).aembed(missing)
+            else:
+                vectors = await embed_model.aget_text_embedding_batch(missing)
+            new_embeddings = dict(zip(missing, vectors))
+        await asyncio.to_thread(lambda: [cache.put(model_name, text, embedding) for text, embedding in new_embeddings.items()])
+        embeddings = [emb if emb is not None else new_embeddings[text] for text, emb in zip(texts, embeddings)]
+    return embeddings
+
+
+def embed_queries(embed_model, texts):
+    """
+    Embed questions (queries, sub-questions) without the persistent cache, since they are patient text.
+
+    With `embedding_batching`, they go through the shared micro-batches together with the note
+    sentences of the other in-flight requests; the HF and ONNX backends embed queries and texts the
+    same way. Without it, a single question is embedded with `get_query_embedding` and several in one
+    batch.
+
+    Returns:
+    - list[list[float]]: One embedding per question, in order.
+    """
+    texts = list(texts)
+    if not texts:
+        return []
+    with span("Query Embedding", texts=len(texts)):
+        if embedding_batching:
+            return get_batcher(embed_model).embed(texts)
+        if len(texts) == 1:
+            return [embed_model.get_query_embedding(texts[0])]
+        return embed_model.get_text_embedding_batch(texts)
+
+
+async def aembed_queries(embed_model, texts):
+    """
+    Async version of `embed_queries`.
+    """
+    texts = list(texts)
+    if not texts:
+        return []
+    with span("Query Embedding", texts=len(texts)):
+        if embedding_batching:
+            return await get_batcher(embed_model).aembed(texts)
+        if len(texts) == 1:
+            return [await embed_model.aget_query_embedding(texts[0])]
+        return await embed_model.aget_text_embedding_batch(texts)
+
+
+def attach_embeddings(nodes, embed_model, cache=None):
+    """
+    Fill in `node.embedding` for every node that does not have one yet, using the cache.
+
+    Nodes with an embedding are skipped by VectorStoreIndex, so only cache misses reach the encoder.
+    The cache key is the hash of the normalized text the index embeds (`MetadataMode.EMBED`); for note
+    sentences that is the sentence alone, since the "key" metadata is excluded from it
+    (`vector_db.note_excerpt_docs`), so a sentence hits the cache whatever its key or position.
+    """
+    pending = [node for node in nodes if node.embedding is None]
+    if not pending:
+        return nodes
+    texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in pending]
+    for node, embedding in zip(pending, embed_texts(embed_model, texts, cache)):
+        node.embedding = embedding
+    return nodes
+
+
+async def aattach_embeddings(nodes, embed_model, cache=None):
+    """
+    Async version of `attach_embeddings`.
+    """
+    pending = [node for node in nodes if node.embedding is None]
+    if not pending:
+        return nodes
+    texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in pending]
+    for node, embedding in zip(pending, await aembed_texts(embed_model, texts, cache)):
+        node.embedding = embedding
+    return nodes
@@ -0,0 +1,190 @@
+import os
+import json
+import numpy as np
+from llama_index.core.schema import MetadataMode
+from embedding_cache import text_hash
+
+VECTORS_FILE = "vectors.f32"
+SIDECAR_FILE = "index.jsonl"
+META_FILE = "meta.json"
+
+
+def _read_sidecar(store_dir):
+    entries = []
+    path = os.path.join(store_dir, SIDECAR_FILE)
+    if not os.path.exists(path):
+        return entries
+    with open(path) as f:
+        for line in f:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                # A partially written last line of an interrupted ingestion
+                break
+    return entries
+
+
+def stored_case_ids(store_dir):
+    """
+    Return the ids of the cases written to a store (empty if the store does not exist).
+    """
+    return {entry["case_id"] for entry in _read_sidecar(store_dir)}
+
+
+class EmbeddingStoreWriter:
+    """
+    Append-only writer of per-case sentence embeddings.
+
+    Vectors are appended as raw float32 rows to `vectors.f32`; after a case's rows are written, one
+    line with its id, row offset, row count, node keys and text hashes is appended to the
+    `index.jsonl` sidecar. The texts are the ones the index embeds (`node_embed_texts`), so that
+    stored vectors can stand in for the index's own. Rows not covered by the sidecar (an interrupted write) are truncated on
+    open, so an ingestion can be resumed.
+
+    Args:
+    - store_dir (str): The store directory.
+    - model_name (str): The embedding model identity (`embed_model.model_name`, which tells the ONNX
+      and quantized backends apart); a store holds the vectors of one model.
+    - dim (int): The embedding dimension.
+    """
+
+    def __init__(self, store_dir, model_name, dim):
+        os.makedirs(store_dir, exist_ok=True)
+        meta_path = os.path.join(store_dir, META_FILE)
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if meta["model"] != model_name or meta["dim"] != dim:
+                raise ValueError(f"The store in {store_dir} holds {meta['model']} ({meta['dim']}-d) vectors, not {model_name} ({dim}-d).")
+        else:
+            with open(meta_path, "w") as f:
+                json.dump({"model": model_name, "dim": dim}, f)
+
+        self.store_dir = store_dir
+        self.dim = dim
+        entries = _read_sidecar(store_dir)
+        self.case_ids = {entry["case_id"] for entry in entries}
+        self.rows = max((entry["offset"] + entry["count"] for entry in entries), default=0)
+
+        # Drop the rows and sidecar lines of an interrupted write
+        vectors_path = os.path.join(store_dir, VECTORS_FILE)
+        with open(vectors_path, "ab") as f:
+            f.truncate(self.rows * dim * 4)
+        with open(os.path.join(store_dir, SIDECAR_FILE), "w") as f:
+            f.writelines(json.dumps(entry) + "\n" for entry in entries)
+
+        self._vectors = open(vectors_path, "ab")
+        self._sidecar = open(os.path.join(store_dir, SIDECAR_FILE), "a")
+
+    def __contains__(self, case_id):
+        return str(case_id) in self.case_ids
+
+    def append(self, case_id, keys, texts, vectors):
+        """
+        Append the sentence embeddings of one case.
+        """
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        self._vectors.write(vectors.tobytes())
+        self._vectors.flush()
+        entry = {
+            "case_id": str(case_id),
+            "offset": self.rows,
+            "count": len(vectors),
+            "keys": [str(key) for key in keys],
+            "hashes": [text_hash(text)[:16] for text in texts],
+        }
+        self._sidecar.write(json.dumps(entry) + "\n")
+        self._sidecar.flush()
+        self.rows += len(vectors)
+        self.case_ids.add(entry["case_id"])
+
+    def close(self):
+        self._vectors.close()
+        self._sidecar.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class EmbeddingStore:
+    """
+    Read-only view of an embedding store written by `EmbeddingStoreWriter`.
+
+    The vectors file is memory-mapped, so the per-case matrices are zero-copy slices and only the
+    pages that are read are loaded, whatever the size of the corpus.
+    """
+
+    def __init__(self, store_dir):
+        with open(os.path.join(store_dir, META_FILE)) as f:
+            meta = json.load(f)
+        self.model_name = meta["model"]
+        self.dim = meta["dim"]
+        self._entries = {entry["case_id"]: entry for entry in _read_sidecar(store_dir)}
+        rows = max((entry["offset"] + entry["count"] for entry in self._entries.values()), default=0)
+        path = os.path.join(store_dir, VECTORS_FILE)
+        self._vectors = np.memmap(path, dtype=np.float32, mode="r", shape=(rows, self.dim)) if rows else np.zeros((0, self.dim), dtype=np.float32)
+
+    def __contains__(self, case_id):
+        return str(case_id) in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def case_ids(self):
+        return list(self._entries)
+
+    def get_case(self, case_id):
+        """
+        Return the sentence keys and the (count, dim) embedding matrix of a case, without copying.
+        """
+        entry = self._entries[str(case_id)]
+        return entry["keys"], self._vectors[entry["offset"]:entry["offset"] + entry["count"]]
+
+    def case_embeddings(self, case_id, items):
+        """
+        Return the stored embedding of every (key, text) pair of `items` whose text is unchanged since
+        ingestion, as a dict of (key, text) -> vector.
+        """
+        entry = self._entries.get(str(case_id))
+        if entry is None:
+            return {}
+        vectors = self._vectors[entry["offset"]:entry["offset"] + entry["count"]]
+        rows = {(key, hashed): i for i, (key, hashed) in enumerate(zip(entry["keys"], entry["hashes"]))}
+        found = {}
+        for key, text in items:
+            i = rows.get((str(key), text_hash(text)[:16]))
+            if i is not None:
+                found[(key, text)] = vectors[i]
+        return found
+
+
+def node_embed_texts(nodes):
+    """
+    Return the (key, text) pairs that the index embeds for `nodes`: the text with the metadata
+    visible to the embedding model (`MetadataMode.EMBED`), e.g. the sentence key.
+    """
+    return [(str(node.metadata.get("key")), node.get_content(metadata_mode=MetadataMode.EMBED)) for node in nodes]
+
+
+def attach_store_embeddings(nodes, store, case_id, embed_model=None):
+    """
+    Fill in `node.embedding` from the store for the nodes of a case, so that they are not re-encoded.
+    Nothing is attached if `embed_model` is given and the store holds the vectors of another model.
+
+    Returns:
+    - int: The number of nodes that got a stored embedding.
+    """
+    if embed_model is not None and store.model_name != embed_model.model_name:
+        return 0
+    items = node_embed_texts(nodes)
+    found = store.case_embeddings(case_id, items)
+    attached = 0
+    for node, item in zip(nodes, items):
+        vector = found.get(item)
+        if node.embedding is None and vector is not None:
+            node.embedding = vector.tolist()
+            attached += 1
+    return attached
@@ -1,64 +1,101 @@
+import sys
+import numpy as np
 import pandas as pd
-from sentence_transformers import SentenceTransformer, util
+from sentence_transformers import SentenceTransformer
 
 # Load the embedding model
 model = SentenceTransformer("BAAI/bge-base-en-v1.5")
 
+CATEGORIES = {"essential": "relevant_similarity", "supplementary": "supplementary_similarity", "not_relevant": "not_relevant_similarity"}
+
+
+# Encode all unique texts of the dataset in large batches
+def encode_unique(texts, batch_size=256):
+    """
+    Encode texts with normalized embeddings, encoding each unique text only once.
+
+    Args:
+    - texts (iterable[str]): The texts to encode.
+    - batch_size (int): The encoder batch size.
+
+    Returns:
+    - tuple: (dict of text -> row index, embedding matrix of shape (num_unique_texts, dim)).
+    """
+    # Sorting by length keeps the padding of each batch small
+    unique = sorted(dict.fromkeys(texts), key=len)
+    embeddings = model.encode(unique, batch_size=batch_size, normalize_embeddings=True, convert_to_numpy=True, show_progress_bar=False)
+    return {text: i for i, text in enumerate(unique)}, embeddings
+
+
 # Function to compute similarity scores
-def compute_similarity(df):
+def compute_similarity(df, batch_size=256):
+    questions = [" ".join(q.values()) for q in df["patient_question"]]
+    sentences = [list(notes.values()) for notes in df["note_excerpt_sentences"]]
+
+    # One batched encoding pass over the whole dataset
+    rows, embeddings = encode_unique(questions + [s for case in sentences for s in case], batch_size)
+
     results = []
+    for row, question, note_sentences in zip(df.to_dict("records"), questions, sentences):
+        # Cosine similarities of all note sentences with one matrix product (embeddings are normalized)
+        note_matrix = embeddings[[rows[s] for s in note_sentences]]
+        similarity_scores = note_matrix @ embeddings[rows[question]]
+
+        result = {"case_id": row["case_id"], "patient_question": question}
+        for category, column in CATEGORIES.items():
+            indices = row[category] if row[category] else []
+            result[column] = similarity_scores[indices].tolist()
+        results.append(result)
 
-    for _, row in df.iterrows():
-        # Extract patient question from dictionary
-        patient_question = " ".join(row["patient_question"].values())  
-        
-        # Extract note sentences from dictionary
-        note_sentences = list(row["note_excerpt_sentences"].values())
-
-        # Encode patient question
-        question_embedding = model.encode(patient_question, convert_to_tensor=True)
-
-        # Compute similarity for each note sentence
-        similarity_scores = [
-            util.pytorch_cos_sim(question_embedding, model.encode(sent, convert_to_tensor=True)).item()
-            for sent in note_sentences
-        ]
-
-        # Get similarity scores as lists for each category
-        supplementary_sim = [similarity_scores[i] for i in row["supplementary"]] if row["supplementary"] else []
-        relevant_sim = [similarity_scores[i] for i in row["essential"]] if row["essential"] else []
-        not_relevant_sim = [similarity_scores[i] for i in row["not_relevant"]] if row["not_relevant"] else []
-
-        results.append({
-            "case_id": row["case_id"],
-            "patient_question": patient_question,
-            "supplementary_similarity": supplementary_sim,
-            "relevant_similarity": relevant_sim,
-            "not_relevant_similarity": not_relevant_sim
-        })
-    
     return pd.DataFrame(results)
 
-# Example DataFrame with dictionary format
-df = pd.DataFrame([
-    {
-        "case_id": 1,
-        "patient_question": {"0": "What are some antihypertensive medications I can take?"},
-        "note_excerpt_sentences": {
-            "0": "Medical Assessment:",
-            "1": "The patient has stage 2 hypertension.",
-            "2": "Prescribed Losartan for treatment.",
-            "3": "Alternative options include ACE inhibitors.",
-            "4": "The patient has a history of allergic reactions to beta-blockers."
-        },
-        "supplementary": [3],
-        "essential": [1, 2],
-        "not_relevant": [0, 4]
-    }
-])
-
-# Compute similarity scores
-result_df = compute_similarity(df)
-
-# Display results
-print(result_df)
\ No newline at end of file
+
+# Columnar output of the score distributions: one row per (case, sentence, category)
+def score_distributions(result_df):
+    frames = []
+    for category, column in CATEGORIES.items():
+        exploded = result_df[["case_id", column]].explode(column).dropna()
+        frames.append(pd.DataFrame({
+            "case_id": exploded["case_id"].to_numpy(),
+            "category": category,
+            "similarity": exploded[column].to_numpy(dtype=np.float32),
+        }))
+    return pd.concat(frames, ignore_index=True)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        # A DataFrame pickled by data_processing/preprocess.ipynb, or a JSON file with the same columns
+        path = sys.argv[1]
+        df = pd.read_pickle(path) if path.endswith((".pkl", ".pickle")) else pd.read_json(path)
+    else:
+        # Example DataFrame with dictionary format
+        df = pd.DataFrame([
+            {
+                "case_id": 1,
+                "patient_question": {"0": "What are some antihypertensive medications I can take?"},
+                "note_excerpt_sentences": {
+                    "0": "Medical Assessment:",
+                    "1": "The patient has stage 2 hypertension.",
+                    "2": "Prescribed Losartan for treatment.",
+                    "3": "Alternative options include ACE inhibitors.",
+                    "4": "The patient has a history of allergic reactions to beta-blockers."
+                },
+                "supplementary": [3],
+                "essential": [1, 2],
+                "not_relevant": [0, 4]
+            }
+        ])
+
+    # Compute similarity scores
+    result_df = compute_similarity(df)
+
+    # Display results
+    print(result_df)
+
+    distributions = score_distributions(result_df)
+    print(distributions.groupby("category")["similarity"].describe())
+    if len(sys.argv) > 2 and sys.argv[2].endswith(".csv"):
+        distributions.to_csv(sys.argv[2], index=False)
+    elif len(sys.argv) > 2:
+        distributions.to_parquet(sys.argv[2], index=False)
@@ -0,0 +1,221 @@
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+import resource
+import tempfile
+import multiprocessing
+
+# Run from the repository root modules
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import embed_models
+
+RETRIEVER_TYPES = ["base", "bm25", "auto_merger", "hybrid", "multi_query"]
+
+
+def load_labeled_cases(path):
+    """
+    Load labeled cases (note sentences with essential/supplementary/not_relevant sentence ids).
+
+    Accepts the `sample_data.json` shape ("note_excerpts", "not-relevant") and the ArchEHR DataFrame
+    shape ("note_excerpt_sentences", "not_relevant").
+    """
+    from batch_runner import iter_cases, normalize_case
+
+    cases = []
+    for case_id, case in iter_cases(path):
+        cases.append({
+            "case_id": case_id,
+            "input": normalize_case(case),
+            "essential": {str(i) for i in case.get("essential", [])},
+            "supplementary": {str(i) for i in case.get("supplementary", [])},
+            "not_relevant": {str(i) for i in case.get("not_relevant", case.get("not-relevant", []))},
+        })
+    return cases
+
+
+def retrieval_metrics(retrieved_keys, essential, supplementary):
+    """
+    Compute recall@k and MRR of the retrieved sentence ids against the labels.
+    """
+    retrieved = set(retrieved_keys)
+    relevant = essential | supplementary
+    first_hit = next((rank for rank, key in enumerate(retrieved_keys, 1) if key in essential), None)
+    return {
+        "recall_essential": len(retrieved & essential) / len(essential) if essential else None,
+        "recall_relevant": len(retrieved & relevant) / len(relevant) if relevant else None,
+        "mrr": 1 / first_hit if first_hit else 0.0,
+    }
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def unique_models(model_keys):
+    """
+    Drop the keys of `config.embed_models` that name a model already in the list (e.g. "minilm" and "MiniLM").
+    """
+    seen, unique = set(), []
+    for key in model_keys:
+        if embed_models[key] not in seen:
+            seen.add(embed_models[key])
+            unique.append(key)
+    return unique
+
+
+def benchmark_model(model_key, cases, retriever_types, top_ks, backend="numpy"):
+    """
+    Benchmark one embedding model across retriever types and top_k values.
+
+    Every case is indexed once with a cold embedding cache (index-build latency and embeddings/sec),
+    then every (retriever, top_k) combination is queried on that index.
+
+    Returns:
+    - list[dict]: One result row per (model, retriever, top_k), averaged over the cases.
+    """
+    from llama_index.core import Settings
+    from llama_index.core.llms import MockLLM
+    from utils import load_embed_model, create_docs_n_nodes
+    from vector_db import create_index
+    from retriever import build_retriever
+    import embedding_cache
+    from embedding_cache import EmbeddingCache
+    from main import retrieval_query
+
+    # Retrieval only: a stub LLM makes sure no remote model is ever called
+    Settings.llm = MockLLM()
+    # Encode directly, the micro-batcher's waits would distort the embeddings/sec numbers
+    embedding_cache.embedding_batching = False
+    chroma_client = None
+    if backend == "chroma":
+        import chromadb
+        # In-memory Chroma, so that runs neither reuse nor leave behind persisted collections
+        chroma_client = chromadb.EphemeralClient()
+
+    start = time.perf_counter()
+    embed_model = load_embed_model(model_key)
+    load_seconds = time.perf_counter() - start
+
+    per_combination = {}
+    build_seconds, embedded = 0.0, 0
+    with tempfile.TemporaryDirectory() as cache_dir:
+        # A private cache so that every sentence is actually encoded once
+        cache = EmbeddingCache(cache_dir=cache_dir)
+        for case in cases:
+            docs, nodes = create_docs_n_nodes(case["input"]["note_excerpts"])
+            start = time.perf_counter()
+            try:
+                index = create_index(chroma_client, docs, embed_model, nodes=nodes, embedding_cache=cache, backend=backend)
+            except Exception as e:
+                print(f"Warning: {model_key} failed to index case {case['case_id']}: {e}")
+                for retriever_type in retriever_types:
+                    for top_k in top_ks:
+                        per_combination.setdefault((retriever_type, top_k), {"queries": [], "metrics": [], "errors": 0})["errors"] += 1
+                continue
+            build_seconds += time.perf_counter() - start
+            embedded += len(nodes)
+
+            for retriever_type in retriever_types:
+                for top_k in top_ks:
+                    row = per_combination.setdefault((retriever_type, top_k), {"queries": [], "metrics": [], "errors": 0})
+                    try:
+                        retriever = build_retriever(index, nodes, retriever_type, top_k=top_k, embed_model=embed_model)
+                        start = time.perf_counter()
+                        results = retriever.retrieve(retrieval_query(case["input"], retriever_type))
+                        row["queries"].append(time.perf_counter() - start)
+                    except Exception as e:
+                        print(f"Warning: {model_key}/{retriever_type}/top_k={top_k} failed on case {case['case_id']}: {e}")
+                        row["errors"] += 1
+                        continue
+                    keys = [str(result.node.metadata.get("key")) for result in results]
+                    row["metrics"].append(retrieval_metrics(keys, case["essential"], case["supplementary"]))
+
+    def mean(values):
+        values = [v for v in values if v is not None]
+        return sum(values) / len(values) if values else None
+
+    rows = []
+    for (retriever_type, top_k), row in per_combination.items():
+        rows.append({
+            "model": model_key,
+            "retriever": retriever_type,
+            "top_k": top_k,
+            "cases": len(row["metrics"]),
+            "errors": row["errors"],
+            "recall_essential": mean([m["recall_essential"] for m in row["metrics"]]),
+            "recall_relevant": mean([m["recall_relevant"] for m in row["metrics"]]),
+            "mrr": mean([m["mrr"] for m in row["metrics"]]),
+            "model_load_seconds": load_seconds,
+            "index_build_seconds": build_seconds / len(cases) if cases else None,
+            "query_seconds": mean(row["queries"]),
+            "embeddings_per_second": embedded / build_seconds if build_seconds else None,
+            "peak_rss_mb": peak_rss_mb(),
+        })
+    return rows
+
+
+def _benchmark_model_worker(args):
+    return benchmark_model(*args)
+
+
+def run_benchmark(cases, models, retriever_types, top_ks, backend="numpy"):
+    """
+    Run every (model, retriever, top_k) combination. Each model runs in its own process, so that the
+    peak RSS of one model does not include the others.
+    """
+    rows = []
+    context = multiprocessing.get_context("spawn")
+    for model_key in models:
+        with context.Pool(1) as pool:
+            rows.extend(pool.apply(_benchmark_model_worker, ((model_key, cases, retriever_types, top_ks, backend),)))
+    return rows
+
+
+def save_results(rows, output_dir, metadata):
+    """
+    Save the results as JSON (with the run metadata) and CSV in a timestamped file pair.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    stamp = time.strftime("%Y%m%d-%H%M%S")
+    json_path = os.path.join(output_dir, f"retrieval_benchmark_{stamp}.json")
+    csv_path = os.path.join(output_dir, f"retrieval_benchmark_{stamp}.csv")
+    with open(json_path, "w") as f:
+        json.dump({"metadata": metadata, "results": rows}, f, indent=2)
+    with open(csv_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()) if rows else [])
+        writer.writeheader()
+        writer.writerows(rows)
+    return json_path, csv_path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark embedding models and retrievers on labeled cases.")
+    parser.add_argument("input", help="Labeled cases (sample_data.json-style file or JSONL).")
+    parser.add_argument("--models", nargs="+", default=list(embed_models), choices=list(embed_models))
+    parser.add_argument("--retrievers", nargs="+", default=RETRIEVER_TYPES, choices=RETRIEVER_TYPES)
+    parser.add_argument("--top-k", nargs="+", type=int, default=[1, 3, 5])
+    parser.add_argument("--backend", default="numpy", choices=["numpy", "chroma"])
+    parser.add_argument("--output-dir", default="benchmark_results")
+    args = parser.parse_args(argv)
+
+    cases = load_labeled_cases(args.input)
+    rows = run_benchmark(cases, unique_models(args.models), args.retrievers, args.top_k, args.backend)
+    metadata = {"input": args.input, "cases": len(cases), "backend": args.backend, "timestamp": time.time()}
+    json_path, csv_path = save_results(rows, args.output_dir, metadata)
+
+    def fmt(value, spec=".3f"):
+        return "n/a" if value is None else format(value, spec)
+
+    for row in rows:
+        print(f"{row['model']:>14} {row['retriever']:>12} k={row['top_k']:<3} recall={fmt(row['recall_essential'])} mrr={fmt(row['mrr'])} "
+              f"build={fmt(row['index_build_seconds'])}s query={fmt(row['query_seconds'], '.4f')}s rss={fmt(row['peak_rss_mb'], '.0f')}MB")
+    print(f"Results saved to {json_path} and {csv_path}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
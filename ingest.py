@@ -0,0 +1,157 @@
+import os
+import sys
+import time
+import argparse
+import multiprocessing
+from collections import deque
+import numpy as np
+from config import embed_model_name, embed_models
+from embedding_store import EmbeddingStoreWriter, stored_case_ids, node_embed_texts
+
+_worker_model = None
+
+
+def _init_worker(model_key, threads):
+    # Each worker process loads the embedding model once and limits its own threads,
+    # so that the workers together do not oversubscribe the CPU cores
+    global _worker_model
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+    from utils import load_embed_model
+    _worker_model = load_embed_model(model_key, threads=threads)
+
+
+def _embed_batch(texts):
+    # The model identity (with its backend) is returned along, it is recorded in the store's meta.json
+    return _worker_model.model_name, np.asarray(_worker_model.get_text_embedding_batch(texts), dtype=np.float32)
+
+
+def case_embed_texts(note_excerpts):
+    """
+    Return the (key, text) pairs of a case's nodes as the index embeds them, so that the stored
+    vectors match the ones `create_index` would compute.
+    """
+    from utils import create_docs_n_nodes
+
+    _, nodes = create_docs_n_nodes(note_excerpts)
+    return node_embed_texts(nodes)
+
+
+def iter_corpus(paths):
+    """
+    Stream (case_id, note sentences) pairs from JSON, JSONL and ArchEHR XML files.
+    """
+    from batch_runner import iter_cases, normalize_case
+
+    for path in paths:
+        for case_id, case in iter_cases(path):
+            note_excerpts = {str(key): text for key, text in normalize_case(case)["note_excerpts"].items() if text.strip()}
+            if note_excerpts:
+                yield case_id, note_excerpts
+
+
+def iter_batches(cases, batch_size, skip=()):
+    """
+    Group whole cases into batches of at least `batch_size` sentences, skipping already ingested cases.
+    """
+    batch, sentences = [], 0
+    for case_id, note_excerpts in cases:
+        if case_id in skip:
+            continue
+        batch.append((case_id, note_excerpts))
+        sentences += len(note_excerpts)
+        if sentences >= batch_size:
+            yield batch
+            batch, sentences = [], 0
+    if batch:
+        yield batch
+
+
+def ingest(paths, store_dir, model_key=embed_model_name, workers=None, threads_per_worker=1, batch_size=256, max_in_flight=None):
+    """
+    Embed the note sentences of a corpus into a memory-mapped embedding store.
+
+    Cases are streamed from the input files and grouped into batches that are embedded by a pool of
+    worker processes. At most `max_in_flight` batches are queued at a time and the results are
+    written in order, so memory use stays flat whatever the corpus size. The embedded texts are the
+    node texts the index embeds (with the sentence key metadata), so the stored vectors can be
+    used in place of the query-time encoding (`embedding_store_dir` in `config.py`). Cases already in the store
+    are skipped, so an interrupted ingestion can be resumed.
+
+    Args:
+    - paths (list[str]): Input files (.json, .jsonl or ArchEHR .xml).
+    - store_dir (str): The embedding store directory.
+    - model_key (str): A key of `config.embed_models`.
+    - workers (int): Number of embedding processes. Defaults to the CPU count divided by `threads_per_worker`.
+    - threads_per_worker (int): Torch/ONNX Runtime threads per process.
+    - batch_size (int): Minimum number of sentences per batch.
+    - max_in_flight (int): Maximum number of queued batches. Defaults to twice the number of workers.
+
+    Returns:
+    - dict: Counts of cases and sentences embedded, elapsed seconds and sentences/sec.
+    """
+    workers = workers or max(1, (os.cpu_count() or 1) // threads_per_worker)
+    max_in_flight = max_in_flight or 2 * workers
+    writer = None
+    cases = sentences = 0
+    start = time.perf_counter()
+
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(workers, initializer=_init_worker, initargs=(model_key, threads_per_worker)) as pool:
+        skip = stored_case_ids(store_dir)
+
+        pending = deque()
+
+        def write_oldest():
+            nonlocal writer, cases, sentences
+            batch, result = pending.popleft()
+            model_name, vectors = result.get()
+            if writer is None:
+                writer = EmbeddingStoreWriter(store_dir, model_name, vectors.shape[1])
+            offset = 0
+            for case_id, items in batch:
+                count = len(items)
+                writer.append(case_id, [key for key, _ in items], [text for _, text in items], vectors[offset:offset + count])
+                offset += count
+            cases += len(batch)
+            sentences += offset
+            print(f"Ingested {cases} cases, {sentences} sentences ({sentences / (time.perf_counter() - start):.1f} sentences/sec)")
+
+        try:
+            for batch in iter_batches(iter_corpus(paths), batch_size, skip):
+                if len(pending) >= max_in_flight:
+                    write_oldest()
+                batch = [(case_id, case_embed_texts(note_excerpts)) for case_id, note_excerpts in batch]
+                texts = [text for _, items in batch for _, text in items]
+                pending.append((batch, pool.apply_async(_embed_batch, (texts,))))
+            while pending:
+                write_oldest()
+        finally:
+            if writer is not None:
+                writer.close()
+
+    elapsed = time.perf_counter() - start
+    return {"cases": cases, "sentences": sentences, "skipped": len(skip), "elapsed": elapsed, "sentences_per_sec": sentences / elapsed if elapsed else 0.0}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Embed the note sentences of a corpus into a memory-mapped embedding store.")
+    parser.add_argument("inputs", nargs="+", help="Input files: sample_data.json-style .json, .jsonl or ArchEHR .xml.")
+    parser.add_argument("--store", default="embedding_store", help="The embedding store directory.")
+    parser.add_argument("--model", default=embed_model_name, choices=list(embed_models.keys()))
+    parser.add_argument("--workers", type=int, default=None, help="Number of embedding processes.")
+    parser.add_argument("--threads-per-worker", type=int, default=1)
+    parser.add_argument("--batch-size", type=int, default=256, help="Minimum number of sentences per batch.")
+    args = parser.parse_args(argv)
+
+    summary = ingest(args.inputs, args.store, args.model, args.workers, args.threads_per_worker, args.batch_size)
+    print(f"Embedded {summary['cases']} cases ({summary['skipped']} already in the store), {summary['sentences']} sentences "
+          f"in {summary['elapsed']:.1f}s - {summary['sentences_per_sec']:.1f} sentences/sec")
+    return summary
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,530 @@
+import json
+import time
+import atexit
+import random
+import asyncio
+import weakref
+import threading
+import contextvars
+from collections import deque
+from concurrent.futures import Future, FIRST_COMPLETED, wait
+import httpx
+from llama_index.core.llms import CustomLLM, CompletionResponse, LLMMetadata
+from llama_index.core.llms.callbacks import llm_completion_callback
+from llama_index.core.bridge.pydantic import Field, PrivateAttr
+from config import (
+    OPENROUTER_API, ollama_base_url, openrouter_base_url, llm_context_window, llm_num_output,
+    llm_request_timeout, llm_connect_timeout, llm_max_connections, llm_backend_concurrency,
+    llm_max_retries, llm_backoff_base, llm_backoff_max, llm_hedging, llm_hedge_delay,
+)
+from tracing import percentile, record
+
+# HTTP statuses worth retrying: timeouts, rate limits and server-side failures
+RETRY_STATUS = {408, 425, 429, 500, 502, 503, 504}
+
+
+class RetryableBackendError(RuntimeError):
+    """A backend call failed in a way that may succeed on retry (e.g. HTTP 429/503)."""
+
+
+class CallCancelled(RuntimeError):
+    """A backend call was aborted because a hedged duplicate answered first."""
+
+
+RETRYABLE_ERRORS = (httpx.TransportError, RetryableBackendError)
+# A read that timed out already waited the full request timeout, retrying it would only delay the fallback
+NON_RETRYABLE_ERRORS = (httpx.ReadTimeout, httpx.WriteTimeout, httpx.PoolTimeout, CallCancelled)
+
+
+class _CallHandle:
+    """
+    Cancellation handle of one sync hedged backend call. Cancelling releases the call's concurrency
+    slot right away and closes its response; the call then stops at its next streamed token.
+    """
+
+    def __init__(self):
+        self.cancelled = False
+        self._response = None
+        self._release = None
+        self._lock = threading.Lock()
+
+    def hold(self, release):
+        # Called with the acquired slot; the slot is released by `free` or `cancel`, whichever comes first
+        with self._lock:
+            if self.cancelled:
+                release()
+                raise CallCancelled("The call was cancelled")
+            self._release = release
+
+    def attach(self, response):
+        with self._lock:
+            if self.cancelled:
+                raise CallCancelled("The call was cancelled")
+            self._response = response
+
+    def free(self):
+        with self._lock:
+            release, self._release = self._release, None
+        if release is not None:
+            release()
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            response = self._response
+        self.free()
+        if response is not None:
+            response.close()
+
+
+class Backend:
+    """
+    One LLM server with a keep-alive connection pool, a concurrency limit and a latency history.
+
+    Args:
+    - name (str): The backend name, e.g. "ollama"; the key of `config.llm_backend_concurrency`.
+    - base_url (str): The server URL.
+    - model (str): The model name sent with every request.
+    """
+
+    path = ""
+
+    def __init__(self, name, base_url, model, max_concurrency=4, max_connections=llm_max_connections,
+                 timeout=llm_request_timeout, connect_timeout=llm_connect_timeout, headers=None):
+        self.name = name
+        self.base_url = base_url
+        self.model = model
+        self.max_concurrency = max_concurrency
+        self._client_kwargs = dict(
+            base_url=base_url,
+            headers=headers or {},
+            timeout=httpx.Timeout(timeout, connect=connect_timeout),
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+        )
+        self._client = httpx.Client(**self._client_kwargs)
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        # Async clients and semaphores are bound to an event loop
+        self._async = weakref.WeakKeyDictionary()
+        self._latencies = deque(maxlen=1000)
+
+    def _async_resources(self):
+        loop = asyncio.get_running_loop()
+        if loop not in self._async:
+            self._async[loop] = (httpx.AsyncClient(**self._client_kwargs), asyncio.Semaphore(self.max_concurrency))
+        return self._async[loop]
+
+    def p95(self, min_samples=20):
+        """The p95 latency of the recent successful calls, or None with too few samples."""
+        latencies = list(self._latencies)
+        return percentile(latencies, 95) if len(latencies) >= min_samples else None
+
+    def _check(self, response):
+        if response.status_code in RETRY_STATUS:
+            raise RetryableBackendError(f"{self.name} returned HTTP {response.status_code}")
+        response.raise_for_status()
+
+    def complete(self, prompt, handle=None):
+        if handle is None:
+            with self._slots:
+                start = time.perf_counter()
+                response = self._client.post(self.path, json=self._payload(prompt, stream=False))
+                self._check(response)
+                text = self._parse(response.json())
+                self._latencies.append(time.perf_counter() - start)
+                return text
+
+        # A hedged call is streamed, so that a cancelled one stops at its next token
+        self._slots.acquire()
+        handle.hold(self._slots.release)
+        try:
+            start = time.perf_counter()
+            text = ""
+            with self._client.stream("POST", self.path, json=self._payload(prompt, stream=True)) as response:
+                handle.attach(response)
+                self._check(response)
+                for line in response.iter_lines():
+                    if handle.cancelled:
+                        raise CallCancelled("The call was cancelled")
+                    text += self._parse_stream_line(line)
+            self._latencies.append(time.perf_counter() - start)
+            return text
+        finally:
+            handle.free()
+
+    async def acomplete(self, prompt):
+        client, slots = self._async_resources()
+        async with slots:
+            start = time.perf_counter()
+            response = await client.post(self.path, json=self._payload(prompt, stream=False))
+            self._check(response)
+            text = self._parse(response.json())
+            self._latencies.append(time.perf_counter() - start)
+            return text
+
+    def stream(self, prompt):
+        """Yield the text deltas of a streamed completion."""
+        with self._slots, self._client.stream("POST", self.path, json=self._payload(prompt, stream=True)) as response:
+            self._check(response)
+            for line in response.iter_lines():
+                delta = self._parse_stream_line(line)
+                if delta:
+                    yield delta
+
+    async def astream(self, prompt):
+        """Async version of `stream`."""
+        client, slots = self._async_resources()
+        async with slots:
+            async with client.stream("POST", self.path, json=self._payload(prompt, stream=True)) as response:
+                self._check(response)
+                async for line in response.aiter_lines():
+                    delta = self._parse_stream_line(line)
+                    if delta:
+                        yield delta
+
+    def close(self):
+        """Close the sync connection pool."""
+        self._client.close()
+
+    async def aclose(self):
+        """Close the async connection pool of the running event loop."""
+        resources = self._async.pop(asyncio.get_running_loop(), None)
+        if resources is not None:
+            await resources[0].aclose()
+
+    def _payload(self, prompt, stream):
+        raise NotImplementedError
+
+    def _parse(self, data):
+        raise NotImplementedError
+
+    def _parse_stream_line(self, line):
+        raise NotImplementedError
+
+
+class OllamaBackend(Backend):
+    """
+    The Ollama generate API. The context window is sent with every request, since the server
+    default (often 2048 tokens) would silently truncate prompts sized for `llm_context_window`.
+    """
+
+    path = "/api/generate"
+
+    def __init__(self, name, base_url, model, context_window=llm_context_window, num_output=llm_num_output, **kwargs):
+        super().__init__(name, base_url, model, **kwargs)
+        self.context_window = context_window
+        self.num_output = num_output
+
+    def _payload(self, prompt, stream):
+        options = {"temperature": 0.75, "num_ctx": self.context_window, "num_predict": self.num_output}
+        return {"model": self.model, "prompt": prompt, "stream": stream, "options": options}
+
+    def _parse(self, data):
+        return data.get("response", "")
+
+    def _parse_stream_line(self, line):
+        return json.loads(line).get("response", "") if line.strip() else ""
+
+
+class OpenAICompatibleBackend(Backend):
+    """An OpenAI-compatible chat completions API, e.g. OpenRouter."""
+
+    path = "/chat/completions"
+
+    def __init__(self, name, base_url, model, api_key=None, max_tokens=4096, **kwargs):
+        headers = {"Authorization": f"Bearer {api_key}"} if api_key else {}
+        super().__init__(name, base_url, model, headers=headers, **kwargs)
+        self.max_tokens = max_tokens
+
+    def _payload(self, prompt, stream):
+        return {"model": self.model, "messages": [{"role": "user", "content": prompt}], "stream": stream, "max_tokens": self.max_tokens}
+
+    def _parse(self, data):
+        return data["choices"][0]["message"].get("content") or ""
+
+    def _parse_stream_line(self, line):
+        # Server-sent events: "data: {...}" lines, ending with "data: [DONE]"
+        if not line.startswith("data:") or line[5:].strip() == "[DONE]":
+            return ""
+        choices = json.loads(line[5:]).get("choices") or [{}]
+        return choices[0].get("delta", {}).get("content") or ""
+
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def get_backend(name, model):
+    """
+    Return the shared backend of a server and model, so that all gateways using it share its
+    connection pool and concurrency limit.
+
+    Args:
+    - name (str): "ollama" or "openrouter".
+    - model (str): The model name.
+    """
+    with _backends_lock:
+        key = (name, model)
+        if key not in _backends:
+            concurrency = llm_backend_concurrency.get(name, 4)
+            if name == "ollama":
+                _backends[key] = OllamaBackend(name, ollama_base_url, model, max_concurrency=concurrency)
+            elif name == "openrouter":
+                _backends[key] = OpenAICompatibleBackend(name, openrouter_base_url, model, api_key=OPENROUTER_API, max_concurrency=concurrency)
+            else:
+                raise ValueError("Invalid LLM backend. Choose from: 'ollama', 'openrouter'.")
+        return _backends[key]
+
+
+def close_backends():
+    """Close the sync connection pools of all shared backends."""
+    with _backends_lock:
+        backends = list(_backends.values())
+    for backend in backends:
+        backend.close()
+
+
+async def aclose_backends():
+    """
+    Close the async connection pools that the shared backends opened on the running event loop.
+    Call it before closing an event loop that ran async LLM calls (e.g. at the end of `asyncio.run`).
+    """
+    with _backends_lock:
+        backends = list(_backends.values())
+    for backend in backends:
+        await backend.aclose()
+
+
+atexit.register(close_backends)
+
+
+def _backoff(attempt):
+    # Exponential backoff with full jitter
+    return random.uniform(0, min(llm_backoff_max, llm_backoff_base * 2 ** attempt))
+
+
+def _start_call(fn, *args):
+    # Hedged calls get their own thread rather than a pool worker, so that waiting for a free worker
+    # never counts towards the hedge delay; the context is copied so that they record into the current trace
+    future = Future()
+    context = contextvars.copy_context()
+
+    def run():
+        try:
+            future.set_result(context.run(fn, *args))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=run, name="llm-hedge", daemon=True).start()
+    return future
+
+
+class LLMGateway(CustomLLM):
+    """
+    LLM client over an ordered list of backends, used for both response generation and the relevance check.
+
+    Each call goes to the first backend, with retries and jittered exponential backoff on transport
+    errors and retryable HTTP statuses (read timeouts are not retried). With hedging (opt-in), a
+    duplicate request is sent when the first one has not answered within the backend's observed p95
+    latency (`llm_hedge_delay` until enough calls were observed); the first answer wins and the
+    other call is cancelled. When a backend still fails, the next one is used, e.g. OpenRouter falls
+    back to the local Ollama server.
+
+    Args:
+    - backends (list[Backend]): The backends, in order of preference.
+    """
+
+    context_window: int = Field(default=llm_context_window)
+    num_output: int = Field(default=llm_num_output)
+    max_retries: int = Field(default=llm_max_retries)
+    hedging: bool = Field(default=llm_hedging)
+    hedge_delay: float = Field(default=llm_hedge_delay)
+
+    _backends = PrivateAttr()
+
+    def __init__(self, backends, **kwargs):
+        super().__init__(**kwargs)
+        self._backends = list(backends)
+
+    @classmethod
+    def class_name(cls):
+        return "LLMGateway"
+
+    @property
+    def metadata(self):
+        return LLMMetadata(context_window=self.context_window, num_output=self.num_output, model_name=self._backends[0].model)
+
+    def _hedge_after(self, backend):
+        if not self.hedging:
+            return None
+        return backend.p95() or self.hedge_delay
+
+    def _call(self, backend, prompt, handle=None):
+        for attempt in range(self.max_retries + 1):
+            try:
+                return backend.complete(prompt, handle)
+            except NON_RETRYABLE_ERRORS:
+                raise
+            except RETRYABLE_ERRORS:
+                if handle is not None and handle.cancelled:
+                    raise CallCancelled("The call was cancelled")
+                if attempt == self.max_retries:
+                    raise
+                record(llm_retries=1)
+                time.sleep(_backoff(attempt))
+
+    async def _acall(self, backend, prompt):
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await backend.acomplete(prompt)
+            except NON_RETRYABLE_ERRORS:
+                raise
+            except RETRYABLE_ERRORS:
+                if attempt == self.max_retries:
+                    raise
+                record(llm_retries=1)
+                await asyncio.sleep(_backoff(attempt))
+
+    def _hedged(self, backend, prompt):
+        delay = self._hedge_after(backend)
+        if delay is None:
+            return self._call(backend, prompt)
+
+        primary = _CallHandle()
+        calls = {_start_call(self._call, backend, prompt, primary): primary}
+        done, _ = wait(calls, timeout=delay)
+        if not done:
+            record(llm_hedged=1)
+            hedge = _CallHandle()
+            calls[_start_call(self._call, backend, prompt, hedge)] = hedge
+        pending, error = set(calls), None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    # The loser stops at its next token and its concurrency slot is released right away
+                    for loser in pending:
+                        calls[loser].cancel()
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    async def _ahedged(self, backend, prompt):
+        delay = self._hedge_after(backend)
+        if delay is None:
+            return await self._acall(backend, prompt)
+        pending = {asyncio.ensure_future(self._acall(backend, prompt))}
+        done, _ = await asyncio.wait(pending, timeout=delay)
+        if not done:
+            record(llm_hedged=1)
+            pending.add(asyncio.ensure_future(self._acall(backend, prompt)))
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    for loser in pending:
+                        loser.cancel()
+                    return task.result()
+                error = task.exception()
+        raise error
+
+    def _fallback(self, backend, error):
+        record(llm_fallbacks=1)
+        print(f"Warning: LLM backend {backend.name} failed ({error}), falling back to the next backend")
+
+    @llm_completion_callback()
+    def complete(self, prompt, formatted=False, **kwargs):
+        for i, backend in enumerate(self._backends):
+            try:
+                return CompletionResponse(text=self._hedged(backend, prompt))
+            except Exception as e:
+                if i == len(self._backends) - 1:
+                    raise
+                self._fallback(backend, e)
+
+    @llm_completion_callback()
+    async def acomplete(self, prompt, formatted=False, **kwargs):
+        for i, backend in enumerate(self._backends):
+            try:
+                return CompletionResponse(text=await self._ahedged(backend, prompt))
+            except Exception as e:
+                if i == len(self._backends) - 1:
+                    raise
+                self._fallback(backend, e)
+
+    @llm_completion_callback()
+    def stream_complete(self, prompt, formatted=False, **kwargs):
+        def gen():
+            # Retries and fallback apply until the first token; a stream that fails later is not replayed
+            for i, backend in enumerate(self._backends):
+                for attempt in range(self.max_retries + 1):
+                    stream = backend.stream(prompt)
+                    try:
+                        first = next(stream, None)
+                    except NON_RETRYABLE_ERRORS as e:
+                        error = e
+                        break
+                    except RETRYABLE_ERRORS as e:
+                        error = e
+                        if attempt < self.max_retries:
+                            record(llm_retries=1)
+                            time.sleep(_backoff(attempt))
+                        continue
+                    except Exception as e:
+                        error = e
+                        break
+                    text = first or ""
+                    if first:
+                        yield CompletionResponse(text=text, delta=first)
+                    for delta in stream:
+                        text += delta
+                        yield CompletionResponse(text=text, delta=delta)
+                    return
+                if i == len(self._backends) - 1:
+                    raise error
+                self._fallback(backend, error)
+        return gen()
+
+    @llm_completion_callback()
+    async def astream_complete(self, prompt, formatted=False, **kwargs):
+        async def gen():
+            # Same retries and fallback as `stream_complete`, without blocking the event loop
+            for i, backend in enumerate(self._backends):
+                for attempt in range(self.max_retries + 1):
+                    stream = backend.astream(prompt)
+                    try:
+                        first = await anext(stream, None)
+                    except NON_RETRYABLE_ERRORS as e:
+                        error = e
+                        break
+                    except RETRYABLE_ERRORS as e:
+                        error = e
+                        if attempt < self.max_retries:
+                            record(llm_retries=1)
+                            await asyncio.sleep(_backoff(attempt))
+                        continue
+                    except Exception as e:
+                        error = e
+                        break
+                    text = first or ""
+                    if first:
+                        yield CompletionResponse(text=text, delta=first)
+                    async for delta in stream:
+                        text += delta
+                        yield CompletionResponse(text=text, delta=delta)
+                    return
+                if i == len(self._backends) - 1:
+                    raise error
+                self._fallback(backend, error)
+        return gen()
+
+
+def create_gateway(backend_names, model_names):
+    """
+    Create a gateway over shared backends.
+
+    Args:
+    - backend_names (list[str]): The backends in order of preference, e.g. ["openrouter", "ollama"].
+    - model_names (list[str]): The model of each backend.
+    """
+    return LLMGateway([get_backend(name, model) for name, model in zip(backend_names, model_names)])
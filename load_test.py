@@ -0,0 +1,167 @@
+import sys
+import json
+import time
+import argparse
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from batch_runner import iter_cases, normalize_case
+import main as workflow
+from main import process_query, console
+from model_registry import use_llms
+from simulated_llm import SimulatedLLM
+from tracing import percentile, latency_summary, reset_latencies, set_quiet
+
+
+def _run_request(case_id, case, speculative, scheduled=None):
+    # In open-loop mode the latency counts from the scheduled arrival, so queueing delay is included
+    start = time.perf_counter() if scheduled is None else scheduled
+    try:
+        result = process_query(case, speculative=speculative)
+        error, exception = bool(result.get("error")), None
+    except Exception as e:
+        error, exception = True, str(e)
+    return {"case_id": case_id, "latency": time.perf_counter() - start, "error": error, "exception": exception}
+
+
+def run_open_loop(cases, qps, num_requests, max_in_flight=256, speculative=False):
+    """
+    Send requests at a fixed arrival rate, regardless of how fast they complete.
+    """
+    requests = itertools.islice(itertools.cycle(cases), num_requests)
+    with ThreadPoolExecutor(max_workers=max_in_flight) as pool:
+        start = time.perf_counter()
+        futures = []
+        for i, (case_id, case) in enumerate(requests):
+            scheduled = start + i / qps
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            futures.append(pool.submit(_run_request, case_id, case, speculative, scheduled))
+        records = [future.result() for future in futures]
+    return records, time.perf_counter() - start
+
+
+def run_closed_loop(cases, concurrency, num_requests, speculative=False):
+    """
+    Keep `concurrency` requests in flight, sending the next one as soon as one completes.
+    """
+    requests = itertools.islice(itertools.cycle(cases), num_requests)
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        start = time.perf_counter()
+        futures = [pool.submit(_run_request, case_id, case, speculative) for case_id, case in requests]
+        records = [future.result() for future in futures]
+    return records, time.perf_counter() - start
+
+
+def summarize(records, elapsed):
+    """
+    Summarize one load level: throughput, error rate and latency percentiles.
+    """
+    latencies = [r["latency"] for r in records]
+    errors = sum(r["error"] for r in records)
+    return {
+        "requests": len(records),
+        "errors": errors,
+        "error_rate": errors / len(records) if records else 0.0,
+        "elapsed": elapsed,
+        "throughput": len(records) / elapsed if elapsed else 0.0,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "max": max(latencies) if latencies else 0.0,
+        "exceptions": sorted({r["exception"] for r in records if r["exception"]}),
+    }
+
+
+def is_saturated(mode, level, stats, previous, slo_p95=None, max_error_rate=0.01):
+    """
+    A level is saturated when the latency SLO or error budget is exceeded, or when throughput stops
+    following the load: below 90% of the offered rate (qps mode), or less than 5% more than the
+    previous level (concurrency mode).
+    """
+    if slo_p95 is not None and stats["p95"] > slo_p95:
+        return True
+    if stats["error_rate"] > max_error_rate:
+        return True
+    if mode == "qps":
+        return stats["throughput"] < 0.9 * level
+    return previous is not None and stats["throughput"] < 1.05 * previous["throughput"]
+
+
+def run_sweep(cases, mode, levels, num_requests, speculative=False, max_in_flight=256, slo_p95=None, max_error_rate=0.01):
+    """
+    Run increasing load levels and find the saturation point.
+
+    Returns:
+    - dict: The per-level results (with the per-stage latencies of the workflow), the first
+      saturated level and the highest level before it.
+    """
+    results, previous, saturation = [], None, None
+    for level in levels:
+        reset_latencies()
+        console.print(f"[bold blue]Load level {mode}={level}...[/bold blue]")
+        if mode == "qps":
+            records, elapsed = run_open_loop(cases, level, num_requests, max_in_flight, speculative)
+        else:
+            records, elapsed = run_closed_loop(cases, int(level), num_requests, speculative)
+        stats = {mode: level, **summarize(records, elapsed), "stages": latency_summary()}
+        stats["saturated"] = is_saturated(mode, level, stats, previous, slo_p95, max_error_rate)
+        results.append(stats)
+        console.print(f"  throughput {stats['throughput']:.2f} req/s, p50 {stats['p50']:.2f}s, p95 {stats['p95']:.2f}s, "
+                      f"p99 {stats['p99']:.2f}s, errors {stats['error_rate']:.1%}" + (" [red](saturated)[/red]" if stats["saturated"] else ""))
+        if stats["saturated"] and saturation is None:
+            saturation = level
+        previous = stats
+
+    sustainable = [r[mode] for r in results if not r["saturated"] and (saturation is None or r[mode] < saturation)]
+    return {"mode": mode, "levels": results, "saturation_level": saturation, "max_sustainable_level": max(sustainable) if sustainable else None}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load-test the EHR workflow offline with a simulated LLM.")
+    parser.add_argument("input", help="Request payloads: a sample_data.json-style file or a JSONL file.")
+    parser.add_argument("--mode", default="concurrency", choices=["qps", "concurrency"], help="Open-loop arrival rate or closed-loop concurrency.")
+    parser.add_argument("--levels", nargs="+", type=float, default=[1, 2, 4, 8, 16], help="Load levels to sweep (QPS or concurrent requests).")
+    parser.add_argument("--requests", type=int, default=50, help="Requests per load level.")
+    parser.add_argument("--max-in-flight", type=int, default=256, help="Thread limit of the open-loop mode.")
+    parser.add_argument("--speculative", action="store_true")
+    parser.add_argument("--slo-p95", type=float, default=None, help="p95 latency (seconds) above which a level is saturated.")
+    parser.add_argument("--max-error-rate", type=float, default=0.01)
+    parser.add_argument("--first-token-latency", type=float, default=0.5)
+    parser.add_argument("--tokens-per-second", type=float, default=30.0)
+    parser.add_argument("--latency-sigma", type=float, default=0.25)
+    parser.add_argument("--num-tokens", type=int, default=120)
+    parser.add_argument("--relevant-ratio", type=float, default=0.9)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of simulated LLM calls that fail.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="JSON file the sweep results are written to.")
+    args = parser.parse_args(argv)
+
+    set_quiet(True)
+    # Replayed cases repeat, cached answers would skip the pipeline this test measures
+    workflow.answer_cache_enabled = False
+    llm_args = dict(
+        first_token_latency=args.first_token_latency,
+        tokens_per_second=args.tokens_per_second,
+        latency_sigma=args.latency_sigma,
+        num_tokens=args.num_tokens,
+        relevant_ratio=args.relevant_ratio,
+        error_rate=args.error_rate,
+    )
+    use_llms(llm=SimulatedLLM(seed=args.seed, **llm_args), relevance_llm=SimulatedLLM(seed=args.seed + 1, **llm_args))
+
+    cases = [(case_id, normalize_case(case)) for case_id, case in iter_cases(args.input)]
+    # One untimed request loads the embedding model and the Chroma client
+    _run_request(*cases[0], args.speculative)
+
+    sweep = run_sweep(cases, args.mode, args.levels, args.requests, args.speculative, args.max_in_flight, args.slo_p95, args.max_error_rate)
+    console.print(f"[bold green]Saturation at {args.mode}={sweep['saturation_level']}, "
+                  f"max sustainable {args.mode}={sweep['max_sustainable_level']}[/bold green]")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(sweep, f, indent=2)
+    return sweep
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
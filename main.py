@@ -4,11 +4,19 @@ from response_generator import *
 from retriever import *
 from vector_db import *
 from question_relevance import * 
-from typing import TypedDict, Dict, Any, List
-from llama_index.core import VectorStoreIndex
+from model_registry import *
+from note_set_cache import *
+from answer_cache import *
+from embedding_store import attach_store_embeddings
+from embedding_cache import embed_queries, aembed_queries
+from tracing import *
+from typing import TypedDict, Dict, Any, List, Annotated
+from llama_index.core import VectorStoreIndex, QueryBundle
 from llama_index.core.query_engine import RetrieverQueryEngine
 from langgraph.graph import StateGraph, START, END
 import json
+import time
+import asyncio
 import colorama
 from colorama import Fore, Style
 from rich.console import Console
@@ -23,10 +31,10 @@ colorama.init()
 # Initialize Rich console
 console = Console()
 
-ChromaDB_DIR = "chromadb"
-
 def print_step_header(step_name: str, step_number: int):
     """Print a formatted header for each step"""
+    if is_quiet():
+        return
     console.print(
         Panel(
             f"[bold white]STEP {step_number}: {step_name}[/bold white]",
@@ -38,6 +46,8 @@ def print_step_header(step_name: str, step_number: int):
 
 def print_agent_output(agent_name: str, output: Dict[str, Any], success: bool = True):
     """Print agent output in a structured format"""
+    if is_quiet():
+        return
     status_color = "green" if success else "red"
     status_text = "SUCCESS" if success else "FAILURE"
     
@@ -54,10 +64,17 @@ def print_agent_output(agent_name: str, output: Dict[str, Any], success: bool =
     if output:
         console.print(JSON(json.dumps(output, indent=2)))
 
+def merge_timings(current, update):
+    """Reducer for the per-step timings, so that parallel branches can each record their own steps."""
+    return {**(current or {}), **(update or {})}
+
 # Define Graph State
 class QueryState(TypedDict):
     input: Dict[str, Any] | str
     relevance: str
+    relevance_tier: str
+    relevance_score: float
+    note_set: str
     docs: List
     nodes: List
     error: bool
@@ -66,61 +83,156 @@ class QueryState(TypedDict):
     retriever: Any
     response: str
     note_texts: str
+    synthesis_stats: Dict[str, Any]
+    timings: Annotated[Dict[str, float], merge_timings]
 
-# Initialize Chroma Client, Embedding Model and LLM
-console.print("[bold blue]Initializing Chroma Client, Embedding Model and LLM...[/bold blue]")
-chroma_client = initialize_chroma_client(ChromaDB_DIR)
-embed_model = load_embed_model("BAAI_bge")
-llm = initialise_llm(llm_model=llm_model)
-console.print("[green]Initialization Complete![/green]")
+def initialize_components():
+    """Load the Chroma client, embedding model and LLMs up front instead of on the first query."""
+    console.print("[bold blue]Initializing Chroma Client, Embedding Model and LLM...[/bold blue]")
+    warm_up(chroma_client=vector_store_backend == "chroma")
+    console.print("[green]Initialization Complete![/green]")
+
+def _apply_relevance(state, rel_response):
+    details = {"tier": state.get('relevance_tier', "llm"), "score": state.get('relevance_score')}
+    if rel_response.strip() == "Yes":
+      state['relevance'] = rel_response
+      print_agent_output("Question Relevance", {"message": f"The given inputs are relevant.", **details})
+    else:
+      state['relevance'] = "No"
+      print_agent_output("Question Relevance", {"message": f"The given inputs are not relevant. Please try again...", **details}, False)
+    return state
 
 def relevance_node(state):
     try:
         print_step_header("Question Relevance", 1)
+        if state['relevance'] in ("Yes", "No"):
+            # Decided beforehand, e.g. by the batched relevance check of the batch runner
+            return _apply_relevance(state, state['relevance'])
         patient_narr = state['input']['patient_narrative']
         patient_ques_dict = state['input']['patient_question']
         notes_dict = state['input']['note_excerpts']
-        rel_response = check_question_relevance(patient_ques_dict, patient_narr, notes_dict)
-        if rel_response.strip() == "Yes":
-          state['relevance'] = rel_response
-          print_agent_output("Question Relevance", {"message": f"The given inputs are relevant."})
+        if relevance_gate == "tiered":
+            rel_response, state['relevance_tier'], state['relevance_score'] = tiered_question_relevance(
+                patient_ques_dict, patient_narr, notes_dict, get_embed_model()
+            )
         else:
-          state['relevance'] = "No"
-          print_agent_output("Question Relevance", {"message": f"The given inputs are not relevant. Please try again..."}, False)
+            rel_response = check_question_relevance(patient_ques_dict, patient_narr, notes_dict)
+            state['relevance_tier'] = "llm"
+        return _apply_relevance(state, rel_response)
+    except Exception as e:
+        print_agent_output("Question Relevance", {"error": str(e)}, False)
+        state['relevance'] = "No"
+        print(f"Error finding relevance: {str(e)}") 
         return state
+
+async def relevance_node_async(state):
+    try:
+        print_step_header("Question Relevance", 1)
+        if state['relevance'] in ("Yes", "No"):
+            # Decided beforehand, e.g. by the batched relevance check of the batch runner
+            return _apply_relevance(state, state['relevance'])
+        patient_narr = state['input']['patient_narrative']
+        patient_ques_dict = state['input']['patient_question']
+        notes_dict = state['input']['note_excerpts']
+        if relevance_gate == "tiered":
+            rel_response, state['relevance_tier'], state['relevance_score'] = await atiered_question_relevance(
+                patient_ques_dict, patient_narr, notes_dict, get_embed_model()
+            )
+        else:
+            rel_response = await acheck_question_relevance(patient_ques_dict, patient_narr, notes_dict)
+            state['relevance_tier'] = "llm"
+        return _apply_relevance(state, rel_response)
     except Exception as e:
         print_agent_output("Question Relevance", {"error": str(e)}, False)
         state['relevance'] = "No"
         print(f"Error finding relevance: {str(e)}") 
         return state
-    
+
+def _index_client():
+    # The in-memory backend does not need a Chroma client, so do not create one
+    return get_chroma_client() if vector_store_backend == "chroma" else None
+
+def _cached_documents(note_set):
+    cached = get_note_set_cache().get(note_set, ("documents", vector_store_backend))
+    if cached is not None and vector_store_backend == "chroma":
+        # The collection is still in use, keep it from being reaped
+        touch_collection(_index_client(), note_set)
+    return cached
+
+def _store_documents(state, note_set, docs, nodes, index):
+    record(nodes=len(nodes))
+    state['note_set'] = note_set
+    state['docs'] = docs
+    state['nodes'] = nodes
+    state['index'] = index
+    print_agent_output("Document Loader", {"Loaded Docs": len(docs), "Nodes Created": len(nodes), "Index Created": "Sucessfully"})
+    return state
+
+def _attach_stored_embeddings(input, nodes):
+    # Sentences ingested into the embedding store are not re-encoded
+    if embedding_store_dir is None or input.get('case_id') is None:
+        return
+    attached = attach_store_embeddings(nodes, get_embedding_store(embedding_store_dir), input['case_id'], get_embed_model())
+    record(stored_embeddings=attached)
+
 def load_documents(state):
     try:
         print_step_header("Document Loader", 2)
         note_excerpts = state['input']['note_excerpts']
-        docs, nodes = create_docs_n_nodes(note_excerpts)
-        index = create_index(chroma_client, docs, embed_model)
-
-
-        state['docs'] = docs
-        state['nodes'] = nodes
-        state['index'] = index
-        print_agent_output("Document Loader", {"Loaded Docs": len(docs), "Nodes Created": len(nodes), "Index Created": "Sucessfully"})
+        # Follow-up questions on the same notes reuse the index built for the first one
+        note_set = note_excerpts_fingerprint(note_excerpts, get_embed_model())
+        cached = _cached_documents(note_set)
+        if cached is None:
+            docs, nodes = create_docs_n_nodes(note_excerpts)
+            _attach_stored_embeddings(state['input'], nodes)
+            index = create_index(_index_client(), docs, get_embed_model(), nodes=nodes, backend=vector_store_backend)
+            cached = get_note_set_cache().put(note_set, ("documents", vector_store_backend), (docs, nodes, index))
+        return _store_documents(state, note_set, *cached)
+    except Exception as e:
+        print_agent_output("Document Loader", {"error": str(e)}, False)
+        print(f"Error loading documents: {e}")
+        state['error'] = True
         return state
+
+async def load_documents_async(state):
+    try:
+        print_step_header("Document Loader", 2)
+        note_excerpts = state['input']['note_excerpts']
+        note_set = note_excerpts_fingerprint(note_excerpts, get_embed_model())
+        cached = await asyncio.to_thread(_cached_documents, note_set)
+        if cached is None:
+            docs, nodes = create_docs_n_nodes(note_excerpts)
+            await asyncio.to_thread(_attach_stored_embeddings, state['input'], nodes)
+            index = await acreate_index(_index_client(), docs, get_embed_model(), nodes=nodes, backend=vector_store_backend)
+            cached = get_note_set_cache().put(note_set, ("documents", vector_store_backend), (docs, nodes, index))
+        return _store_documents(state, note_set, *cached)
     except Exception as e:
         print_agent_output("Document Loader", {"error": str(e)}, False)
         print(f"Error loading documents: {e}")
         state['error'] = True
         return state
 
+def _note_set_component(state, component, factory):
+    # Retrievers and query engines are built once per note set and reused by follow-up questions
+    if not state.get('note_set'):
+        return factory()
+    return get_note_set_cache().get_or_create(state['note_set'], component, factory)
+
+def _top_k(state):
+    return max(1, (len(state['input']['note_excerpts'])*2) // 3)
+
 def retrieve(state):
     try:
         print_step_header("Retriever", 3)
         index = state["index"]
         nodes = state["nodes"]
-        note_excerpt = state['input']['note_excerpts'] 
         retriever_type = state['retriever_type']
-        retriever = build_retriever(index, nodes, retriever_type, top_k =max(1, (len(note_excerpt)*2) // 3))
+        top_k = _top_k(state)
+        def build():
+            retriever = build_retriever(index, nodes, retriever_type, top_k=top_k, embed_model=get_embed_model())
+            # top_k is the upper bound, the context is then cut to the nodes worth sending to the LLM
+            return PruningRetriever(retriever, embed_model=get_embed_model(), retriever_type=retriever_type) if context_pruning else retriever
+        retriever = _note_set_component(state, ("retriever", retriever_type, top_k), build)
 
         print_agent_output("Retriever", {"status": "Sucessfully created retriever", "retriever_type": retriever_type})
         state['retriever'] = retriever
@@ -130,91 +242,417 @@ def retrieve(state):
         print(f"Error retrieving: {e}")
         state['error'] = True
         return state
+
+async def retrieve_async(state):
+    # Building a retriever is CPU work (BM25 tokenizes the whole corpus), keep it off the event loop
+    return await asyncio.to_thread(retrieve, state)
+
+def combined_query_text(input):
+    """
+    Combine the patient questions and the clinical question into the query sent to the query engine.
+    """
+    return " ".join(input['patient_question'].values()) + " " + input['clinical_question']
+
+# Retrievers that embed the combined query with the embedding model
+DENSE_QUERY_RETRIEVERS = ("base", "auto_merger", "hybrid")
+
+def retrieval_query(input, retriever_type):
+    """
+    Return the query passed to the query engine: the combined text, with the patient questions and the
+    clinical question as separate sub-questions for the multi_query retriever. With `embedding_batching`,
+    the query of a dense retriever is embedded up front through the shared micro-batches.
+    """
+    query_text = combined_query_text(input)
+    if retriever_type == "multi_query":
+        questions = [question for question in [*input['patient_question'].values(), input['clinical_question']] if question.strip()]
+        return QueryBundle(query_str=query_text, custom_embedding_strs=questions)
+    if embedding_batching and retriever_type in DENSE_QUERY_RETRIEVERS:
+        return QueryBundle(query_str=query_text, embedding=embed_queries(get_embed_model(), [query_text])[0])
+    return query_text
+
+async def aretrieval_query(input, retriever_type):
+    """
+    Async version of `retrieval_query`.
+    """
+    if embedding_batching and retriever_type in DENSE_QUERY_RETRIEVERS:
+        query_text = combined_query_text(input)
+        return QueryBundle(query_str=query_text, embedding=(await aembed_queries(get_embed_model(), [query_text]))[0])
+    return retrieval_query(input, retriever_type)
+
+def _retrieval_stats(retriever):
+    return {**get_pruning_stats(retriever), **get_multi_query_stats(retriever)}
+
+def _query_engine(state, streaming=False):
+    def build():
+        response_synthesizer = create_response_synthesizer(get_llm(), streaming=streaming)
+        return response_synthesizer, build_query_engine(state["retriever"], response_synthesizer)
+    return _note_set_component(state, ("query_engine", state['retriever_type'], _top_k(state), streaming), build)
+
+def _apply_response(state, response, stats, response_text=None):
+    note_texts = []
+    nodes = []
+    for node in response.source_nodes:
+        note_id = node.node.metadata.get("key", "Unknown")
+        note_text = node.node.text
+        note_texts.append(f"({note_id}): {note_text}")
+        nodes.append(note_id)
+    
+    print_agent_output("Response Generator", {"status": f"Response generated, retrieved nodes: {nodes}", **stats})
+
+    state['response'] = response.response if response_text is None else response_text
+    state['note_texts'] = "\n".join(note_texts)
+    state['synthesis_stats'] = stats
+    record(llm_calls=stats.get('llm_calls', 0), prompt_tokens=stats.get('prompt_tokens', 0))
+    return state
     
 def generate_response(state):
     try:
         print_step_header("Response Generator", 4)
-        retriever = state["retriever"]
-        response_synthesizer = create_response_synthesizer(llm)
-        query_engine = build_query_engine(retriever, response_synthesizer)
-        patient_question_dict = state['input']['patient_question']
-        clinical_question_text = state['input']['clinical_question']
-        combined_query_text = " ".join(patient_question_dict.values()) + " " + clinical_question_text
-        response = query_engine.query(combined_query_text)
-
-        note_texts = []
-        nodes = []
-        for node in response.source_nodes:
-            note_id = node.node.metadata.get("key", "Unknown")
-            note_text = node.node.text
-            note_texts.append(f"({note_id}): {note_text}")
-            nodes.append(note_id)
-        
-        print_agent_output("Response Generator", {"status": f"Response generated, retrieved nodes: {nodes}"})
-    
-        state['response'] = response.response
-        state['note_texts'] = "\n".join(note_texts)
+        response_synthesizer, query_engine = _query_engine(state)
+        query_text = combined_query_text(state['input'])
+        with span("Synthesis"):
+            response = query_engine.query(retrieval_query(state['input'], state['retriever_type']))
+        stats = {**get_synthesis_stats(response_synthesizer, query_text, response.source_nodes), **_retrieval_stats(state["retriever"])}
+        return _apply_response(state, response, stats)
+    except Exception as e:
+        state['error'] = True
+        print(f"Error generating response: {e}")
         return state
+
+async def generate_response_async(state):
+    try:
+        print_step_header("Response Generator", 4)
+        response_synthesizer, query_engine = _query_engine(state)
+        query_text = combined_query_text(state['input'])
+        with span("Synthesis"):
+            response = await query_engine.aquery(await aretrieval_query(state['input'], state['retriever_type']))
+        stats = {**get_synthesis_stats(response_synthesizer, query_text, response.source_nodes), **_retrieval_stats(state["retriever"])}
+        return _apply_response(state, response, stats)
     except Exception as e:
         state['error'] = True
         print(f"Error generating response: {e}")
         return state
 
-# Define the Graph
-workflow = StateGraph(QueryState)
-workflow.add_node("Question Relevance", relevance_node)
-workflow.add_node("Document Loader", load_documents)
-workflow.add_node("Retriever", retrieve)
-workflow.add_node("Response Generator", generate_response)
+def generate_response_stream(state):
+    """
+    Streaming variant of `generate_response`: yields the response tokens as they arrive from the LLM.
 
-workflow.add_conditional_edges(
-    "Question Relevance",
-    lambda state: "Document Loader" if state['relevance']=="Yes" else END
-)
+    The supporting note texts are available in `state['note_texts']` as soon as the first token is
+    yielded; `state['response']` holds the full response once the stream is exhausted.
+    """
+    try:
+        print_step_header("Response Generator", 4)
+        start = time.perf_counter()
+        response_synthesizer, query_engine = _query_engine(state, streaming=True)
+        query_text = combined_query_text(state['input'])
+        with span("Synthesis"):
+            response = query_engine.query(retrieval_query(state['input'], state['retriever_type']))
+        stats = {**get_synthesis_stats(response_synthesizer, query_text, response.source_nodes), **_retrieval_stats(state["retriever"])}
+        _apply_response(state, response, stats, response_text="")
 
-workflow.add_conditional_edges(
-    "Document Loader",
-    lambda state: "Retriever" if not state['error'] else END
-)
-workflow.add_conditional_edges(
-    "Retriever",
-    lambda state: "Response Generator" if not state['error'] else END
-)
+        tokens = []
+        for token in response.response_gen:
+            if not tokens:
+                state.setdefault('timings', {})["Time To First Token"] = time.perf_counter() - start
+                record(time_to_first_token=state['timings']["Time To First Token"])
+            tokens.append(token)
+            yield token
+        state['response'] = "".join(tokens)
+        state.setdefault('timings', {})["Response Generator"] = time.perf_counter() - start
+    except Exception as e:
+        state['error'] = True
+        print(f"Error generating response: {e}")
+
+# State keys written by each branch of the speculative graph. Parallel branches must not write the same keys.
+RELEVANCE_KEYS = ("relevance", "relevance_tier", "relevance_score")
+LOADER_KEYS = ("note_set", "docs", "nodes", "index", "error")
+RETRIEVER_KEYS = ("retriever", "error")
+
+def _branch(node_fn, keys, skip_on_error=False):
+    """
+    Wrap a node for a parallel branch so that it only returns the state keys it owns.
+    With `skip_on_error`, the node is skipped when an earlier step of the branch failed.
+    """
+    if asyncio.iscoroutinefunction(node_fn):
+        async def async_wrapped(state):
+            if skip_on_error and state['error']:
+                return {}
+            state = await node_fn(dict(state))
+            return {key: state[key] for key in keys if key in state}
+        return async_wrapped
 
-workflow.add_edge(START, "Question Relevance")
-workflow.add_edge("Response Generator", END)
+    def wrapped(state):
+        if skip_on_error and state['error']:
+            return {}
+        state = node_fn(dict(state))
+        return {key: state[key] for key in keys if key in state}
+    return wrapped
 
-console.print("[bold blue]Compiling Workflow...[/bold blue]")
-ehr_workflow = workflow.compile()
-console.print("[green]Workflow Compilation Complete![/green]")
+def speculation_join(state):
+    """Join point of the speculative graph: the indexing/retrieval work is discarded if the inputs are not relevant."""
+    if state['relevance'] != "Yes":
+        print_agent_output("Speculative Retrieval", {"status": "Discarded, inputs are not relevant"}, False)
+    return {}
 
-def process_query(input) -> Dict[str, Any]:
+def build_workflow(wrap_node=None, use_async=False, speculative=False, include_generator=True):
     """
-    Process a query through the entire graph workflow
-    
+    Build the EHR workflow graph.
+
     Args:
-        input: Input dictionary containing the query and any other relevant information
-    
+        wrap_node: Optional callable `(step_name, node_fn) -> node_fn` applied to every node,
+            e.g. to add timing or concurrency limits around each step.
+        use_async: Use the async node implementations (run the graph with `ainvoke`).
+        speculative: Run the relevance check and the document loading/retrieval as parallel branches
+            that join before the response generator, instead of loading documents only after the
+            relevance check. The retrieval work is discarded if the inputs are not relevant.
+        include_generator: Add the response generator. Without it the graph ends after retrieval,
+            e.g. to stream the response separately with `generate_response_stream`.
+
     Returns:
-        Dict containing final query results and workflow details
+        The (uncompiled) StateGraph of the workflow.
     """
-    initial_state = {
+    wrap = wrap_node or (lambda name, fn: fn)
+    if use_async:
+        nodes = [relevance_node_async, load_documents_async, retrieve_async, generate_response_async]
+    else:
+        nodes = [relevance_node, load_documents, retrieve, generate_response]
+    relevance_fn, loader_fn, retriever_fn, generator_fn = nodes
+
+    # Define the Graph
+    workflow = StateGraph(QueryState)
+    generator_step = "Response Generator" if include_generator else END
+
+    if speculative:
+        workflow.add_node("Question Relevance", wrap("Question Relevance", _branch(relevance_fn, RELEVANCE_KEYS)))
+        workflow.add_node("Document Loader", wrap("Document Loader", _branch(loader_fn, LOADER_KEYS)))
+        workflow.add_node("Retriever", wrap("Retriever", _branch(retriever_fn, RETRIEVER_KEYS, skip_on_error=True)))
+        workflow.add_node("Speculation Join", speculation_join)
+        if include_generator:
+            workflow.add_node("Response Generator", wrap("Response Generator", generator_fn))
+            workflow.add_edge("Response Generator", END)
+
+        workflow.add_edge(START, "Question Relevance")
+        workflow.add_edge(START, "Document Loader")
+        workflow.add_edge("Document Loader", "Retriever")
+        workflow.add_edge(["Question Relevance", "Retriever"], "Speculation Join")
+        workflow.add_conditional_edges(
+            "Speculation Join",
+            lambda state: generator_step if state['relevance']=="Yes" and not state['error'] else END
+        )
+        return workflow
+
+    workflow.add_node("Question Relevance", wrap("Question Relevance", relevance_fn))
+    workflow.add_node("Document Loader", wrap("Document Loader", loader_fn))
+    workflow.add_node("Retriever", wrap("Retriever", retriever_fn))
+    if include_generator:
+        workflow.add_node("Response Generator", wrap("Response Generator", generator_fn))
+        workflow.add_edge("Response Generator", END)
+
+    workflow.add_conditional_edges(
+        "Question Relevance",
+        lambda state: "Document Loader" if state['relevance']=="Yes" else END
+    )
+
+    workflow.add_conditional_edges(
+        "Document Loader",
+        lambda state: "Retriever" if not state['error'] else END
+    )
+    workflow.add_conditional_edges(
+        "Retriever",
+        lambda state: generator_step if not state['error'] else END
+    )
+
+    workflow.add_edge(START, "Question Relevance")
+    return workflow
+
+_compiled_workflows = {}
+
+def get_workflow(use_async=False, speculative=False, include_generator=True):
+    """
+    Return the compiled workflow for the given options, compiling it on first use.
+    """
+    key = (use_async, speculative, include_generator)
+    if key not in _compiled_workflows:
+        _compiled_workflows[key] = build_workflow(
+            trace_node, use_async=use_async, speculative=speculative, include_generator=include_generator
+        ).compile()
+    return _compiled_workflows[key]
+
+def create_initial_state(input, retriever_type="base") -> Dict[str, Any]:
+    """
+    Create the initial graph state for a query.
+    """
+    return {
         "input": input,
+        "relevance": "",
+        "relevance_tier": "",
+        "relevance_score": None,
+        "note_set": "",
         "docs": [],
         "nodes": [],
         "index": "",
-        "retriever_type": "base",
+        "retriever_type": retriever_type,
         "error": False,
         "retriever": "",
         "response": "",
-        "note_texts": ""
+        "note_texts": "",
+        "synthesis_stats": {},
+        "timings": {}
     }
 
-    result = ehr_workflow.invoke(initial_state)
+def _answer_cache_key(input, retriever_type):
+    note_set = note_excerpts_fingerprint(input['note_excerpts'], get_embed_model())
+    return answer_cache_key(note_set, input.get('patient_narrative', ""), retriever_type)
+
+def _cached_answer_state(input, answer):
+    # The cached answer was relevant and needed no retrieval or LLM call
+    state = create_initial_state(input)
+    state.update({
+        "relevance": "Yes",
+        "relevance_tier": "answer_cache",
+        "relevance_score": answer["similarity"],
+        "response": answer["response"],
+        "note_texts": answer["note_texts"],
+        "synthesis_stats": {"mode": "answer_cache", "llm_calls": 0, "prompt_tokens": 0},
+    })
+    print_agent_output("Answer Cache", {"status": "Cached answer of a similar question", "similarity": answer["similarity"]})
+    return state
+
+def lookup_answer(input, retriever_type="base"):
+    """
+    Look up the answer of the same (or, with a threshold, a similar) question on the same notes in the answer cache.
+
+    The question is embedded only for similarity lookups, with `embed_queries`: patient questions are
+    not written to the persistent embedding cache.
+
+    Returns:
+        Tuple of the cache key, the question text, its embedding (None for exact lookups) and the cached answer (None on a miss).
+    """
+    cache = get_answer_cache()
+    with span("Answer Cache"):
+        key = _answer_cache_key(input, retriever_type)
+        question = combined_query_text(input)
+        question_vector = embed_queries(get_embed_model(), [question])[0] if cache.semantic else None
+        answer = cache.lookup(key, question, question_vector)
+        record(answer_cache_hits=int(answer is not None))
+    return key, question, question_vector, answer
+
+async def alookup_answer(input, retriever_type="base"):
+    """
+    Async version of `lookup_answer`.
+    """
+    cache = get_answer_cache()
+    with span("Answer Cache"):
+        key = _answer_cache_key(input, retriever_type)
+        question = combined_query_text(input)
+        question_vector = (await aembed_queries(get_embed_model(), [question]))[0] if cache.semantic else None
+        answer = cache.lookup(key, question, question_vector)
+        record(answer_cache_hits=int(answer is not None))
+    return key, question, question_vector, answer
+
+def store_answer(key, question, question_vector, state):
+    """
+    Cache the answer of a completed query, if it was relevant and succeeded.
+    """
+    if state['relevance'] == "Yes" and not state['error'] and state['response']:
+        get_answer_cache().store(key, question, {"response": state['response'], "note_texts": state['note_texts']}, question_vector)
+
+def process_query(input, speculative=speculative_mode) -> Dict[str, Any]:
+    """
+    Process a query through the entire graph workflow
+    
+    Args:
+        input: Input dictionary containing the query and any other relevant information
+        speculative: Run the relevance check and document loading/retrieval concurrently
+    
+    Returns:
+        Dict containing final query results and workflow details
+    """
+    initial_state = create_initial_state(input)
+
+    workflow = get_workflow(speculative=speculative)
+    with request_trace("process_query"):
+        if answer_cache_enabled:
+            key, question, question_vector, answer = lookup_answer(input, initial_state['retriever_type'])
+            if answer is not None:
+                return _cached_answer_state(input, answer)
+        result = workflow.invoke(initial_state)
+        if answer_cache_enabled:
+            store_answer(key, question, question_vector, result)
     return result
 
+async def process_query_async(input, speculative=speculative_mode) -> Dict[str, Any]:
+    """
+    Process a query through the entire graph workflow without blocking the event loop,
+    so a single process can serve many in-flight queries while they wait on the LLM.
+    
+    Args:
+        input: Input dictionary containing the query and any other relevant information
+        speculative: Run the relevance check and document loading/retrieval concurrently
+    
+    Returns:
+        Dict containing final query results and workflow details
+    """
+    initial_state = create_initial_state(input)
+
+    workflow = get_workflow(use_async=True, speculative=speculative)
+    with request_trace("process_query"):
+        if answer_cache_enabled:
+            key, question, question_vector, answer = await alookup_answer(input, initial_state['retriever_type'])
+            if answer is not None:
+                return _cached_answer_state(input, answer)
+        result = await workflow.ainvoke(initial_state)
+        if answer_cache_enabled:
+            store_answer(key, question, question_vector, result)
+    return result
+
+def process_query_stream(input, speculative=speculative_mode):
+    """
+    Process a query through the graph workflow, streaming the response tokens.
+
+    The relevance check, document loading and retrieval run through the graph as usual; the
+    response is then streamed from the LLM instead of being returned at once.
+
+    Args:
+        input: Input dictionary containing the query and any other relevant information
+        speculative: Run the relevance check and document loading/retrieval concurrently
+
+    Returns:
+        Tuple of the workflow state and a generator of response tokens, or None if the inputs are
+        not relevant or an error occurred. The state is completed while the generator is consumed.
+    """
+    initial_state = create_initial_state(input)
+
+    workflow = get_workflow(speculative=speculative, include_generator=False)
+    trace = start_trace("process_query")
+    with resume_trace(trace):
+        cache_entry = None
+        if answer_cache_enabled:
+            key, question, question_vector, answer = lookup_answer(input, initial_state['retriever_type'])
+            cache_entry = (key, question, question_vector)
+            if answer is not None:
+                finish_trace(trace)
+                state = _cached_answer_state(input, answer)
+                return state, iter([state['response']])
+        state = workflow.invoke(initial_state)
+    if state['relevance'] != "Yes" or state['error']:
+        finish_trace(trace)
+        return state, None
+    return state, _traced_stream(trace, generate_response_stream(state), state, cache_entry)
+
+def _traced_stream(trace, token_stream, state, cache_entry=None):
+    # The trace of a streamed query ends when the last token has been consumed
+    try:
+        with resume_trace(trace), span("Response Generator"):
+            yield from token_stream
+        if cache_entry is not None:
+            store_answer(*cache_entry, state)
+    finally:
+        finish_trace(trace)
+
 # Main Execution
 if __name__ == "__main__":
+    initialize_components()
     console.print("[bold yellow] Starting EHR Workflow...[/bold yellow]")
     user_input = {
       "note_excerpts": {
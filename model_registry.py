@@ -0,0 +1,93 @@
+import threading
+from config import llm_model, embed_model_name, chroma_db_dir
+from embedding_store import EmbeddingStore
+from utils import load_embed_model, initialise_llm, initialise_relevance_llm
+from vector_db import initialize_chroma_client
+
+# Process-wide registry of the heavy components (embedding models, LLM clients, Chroma clients).
+# Everything is created lazily on first use and shared by all modules, so importing the pipeline is
+# cheap and each model is loaded into memory only once.
+_registry = {}
+_registry_lock = threading.Lock()
+_creation_locks = {}
+
+
+def _get_or_create(key, factory):
+    instance = _registry.get(key)
+    if instance is not None:
+        return instance
+
+    # One lock per key, so that loading the embedding model does not block creating an LLM client
+    with _registry_lock:
+        lock = _creation_locks.setdefault(key, threading.Lock())
+    with lock:
+        if key not in _registry:
+            _registry[key] = factory()
+        return _registry[key]
+
+
+def get_embed_model(name=embed_model_name):
+    """
+    Return the shared embedding model for a key of `config.embed_models`, loading it on first use.
+    """
+    return _get_or_create(("embed_model", name), lambda: load_embed_model(name))
+
+
+def get_embedding_store(store_dir):
+    """
+    Return the shared read-only view of an embedding store written by `ingest.py`.
+    """
+    return _get_or_create(("embedding_store", store_dir), lambda: EmbeddingStore(store_dir))
+
+
+def get_llm(model=llm_model):
+    """
+    Return the shared Ollama LLM used for response generation.
+    """
+    return _get_or_create(("llm", model), lambda: initialise_llm(llm_model=model))
+
+
+def get_relevance_llm():
+    """
+    Return the shared OpenRouter LLM used for the question relevance check.
+    """
+    return _get_or_create(("relevance_llm",), initialise_relevance_llm)
+
+
+def get_chroma_client(path=chroma_db_dir):
+    """
+    Return the shared ChromaDB client for a persistence directory.
+    """
+    return _get_or_create(("chroma_client", path), lambda: initialize_chroma_client(path))
+
+
+def use_llms(llm=None, relevance_llm=None, model=llm_model):
+    """
+    Replace the shared LLMs, e.g. with the local stand-ins of `load_test.py`.
+    """
+    with _registry_lock:
+        if llm is not None:
+            _registry[("llm", model)] = llm
+        if relevance_llm is not None:
+            _registry[("relevance_llm",)] = relevance_llm
+
+
+def warm_up(embed_model=True, llm=True, relevance_llm=True, chroma_client=False):
+    """
+    Create the selected components up front, e.g. at server start, instead of on the first request.
+    """
+    if embed_model:
+        get_embed_model()
+    if llm:
+        get_llm()
+    if relevance_llm:
+        get_relevance_llm()
+    if chroma_client:
+        get_chroma_client()
+
+
+def loaded_components():
+    """
+    Return the keys of the components created so far.
+    """
+    return list(_registry.keys())
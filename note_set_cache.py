@@ -0,0 +1,79 @@
+import threading
+from collections import OrderedDict
+from config import note_set_cache_size
+
+
+class NoteSetCache:
+    """
+    LRU cache of the components built for a note set: its index and nodes, retrievers (including the
+    stemmed BM25 index) and query engines.
+
+    Entries are keyed by the note set fingerprint (`note_excerpts_fingerprint`), so edited notes get a
+    new entry; `invalidate` drops the entry of a note set whose index or nodes were changed in place.
+    """
+
+    def __init__(self, max_note_sets=note_set_cache_size):
+        self.max_note_sets = max_note_sets
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, fingerprint, component):
+        """Return a cached component of a note set, or None."""
+        with self._lock:
+            entry = self._entries.get(fingerprint)
+            if entry is None or component not in entry:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(fingerprint)
+            self.hits += 1
+            return entry[component]
+
+    def put(self, fingerprint, component, value):
+        """Cache a component of a note set, evicting the least recently used note sets."""
+        with self._lock:
+            self._entries.setdefault(fingerprint, {})[component] = value
+            self._entries.move_to_end(fingerprint)
+            while len(self._entries) > self.max_note_sets:
+                self._entries.popitem(last=False)
+        return value
+
+    def get_or_create(self, fingerprint, component, factory):
+        """
+        Return a cached component of a note set, building it with `factory()` on a miss.
+        """
+        value = self.get(fingerprint, component)
+        if value is None:
+            # Built outside the lock; concurrent misses may build twice, the last one is kept
+            value = self.put(fingerprint, component, factory())
+        return value
+
+    def invalidate(self, fingerprint=None):
+        """Drop the components of one note set, or of all note sets."""
+        with self._lock:
+            if fingerprint is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(fingerprint, None)
+
+    def stats(self):
+        """
+        Return hit/miss counters and the number of cached note sets.
+        """
+        return {"hits": self.hits, "misses": self.misses, "note_sets": len(self._entries)}
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_note_set_cache():
+    """
+    Return the process-wide note set cache, creating it on first use.
+    """
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = NoteSetCache()
+        return _default_cache
@@ -0,0 +1,95 @@
+import numpy as np
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.vector_stores.types import BasePydanticVectorStore, VectorStoreQuery, VectorStoreQueryResult
+
+
+class NumpyVectorStore(BasePydanticVectorStore):
+    """
+    In-memory vector store for small per-case note sets.
+
+    Embeddings are kept L2-normalized in one contiguous float32 array, and a query is an exact top-k
+    search: one matrix-vector product followed by `argpartition`. There is no disk I/O, so it is meant
+    for the handful of note sentences of a single case; use ChromaDB for large or persistent corpora.
+    """
+
+    stores_text: bool = True
+    is_embedding_query: bool = True
+
+    _matrix = PrivateAttr(default=None)
+    _nodes = PrivateAttr(default_factory=list)
+
+    @property
+    def client(self):
+        return None
+
+    @property
+    def embeddings(self):
+        """The normalized (num_nodes, dim) float32 embedding matrix."""
+        return self._matrix
+
+    @property
+    def nodes(self):
+        """The stored nodes, in the row order of `embeddings`."""
+        return list(self._nodes)
+
+    @staticmethod
+    def _normalize(vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    def add(self, nodes, **add_kwargs):
+        if not nodes:
+            return []
+        vectors = self._normalize([node.get_embedding() for node in nodes])
+        self._matrix = vectors if self._matrix is None else np.vstack([self._matrix, vectors])
+        self._nodes.extend(nodes)
+        return [node.node_id for node in nodes]
+
+    def _keep(self, mask):
+        self._nodes = [node for node, keep in zip(self._nodes, mask) if keep]
+        self._matrix = self._matrix[np.asarray(mask, dtype=bool)] if self._nodes else None
+
+    def delete(self, ref_doc_id, **delete_kwargs):
+        self._keep([node.ref_doc_id != ref_doc_id for node in self._nodes])
+
+    def delete_nodes(self, node_ids=None, filters=None, **delete_kwargs):
+        if filters is not None:
+            raise NotImplementedError("Metadata filters are not supported by NumpyVectorStore.")
+        node_ids = set(node_ids or [])
+        self._keep([node.node_id not in node_ids for node in self._nodes])
+
+    def get_nodes(self, node_ids=None, filters=None, **kwargs):
+        if node_ids is None:
+            return list(self._nodes)
+        node_ids = set(node_ids)
+        return [node for node in self._nodes if node.node_id in node_ids]
+
+    def clear(self):
+        self._matrix = None
+        self._nodes = []
+
+    def query(self, query: VectorStoreQuery, **kwargs):
+        if query.filters is not None:
+            raise NotImplementedError("Metadata filters are not supported by NumpyVectorStore.")
+        if self._matrix is None or query.query_embedding is None:
+            return VectorStoreQueryResult(nodes=[], similarities=[], ids=[])
+
+        rows = np.arange(len(self._nodes))
+        if query.node_ids:
+            allowed = set(query.node_ids)
+            rows = rows[[node.node_id in allowed for node in self._nodes]]
+        if rows.size == 0:
+            return VectorStoreQueryResult(nodes=[], similarities=[], ids=[])
+
+        scores = self._matrix[rows] @ self._normalize(query.query_embedding)
+        k = min(query.similarity_top_k, rows.size)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+
+        nodes = [self._nodes[rows[i]] for i in top]
+        return VectorStoreQueryResult(
+            nodes=nodes,
+            similarities=scores[top].tolist(),
+            ids=[node.node_id for node in nodes],
+        )
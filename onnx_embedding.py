@@ -0,0 +1,162 @@
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import numpy as np
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.bridge.pydantic import PrivateAttr
+from config import embed_models
+
+ONNX_CACHE_DIR = "onnx_models"
+
+
+def _quantize_model_dir(model_dir, output_dir):
+    """
+    Copy a fastembed model directory and quantize its ONNX weights to int8 (dynamic quantization).
+    """
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+
+    if os.path.isdir(output_dir):
+        return output_dir
+    tmp_dir = output_dir + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    shutil.copytree(model_dir, tmp_dir)
+    for root, _, files in os.walk(tmp_dir):
+        for name in files:
+            if name.endswith(".onnx"):
+                path = os.path.join(root, name)
+                quantize_dynamic(path, path + ".int8", weight_type=QuantType.QInt8)
+                os.replace(path + ".int8", path)
+    os.replace(tmp_dir, output_dir)
+    return output_dir
+
+
+def _model_dir(text_embedding):
+    # fastembed keeps the directory of the downloaded model on the underlying model object
+    model = getattr(text_embedding, "model", text_embedding)
+    return str(getattr(model, "_model_dir", None) or getattr(model, "model_dir", ""))
+
+
+class OnnxEmbedding(BaseEmbedding):
+    """
+    CPU embedding backend running the models of `config.embed_models` through ONNX Runtime (via fastembed).
+
+    Args:
+    - model_name (str): The Hugging Face model name, e.g. "BAAI/bge-base-en-v1.5".
+    - quantize (bool): Use dynamically int8-quantized weights (smaller and faster on CPU, slightly less accurate).
+    - embed_batch_size (int): Number of texts per forward pass.
+    - threads (int, optional): ONNX Runtime intra-op threads. Defaults to all cores.
+    - cache_dir (str): Where the ONNX models (and their quantized copies) are stored.
+    """
+
+    _model = PrivateAttr()
+    _batch_size = PrivateAttr()
+
+    def __init__(self, model_name, quantize=False, embed_batch_size=32, threads=None, cache_dir=ONNX_CACHE_DIR, **kwargs):
+        from fastembed import TextEmbedding
+
+        # Quantized vectors differ from the full precision ones, so they must not share embedding cache entries
+        super().__init__(
+            model_name=f"{model_name}@onnx" + ("-int8" if quantize else ""),
+            embed_batch_size=embed_batch_size,
+            **kwargs,
+        )
+        model = TextEmbedding(model_name=model_name, cache_dir=cache_dir, threads=threads)
+        if quantize:
+            quantized_dir = os.path.join(cache_dir, model_name.replace("/", "__") + "-int8")
+            try:
+                _quantize_model_dir(_model_dir(model), quantized_dir)
+                model = TextEmbedding(model_name=model_name, cache_dir=cache_dir, threads=threads, specific_model_path=quantized_dir)
+            except Exception as e:
+                print(f"Warning: Could not quantize {model_name}, using full precision ONNX weights: {e}")
+        self._model = model
+        self._batch_size = embed_batch_size
+
+    @classmethod
+    def class_name(cls):
+        return "OnnxEmbedding"
+
+    def _embed(self, texts):
+        return [vector.tolist() for vector in self._model.embed(texts, batch_size=self._batch_size)]
+
+    def _get_query_embedding(self, query):
+        return self._embed([query])[0]
+
+    def _get_text_embedding(self, text):
+        return self._embed([text])[0]
+
+    def _get_text_embeddings(self, texts):
+        return self._embed(texts)
+
+    # ONNX Runtime calls block, run them in a worker thread so that they do not stall the event loop
+    async def _aget_query_embedding(self, query):
+        return await asyncio.to_thread(self._get_query_embedding, query)
+
+    async def _aget_text_embedding(self, text):
+        return await asyncio.to_thread(self._get_text_embedding, text)
+
+    async def _aget_text_embeddings(self, texts):
+        return await asyncio.to_thread(self._get_text_embeddings, texts)
+
+
+def compare_backends(embed_model_name, texts, quantize=False, batch_size=32, threads=None):
+    """
+    Measure the accuracy delta and the speed of the ONNX backend against the PyTorch backend.
+
+    Args:
+    - embed_model_name (str): A key of `config.embed_models`.
+    - texts (list[str]): The texts to embed (e.g. note sentences).
+    - quantize (bool): Compare the int8-quantized ONNX model.
+
+    Returns:
+    - dict: Cosine similarity between the two backends' vectors (mean/min), the agreement of the
+      nearest neighbour of every text, and the load time and throughput of both backends.
+    """
+    from utils import load_embed_model
+
+    results = {}
+    vectors = {}
+    for backend in ("torch", "onnx"):
+        start = time.perf_counter()
+        model = load_embed_model(embed_model_name, backend=backend, quantize=quantize, batch_size=batch_size, threads=threads)
+        load_time = time.perf_counter() - start
+        start = time.perf_counter()
+        embeddings = np.asarray(model.get_text_embedding_batch(texts), dtype=np.float32)
+        elapsed = time.perf_counter() - start
+        vectors[backend] = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+        results[backend] = {"load_seconds": load_time, "texts_per_second": len(texts) / elapsed if elapsed else 0.0}
+
+    cosine = np.sum(vectors["torch"] * vectors["onnx"], axis=1)
+    # Agreement of the nearest neighbour of every text within the set, which is what retrieval depends on
+    torch_sim, onnx_sim = vectors["torch"] @ vectors["torch"].T, vectors["onnx"] @ vectors["onnx"].T
+    np.fill_diagonal(torch_sim, -np.inf)
+    np.fill_diagonal(onnx_sim, -np.inf)
+    results["cosine_mean"] = float(cosine.mean())
+    results["cosine_min"] = float(cosine.min())
+    results["nearest_neighbour_agreement"] = float(np.mean(torch_sim.argmax(axis=1) == onnx_sim.argmax(axis=1)))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the ONNX embedding backend against the PyTorch backend.")
+    parser.add_argument("input", help="sample_data.json-style file whose note sentences are embedded.")
+    parser.add_argument("--model", default="BAAI_bge", choices=list(embed_models.keys()))
+    parser.add_argument("--quantize", action="store_true")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--markdown", action="store_true", help="Print the result as a row of the README delta table.")
+    args = parser.parse_args(sys.argv[1:])
+
+    with open(args.input) as f:
+        data = json.load(f)
+    cases = data.values() if isinstance(data, dict) else data
+    sentences = [s for case in cases for s in case.get("note_excerpts", {}).values() if s.strip()]
+    results = compare_backends(args.model, sentences, args.quantize, args.batch_size, args.threads)
+    if args.markdown:
+        print(f"| {args.model} | {'int8' if args.quantize else 'fp32'} | {results['cosine_mean']:.4f} | {results['cosine_min']:.4f} "
+              f"| {results['nearest_neighbour_agreement']:.1%} |")
+    else:
+        print(json.dumps(results, indent=2))
@@ -1,25 +1,26 @@
-from llama_index.llms.openrouter import OpenRouter
+import re
+import json
+import threading
+import contextvars
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from config import *
+from embedding_cache import embed_texts, aembed_texts, embed_queries, aembed_queries, text_hash
+from model_registry import get_relevance_llm
+from response_generator import count_tokens
+from tracing import span, record
 
-# Initialize the LLM
-llm = OpenRouter(
-    api_key=OPENROUTER_API,  
-    max_tokens=4096,
-    context_window=4096,
-    # model="openai/gpt-3.5-turbo",
-    model="deepseek/deepseek-r1:free",
-)
-
-def check_question_relevance(patient_question_dict, patient_narr, notes_dict):
+def build_relevance_prompt(patient_question_dict, patient_narr, notes_dict):
     # Get patient question
     ques_dict = patient_question_dict
     if ques_dict is None:
-        return "Error: patient_question is None"
+        raise ValueError("Error: patient_question is None")
     ques_text = "\n".join(ques_dict.values()) if isinstance(ques_dict, dict) else str(ques_dict)
 
     # Get note excerpt
     if notes_dict is None:
-        return "Error: note_excerpt_sentences is None"
+        raise ValueError("Error: note_excerpt_sentences is None")
     notes_text = "\n".join(notes_dict.values()) if isinstance(notes_dict, dict) else str(notes_dict)
 
     prompt = f"""
@@ -54,11 +55,334 @@ Respond with one of the following:
 Use clinical reasoning to assess whether the information in the clinical notes can help answer or provide insight into the patient's question.
 Do not explain your answer. Just say "Yes" or "No". NOTHING ELSE.
     """
+    return prompt
+
+def _parse_relevance_response(response):
+    if response is None or not hasattr(response, 'text'):
+        return "No"
+    return response.text.strip()
+
+def check_question_relevance(patient_question_dict, patient_narr, notes_dict):
+    try:
+        prompt = build_relevance_prompt(patient_question_dict, patient_narr, notes_dict)
+    except ValueError as e:
+        return str(e)
+    try:
+        record(llm_calls=1, prompt_tokens=count_tokens(prompt))
+        with span("Relevance LLM"):
+            response = get_relevance_llm().complete(prompt)
+        return _parse_relevance_response(response)
+    except Exception as e:
+        print(f"Error : {e}")
+        return "Error: Exception occurred"
+
+async def acheck_question_relevance(patient_question_dict, patient_narr, notes_dict):
+    """
+    Async version of `check_question_relevance`, awaiting the LLM instead of blocking a thread.
+    """
+    try:
+        prompt = build_relevance_prompt(patient_question_dict, patient_narr, notes_dict)
+    except ValueError as e:
+        return str(e)
+    try:
+        record(llm_calls=1, prompt_tokens=count_tokens(prompt))
+        with span("Relevance LLM"):
+            response = await get_relevance_llm().acomplete(prompt)
+        return _parse_relevance_response(response)
+    except Exception as e:
+        print(f"Error : {e}")
+        return "Error: Exception occurred"
+
+def _question_and_notes(patient_question_dict, notes_dict):
+    ques_text = " ".join(patient_question_dict.values()) if isinstance(patient_question_dict, dict) else str(patient_question_dict)
+    notes = list(notes_dict.values()) if isinstance(notes_dict, dict) else [str(notes_dict)]
+    return ques_text, [note for note in notes if note.strip()]
+
+def similarity_score(question_embedding, note_embeddings):
+    """
+    Maximum cosine similarity between the question and any note sentence, computed with one matrix-vector product.
+
+    Args:
+    - question_embedding (list[float]): The embedding of the patient question.
+    - note_embeddings (list[list[float]]): The embeddings of the note sentences.
+
+    Returns:
+    - float: The highest similarity, or 0.0 if there are no notes.
+    """
+    if not note_embeddings:
+        return 0.0
+    notes = np.asarray(note_embeddings, dtype=np.float32)
+    question = np.asarray(question_embedding, dtype=np.float32)
+    notes /= np.maximum(np.linalg.norm(notes, axis=1, keepdims=True), 1e-12)
+    question /= max(np.linalg.norm(question), 1e-12)
+    return float(np.max(notes @ question))
+
+def _similarity_decision(score, accept_threshold, reject_threshold):
+    if score >= accept_threshold:
+        return "Yes", "similarity_accept"
+    if score < reject_threshold:
+        return "No", "similarity_reject"
+    return None, "llm"
+
+def tiered_question_relevance(patient_question_dict, patient_narr, notes_dict, embed_model,
+                              accept_threshold=relevance_accept_threshold, reject_threshold=relevance_reject_threshold):
+    """
+    Tiered relevance gate: accept or reject on the question-vs-notes similarity when it is confidently
+    high or low, and call the LLM only in the ambiguous band between the thresholds.
+
+    Args:
+    - patient_question_dict (dict): The patient questions.
+    - patient_narr (str): The patient narrative (only used by the LLM tier).
+    - notes_dict (dict): The note excerpt sentences.
+    - embed_model: The embedding model used for the similarity tier.
+    - accept_threshold (float): Similarity at or above which the inputs are accepted without the LLM.
+    - reject_threshold (float): Similarity below which the inputs are rejected without the LLM.
+
+    Returns:
+    - tuple: (decision, tier, score) where tier is "similarity_accept", "similarity_reject" or "llm".
+    """
+    if patient_question_dict is None or notes_dict is None:
+        return check_question_relevance(patient_question_dict, patient_narr, notes_dict), "llm", None
+    ques_text, notes = _question_and_notes(patient_question_dict, notes_dict)
+    score = similarity_score(embed_queries(embed_model, [ques_text])[0], embed_texts(embed_model, notes))
+    decision, tier = _similarity_decision(score, accept_threshold, reject_threshold)
+    if decision is None:
+        decision = check_question_relevance(patient_question_dict, patient_narr, notes_dict)
+    return decision, tier, score
+
+async def atiered_question_relevance(patient_question_dict, patient_narr, notes_dict, embed_model,
+                                     accept_threshold=relevance_accept_threshold, reject_threshold=relevance_reject_threshold):
+    """
+    Async version of `tiered_question_relevance`.
+    """
+    if patient_question_dict is None or notes_dict is None:
+        return await acheck_question_relevance(patient_question_dict, patient_narr, notes_dict), "llm", None
+    ques_text, notes = _question_and_notes(patient_question_dict, notes_dict)
+    question_embedding = (await aembed_queries(embed_model, [ques_text]))[0]
+    score = similarity_score(question_embedding, await aembed_texts(embed_model, notes))
+    decision, tier = _similarity_decision(score, accept_threshold, reject_threshold)
+    if decision is None:
+        decision = await acheck_question_relevance(patient_question_dict, patient_narr, notes_dict)
+    return decision, tier, score
+
+def calibrate_relevance_thresholds(scores, labels):
+    """
+    Derive accept/reject thresholds from labeled similarity scores (e.g. recorded `relevance_score`s
+    of past traffic with their final relevance), so that neither similarity tier makes a wrong decision
+    on the labeled set. Everything in between is left to the LLM.
+
+    Args:
+    - scores (list[float]): Similarity scores.
+    - labels (list[bool]): True for relevant cases, False for irrelevant ones.
+
+    Returns:
+    - tuple: (accept_threshold, reject_threshold).
+    """
+    scores = np.asarray(scores, dtype=np.float32)
+    labels = np.asarray(labels, dtype=bool)
+    irrelevant, relevant = scores[~labels], scores[labels]
+    # Accept only above every irrelevant score, reject only below every relevant score
+    accept = float(np.nextafter(irrelevant.max(), np.inf)) if irrelevant.size else float(scores.min())
+    reject = float(relevant.min()) if relevant.size else float(np.nextafter(scores.max(), np.inf))
+    return accept, min(reject, accept)
+
+BATCH_RELEVANCE_INSTRUCTIONS = """
+You are an expert clinical assistant.
+
+# Task
+For each case below, determine whether the **patient's question** is relevant to the **clinical notes** of that case, that is you should understand the clinical history using the clinical notes and the patient narrative. Judge every case independently.
+
+# Types of questions can be asked:
+  - It can be a follow up question.
+  - Some conseqence or complications of the problem/issues faced.
+  - It can be a treatment or medication queries.
+  - It can be a diagnostic clarification or symptom concerns about the problem/issue faced
+  - A question directly related with the clinical notes.
+
+# Cases
+{cases}
+
+# Output Format (Strictly follow the output format)
+Respond with a single JSON object mapping every case number to "Yes" (relevant) or "No" (not relevant), e.g. {{"1": "Yes", "2": "No"}}.
+Do not explain your answers. Output the JSON object and NOTHING ELSE.
+    """
+
+def _batch_case_section(number, patient_question_dict, patient_narr, notes_dict):
+    ques_text = "\n".join(patient_question_dict.values()) if isinstance(patient_question_dict, dict) else str(patient_question_dict)
+    notes_text = "\n".join(notes_dict.values()) if isinstance(notes_dict, dict) else str(notes_dict)
+    return f"## Case {number}\n### Patient Narrative\n{patient_narr}\n\n### Patient Question\n{ques_text}\n\n### Clinical Notes\n{notes_text}\n"
+
+def build_batch_relevance_prompt(cases):
+    """
+    Build one relevance prompt for several cases, numbered from 1 in the given order.
+
+    Args:
+    - cases (list[tuple]): (patient_question_dict, patient_narr, notes_dict) triples.
+    """
+    sections = [_batch_case_section(i, question, narr, notes) for i, (question, narr, notes) in enumerate(cases, 1)]
+    return BATCH_RELEVANCE_INSTRUCTIONS.format(cases="\n".join(sections))
+
+def pack_relevance_cases(cases, token_budget=relevance_batch_token_budget, max_cases=relevance_batch_max_cases):
+    """
+    Pack cases into as few batch prompts as fit the token budget, in order.
+
+    Returns:
+    - list[list[int]]: The indices of the cases of each pack. A case larger than the budget gets a pack of its own.
+    """
+    overhead = count_tokens(build_batch_relevance_prompt([]))
+    packs, current, used = [], [], overhead
+    for i, (question, narr, notes) in enumerate(cases):
+        tokens = count_tokens(_batch_case_section(len(current) + 1, question, narr, notes))
+        if current and (used + tokens > token_budget or len(current) >= max_cases):
+            packs.append(current)
+            current, used = [], overhead
+        current.append(i)
+        used += tokens
+    if current:
+        packs.append(current)
+    return packs
+
+def _parse_batch_relevance_response(response, num_cases):
+    """
+    Parse the JSON answer of a batch prompt into {case number: "Yes"/"No"}; invalid entries are left out.
+    """
+    text = response.text if response is not None and hasattr(response, 'text') else ""
+    # Reasoning models may think out loud first, the answer is the last JSON object
+    for candidate in reversed(re.findall(r"\{[^{}]*\}", text)):
+        try:
+            data = json.loads(candidate)
+        except ValueError:
+            continue
+        return {
+            int(number): answer.strip().capitalize()
+            for number, answer in data.items()
+            if str(number).isdigit() and 1 <= int(number) <= num_cases
+            and isinstance(answer, str) and answer.strip().lower() in ("yes", "no")
+        }
+    return {}
+
+def _valid_case(case):
+    question, _, notes = case
+    return question is not None and notes is not None
+
+def _check_pack(cases, pack):
+    # Returns the answer of every case of the pack (None if missing or malformed) and the prompt tokens
+    prompt = build_batch_relevance_prompt([cases[i] for i in pack])
+    prompt_tokens = count_tokens(prompt)
+    record(llm_calls=1, prompt_tokens=prompt_tokens)
     try:
-        response = llm.complete(prompt)
-        if response is None or not hasattr(response, 'text'):
-            return "No"
-        return response.text.strip()
+        with span("Relevance LLM", cases=len(pack)):
+            answers = _parse_batch_relevance_response(get_relevance_llm().complete(prompt), len(pack))
     except Exception as e:
         print(f"Error : {e}")
-        return "Error: Exception occurred"
\ No newline at end of file
+        answers = {}
+    return {i: answers.get(number) for number, i in enumerate(pack, 1)}, prompt_tokens
+
+_relevance_cache = OrderedDict()
+_relevance_cache_lock = threading.Lock()
+
+def _relevance_key(case):
+    # The single-case prompt holds everything the decision depends on
+    return text_hash(build_relevance_prompt(*case))
+
+def _cached_relevance(key):
+    with _relevance_cache_lock:
+        decision = _relevance_cache.get(key)
+        if decision is not None:
+            _relevance_cache.move_to_end(key)
+        return decision
+
+def _cache_relevance(key, decision):
+    if relevance_cache_size <= 0 or decision not in ("Yes", "No"):
+        return
+    with _relevance_cache_lock:
+        _relevance_cache[key] = decision
+        _relevance_cache.move_to_end(key)
+        while len(_relevance_cache) > relevance_cache_size:
+            _relevance_cache.popitem(last=False)
+
+def batch_check_question_relevance(cases, token_budget=relevance_batch_token_budget, max_cases=relevance_batch_max_cases,
+                                   concurrency=relevance_batch_concurrency):
+    """
+    LLM relevance check of many cases, several cases per request.
+
+    The cases are packed under the token budget with the instruction block sent once per pack, the
+    packs are sent concurrently, and every case whose answer is missing or malformed is checked
+    again on its own with `check_question_relevance`, through the same pool. The LLM calls are
+    recorded into the caller's trace. Duplicate cases are checked once, and decisions are cached
+    across calls by the hash of the case's relevance prompt (`relevance_cache_size`).
+
+    Args:
+    - cases (list[tuple]): (patient_question_dict, patient_narr, notes_dict) triples.
+    - token_budget (int): Maximum prompt tokens of a pack.
+    - max_cases (int): Maximum number of cases per pack.
+    - concurrency (int): Maximum number of packs in flight.
+
+    Returns:
+    - tuple: The decisions ("Yes"/"No", in the order of `cases`) and the stats (number of packs,
+      LLM calls, single-case fallbacks, cache hits, duplicates and prompt tokens).
+    """
+    decisions = [None] * len(cases)
+    keys = {i: _relevance_key(case) for i, case in enumerate(cases) if _valid_case(case)}
+    first = {}
+    for i, key in keys.items():
+        decisions[i] = _cached_relevance(key)
+        if decisions[i] is None:
+            first.setdefault(key, i)
+    # Only the first case of every uncached prompt is sent; its duplicates get its decision
+    valid = sorted(first.values())
+    duplicates = {i for i, key in keys.items() if decisions[i] is None and first[key] != i}
+    packs = [[valid[i] for i in pack] for pack in pack_relevance_cases([cases[i] for i in valid], token_budget, max_cases)]
+    stats = {"cases": len(cases), "packs": len(packs), "llm_calls": len(packs), "fallbacks": 0,
+             "cached": sum(decision is not None for decision in decisions), "duplicates": len(duplicates), "prompt_tokens": 0}
+
+    def submit(pool, fn, *args):
+        # Each call runs in a copy of the caller's context, so that it records into the current trace
+        return pool.submit(contextvars.copy_context().run, fn, *args)
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        for future in [submit(pool, _check_pack, cases, pack) for pack in packs]:
+            answers, prompt_tokens = future.result()
+            stats["prompt_tokens"] += prompt_tokens
+            for i, answer in answers.items():
+                decisions[i] = answer
+
+        # Malformed or missing answers (or invalid inputs): check those cases on their own
+        fallbacks = [i for i, decision in enumerate(decisions) if decision is None and i not in duplicates]
+        stats["fallbacks"] += len(fallbacks)
+        stats["llm_calls"] += sum(_valid_case(cases[i]) for i in fallbacks)
+        for i, future in [(i, submit(pool, check_question_relevance, *cases[i])) for i in fallbacks]:
+            decisions[i] = future.result()
+
+    for i in valid:
+        _cache_relevance(keys[i], decisions[i])
+    for i in duplicates:
+        decisions[i] = decisions[first[keys[i]]]
+    return decisions, stats
+
+def batch_question_relevance(cases, embed_model=None, accept_threshold=relevance_accept_threshold,
+                             reject_threshold=relevance_reject_threshold, **batch_kwargs):
+    """
+    Relevance gate of many cases: with an embedding model, the similarity tier of
+    `tiered_question_relevance` decides the confident cases first and only the ambiguous ones are
+    sent to `batch_check_question_relevance`.
+
+    Returns:
+    - tuple: (decision, tier, score) per case, in order, and the stats of the batched LLM check.
+    """
+    results = [(None, "llm", None)] * len(cases)
+    if embed_model is not None:
+        for i, (question, _, notes) in enumerate(cases):
+            if question is None or notes is None:
+                continue
+            ques_text, note_texts = _question_and_notes(question, notes)
+            score = similarity_score(embed_queries(embed_model, [ques_text])[0], embed_texts(embed_model, note_texts))
+            decision, tier = _similarity_decision(score, accept_threshold, reject_threshold)
+            results[i] = (decision, tier, score)
+
+    ambiguous = [i for i, (decision, _, _) in enumerate(results) if decision is None]
+    decisions, stats = batch_check_question_relevance([cases[i] for i in ambiguous], **batch_kwargs)
+    for i, decision in zip(ambiguous, decisions):
+        results[i] = (decision, "llm_batch", results[i][2])
+    return results, stats
+
@@ -1,26 +1,227 @@
-from llama_index.core.response_synthesizers import ResponseMode
+import threading
+import contextvars
+import tiktoken
+from llama_index.core.response_synthesizers import ResponseMode, BaseSynthesizer
 from llama_index.core import get_response_synthesizer
 from llama_index.core.query_engine import RetrieverQueryEngine
 from llama_index.core import PromptTemplate
-from config import summary_prompt
+from llama_index.core.schema import MetadataMode
+from config import summary_prompt, refine_prompt, synthesis_mode, llm_context_window, llm_num_output
 
+# Rough characters per token, used when the tiktoken encoding cannot be loaded (e.g. offline)
+CHARS_PER_TOKEN = 4
 
-def create_response_synthesizer(llm):
+_encoding = None
+_encoding_loaded = False
+_encoding_lock = threading.Lock()
+
+
+def get_encoding():
+    """
+    Return the tiktoken encoding used for the prompt budget, loading it on first use.
+
+    tiktoken downloads the encoding the first time it is used, so this returns None when it is not
+    available offline; token counts then fall back to a character-based estimate.
+    """
+    global _encoding, _encoding_loaded
+    with _encoding_lock:
+        if not _encoding_loaded:
+            try:
+                _encoding = tiktoken.get_encoding("cl100k_base")
+            except Exception as e:
+                print(f"Warning: Could not load the tiktoken encoding ({e}), estimating token counts from characters")
+            _encoding_loaded = True
+    return _encoding
+
+
+def count_tokens(text):
+    """Count the tokens of a text with the tiktoken tokenizer used for the prompt budget."""
+    encoding = get_encoding()
+    if encoding is None:
+        return -(-len(text) // CHARS_PER_TOKEN)
+    return len(encoding.encode(text))
+
+
+def truncate_tokens(text, max_tokens):
+    """Cut a text to at most `max_tokens` tokens."""
+    encoding = get_encoding()
+    if encoding is None:
+        return text[:max_tokens * CHARS_PER_TOKEN]
+    return encoding.decode(encoding.encode(text)[:max_tokens])
+
+
+# Stats of the last synthesis per synthesizer (by id), per context (thread or task), so that a synthesizer
+# shared by concurrent queries reports each query's own stats. One module-level variable, since context
+# variables are never garbage-collected.
+_synthesis_stats = contextvars.ContextVar("synthesis_stats", default={})
+
+
+class PackedSynthesizer(BaseSynthesizer):
+    """
+    Response synthesizer that packs the retrieved nodes into as few prompts as fit the LLM context window.
+
+    The nodes are packed, in retrieval order, into the summary prompt up to a tiktoken-measured budget.
+    Usually this is a single LLM call; only when the budget overflows are the remaining nodes
+    packed into the minimal number of refine steps.
+    """
+
+    def __init__(self, llm, text_qa_template, refine_template, context_window=llm_context_window, num_output=llm_num_output, streaming=False):
+        super().__init__(llm=llm, streaming=streaming)
+        self._text_qa_template = text_qa_template
+        self._refine_template = refine_template
+        self._context_window = context_window
+        self._num_output = num_output
+
+    @property
+    def last_stats(self):
+        """Stats of the last response synthesized in the current thread or task."""
+        return _synthesis_stats.get().get(id(self), {})
+
+    @last_stats.setter
+    def last_stats(self, stats):
+        # Copy on write: the mapping is shared with the contexts copied from this one
+        _synthesis_stats.set({**_synthesis_stats.get(), id(self): stats})
+
+    def _get_prompts(self):
+        return {"text_qa_template": self._text_qa_template, "refine_template": self._refine_template}
+
+    def _update_prompts(self, prompts):
+        if "text_qa_template" in prompts:
+            self._text_qa_template = prompts["text_qa_template"]
+        if "refine_template" in prompts:
+            self._refine_template = prompts["refine_template"]
+
+    def pack(self, query_str, text_chunks):
+        """
+        Pack text chunks into prompt contexts within the token budget.
+
+        Args:
+        - query_str (str): The query.
+        - text_chunks (list[str]): The retrieved node texts, in retrieval order.
+
+        Returns:
+        - list[str]: The context of the first (summary) prompt followed by those of the refine prompts.
+        """
+        qa_overhead = count_tokens(self._text_qa_template.format(context_str="", query_str=query_str))
+        # The existing answer in a refine prompt is at most `num_output` tokens long
+        refine_overhead = count_tokens(
+            self._refine_template.format(context_msg="", query_str=query_str, existing_answer="")
+        ) + self._num_output
+
+        packs, current, used = [], [], 0
+        budget = self._context_window - self._num_output - qa_overhead
+        refine_budget = self._context_window - self._num_output - refine_overhead
+        if budget <= 0:
+            raise ValueError(self._no_room_message("summary"))
+        for chunk in text_chunks:
+            tokens = count_tokens(chunk)
+            if tokens > budget:
+                # A single chunk larger than the whole budget is truncated
+                chunk = truncate_tokens(chunk, budget)
+                tokens = count_tokens(chunk)
+            if current and used + tokens + 1 > budget:
+                if refine_budget <= 0:
+                    raise ValueError(self._no_room_message("refine"))
+                packs.append("\n".join(current))
+                current, used = [], 0
+                budget = refine_budget
+            current.append(chunk)
+            used += tokens + 1
+        if current:
+            packs.append("\n".join(current))
+        return packs
+
+    def _no_room_message(self, prompt_name):
+        return (f"The {prompt_name} prompt and {self._num_output} output tokens leave no room for context "
+                f"in the {self._context_window}-token context window.")
+
+    def _build_prompt(self, query_str, context, existing_answer):
+        if existing_answer is None:
+            return self._text_qa_template.format(context_str=context, query_str=query_str)
+        return self._refine_template.format(context_msg=context, query_str=query_str, existing_answer=existing_answer)
+
+    def _stream(self, prompt):
+        for chunk in self._llm.stream_complete(prompt):
+            yield chunk.delta or ""
+
+    async def _astream(self, prompt):
+        async for chunk in await self._llm.astream_complete(prompt):
+            yield chunk.delta or ""
+
+    def get_response(self, query_str, text_chunks, **response_kwargs):
+        packs = self.pack(query_str, text_chunks)
+        answer, prompt_tokens = None, 0
+        for i, context in enumerate(packs):
+            prompt = self._build_prompt(query_str, context, answer)
+            prompt_tokens += count_tokens(prompt)
+            if self._streaming and i == len(packs) - 1:
+                # Only the final step is streamed, earlier refine steps are needed in full
+                self.last_stats = {"mode": "packed", "estimated": False, "llm_calls": len(packs), "prompt_tokens": prompt_tokens}
+                return self._stream(prompt)
+            answer = self._llm.complete(prompt).text.strip()
+        self.last_stats = {"mode": "packed", "estimated": False, "llm_calls": len(packs), "prompt_tokens": prompt_tokens}
+        return answer or "Empty Response"
+
+    async def aget_response(self, query_str, text_chunks, **response_kwargs):
+        packs = self.pack(query_str, text_chunks)
+        answer, prompt_tokens = None, 0
+        for i, context in enumerate(packs):
+            prompt = self._build_prompt(query_str, context, answer)
+            prompt_tokens += count_tokens(prompt)
+            if self._streaming and i == len(packs) - 1:
+                self.last_stats = {"mode": "packed", "estimated": False, "llm_calls": len(packs), "prompt_tokens": prompt_tokens}
+                return self._astream(prompt)
+            answer = (await self._llm.acomplete(prompt)).text.strip()
+        self.last_stats = {"mode": "packed", "estimated": False, "llm_calls": len(packs), "prompt_tokens": prompt_tokens}
+        return answer or "Empty Response"
+
+
+def create_response_synthesizer(llm, mode=synthesis_mode, streaming=False):
     """Create a response synthesizer based on the given LLaMA model and response type.
     
     Args:
     - llm: The llm model to be used for response synthesis.
+    - mode: "refine" (one LLM call per retrieved node) or "packed" (token-budgeted, usually a single call).
+    - streaming: Stream the tokens of the final LLM call (the query engine then returns a StreamingResponse).
 
     Returns:
     - A response synthesizer object.
     """
     summary_tmpl = PromptTemplate(summary_prompt)
 
+    if mode == "packed":
+        return PackedSynthesizer(llm, summary_tmpl, PromptTemplate(refine_prompt), streaming=streaming)
+    elif mode != "refine":
+        raise ValueError("Invalid synthesis mode. Choose from: 'refine', 'packed'.")
+
     response_synthesizer = get_response_synthesizer(
-        response_mode=ResponseMode.REFINE, llm=llm, text_qa_template=summary_tmpl, simple_template=summary_tmpl, refine_template=summary_tmpl
+        response_mode=ResponseMode.REFINE, llm=llm, text_qa_template=summary_tmpl, simple_template=summary_tmpl, refine_template=summary_tmpl,
+        streaming=streaming
     )
     return response_synthesizer
 
+def get_synthesis_stats(response_synthesizer, query_str, source_nodes):
+    """Report the number of LLM calls and prompt tokens used to synthesize a response.
+
+    Args:
+    - response_synthesizer: The synthesizer that produced the response.
+    - query_str: The query text.
+    - source_nodes: The retrieved nodes passed to the synthesizer.
+
+    Returns:
+    - A dictionary with the synthesis mode, the number of LLM calls and the prompt token count. The
+      refine stats are estimated from the retrieved nodes rather than measured (`estimated` is True).
+    """
+    if isinstance(response_synthesizer, PackedSynthesizer):
+        return dict(response_synthesizer.last_stats)
+
+    # REFINE formats the summary prompt once per retrieved node
+    prompts = [
+        summary_prompt.format(context_str=node.node.get_content(metadata_mode=MetadataMode.LLM), query_str=query_str)
+        for node in source_nodes
+    ]
+    return {"mode": "refine", "estimated": True, "llm_calls": len(prompts), "prompt_tokens": sum(count_tokens(prompt) for prompt in prompts)}
+
 def build_query_engine(retriever, response_synthesizer):
     """Build a query engine based on the given retriever and response synthesizer.
     
@@ -1,18 +1,305 @@
 import Stemmer
+import contextvars
+import numpy as np
 from llama_index.retrievers.bm25 import BM25Retriever
-from llama_index.core.retrievers import VectorIndexRetriever, AutoMergingRetriever
+from llama_index.core.retrievers import VectorIndexRetriever, AutoMergingRetriever, BaseRetriever
+from llama_index.core.schema import NodeWithScore, MetadataMode
+from config import (
+    hybrid_dense_weight, hybrid_fusion, multi_query_top_k,
+    prune_score_gap, prune_min_score, prune_duplicate_threshold, prune_token_budget, prune_min_nodes,
+)
+from embedding_cache import embed_texts, embed_queries, aembed_queries, attach_embeddings
+from response_generator import count_tokens
+from tracing import record
+
+
+def _fusion_key(node_with_score):
+    # Dense results may come from a reused vector store whose node ids differ from the BM25 nodes,
+    # so nodes are matched on their note key and text instead of their id
+    node = node_with_score.node
+    return (node.metadata.get("key"), node.get_content())
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    Scores the same node set with the dense and the BM25 retriever and fuses both rankings.
+
+    Fusion is computed on arrays: "rrf" is weighted reciprocal-rank fusion, "score" is a weighted sum of
+    min-max normalized scores. Nodes missing from one ranking get no contribution from it.
+    """
+
+    def __init__(self, dense_retriever, bm25_retriever, top_k=5, dense_weight=0.5, fusion="rrf", rrf_k=60):
+        super().__init__()
+        self._dense_retriever = dense_retriever
+        self._bm25_retriever = bm25_retriever
+        self._top_k = top_k
+        self._weights = np.array([dense_weight, 1.0 - dense_weight], dtype=np.float32)
+        self._fusion = fusion
+        self._rrf_k = rrf_k
+
+    def _fuse(self, rankings):
+        keys, nodes = {}, []
+        for ranking in rankings:
+            for node in ranking:
+                key = _fusion_key(node)
+                if key not in keys:
+                    keys[key] = len(nodes)
+                    nodes.append(node.node)
+
+        # contributions[i, j]: contribution of ranking i to candidate j
+        contributions = np.zeros((len(rankings), len(nodes)), dtype=np.float32)
+        for i, ranking in enumerate(rankings):
+            if not ranking:
+                continue
+            positions = np.array([keys[_fusion_key(node)] for node in ranking])
+            if self._fusion == "rrf":
+                contributions[i, positions] = 1.0 / (self._rrf_k + np.arange(1, len(ranking) + 1))
+            else:
+                scores = np.array([node.score or 0.0 for node in ranking], dtype=np.float32)
+                spread = scores.max() - scores.min()
+                contributions[i, positions] = (scores - scores.min()) / spread if spread > 0 else 1.0
+
+        fused = self._weights[: len(rankings)] @ contributions
+        k = min(self._top_k, len(nodes))
+        if k == 0:
+            return []
+        top = np.argpartition(-fused, k - 1)[:k]
+        top = top[np.argsort(-fused[top])]
+        return [NodeWithScore(node=nodes[i], score=float(fused[i])) for i in top]
+
+    def _retrieve(self, query_bundle):
+        return self._fuse([self._dense_retriever.retrieve(query_bundle), self._bm25_retriever.retrieve(query_bundle)])
+
+    async def _aretrieve(self, query_bundle):
+        dense = await self._dense_retriever.aretrieve(query_bundle)
+        return self._fuse([dense, self._bm25_retriever.retrieve(query_bundle)])
+
+
+# Stats of the last retrieval per retriever (by id), per context (thread or task), so that a retriever
+# shared by concurrent queries reports each query's own stats. One module-level variable, since context
+# variables are never garbage-collected.
+_retriever_stats = contextvars.ContextVar("retriever_stats", default={})
+
+
+def _last_retriever_stats(retriever):
+    return _retriever_stats.get().get(id(retriever), {})
+
+
+def _set_retriever_stats(retriever, stats):
+    # Copy on write: the mapping is shared with the contexts copied from this one
+    _retriever_stats.set({**_retriever_stats.get(), id(retriever): stats})
+
+
+class MultiQueryRetriever(BaseRetriever):
+    """
+    Dense retrieval of several sub-questions at once instead of one concatenated query.
+
+    The sub-questions are the `custom_embedding_strs` of the query bundle (the query string alone if
+    there are none). They are embedded in one batch (`embed_queries`, bypassing the embedding cache
+    since they are patient text) and scored against
+    the node embeddings with one matrix product; the top `per_question_top_k` nodes of every sub-question are merged, deduplicated
+    on their note key and text, and the best `top_k` by their highest similarity are returned. The
+    sub-questions each node was retrieved for (as indices into the sub-questions, by note key) are
+    available as `last_stats["attribution"]`.
+    """
+
+    def __init__(self, nodes, embed_model, top_k=5, per_question_top_k=multi_query_top_k):
+        super().__init__()
+        self._nodes = nodes
+        self._embed_model = embed_model
+        self._top_k = top_k
+        self._per_question_top_k = per_question_top_k
+        attach_embeddings(nodes, embed_model)
+        self._keys = [_fusion_key(NodeWithScore(node=node)) for node in nodes]
+        self._matrix = self._normalize(np.asarray([node.embedding for node in nodes], dtype=np.float32)) if nodes else None
+
+    @staticmethod
+    def _normalize(matrix):
+        return matrix / np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+
+    @property
+    def last_stats(self):
+        return _last_retriever_stats(self)
+
+    def _merge(self, questions, embeddings):
+        if not self._nodes or not questions:
+            _set_retriever_stats(self, {"questions": len(questions), "question_hits": 0, "attribution": {}})
+            return []
+
+        # similarity[i, j]: cosine similarity of sub-question i and node j
+        similarity = self._normalize(np.asarray(embeddings, dtype=np.float32)) @ self._matrix.T
+        k = min(self._per_question_top_k, len(self._nodes))
+        hits = np.argpartition(-similarity, k - 1, axis=1)[:, :k]
+
+        best, attribution = {}, {}
+        for i, row in enumerate(hits):
+            for j in row:
+                key = self._keys[j]
+                score = float(similarity[i, j])
+                if key not in best or score > best[key][1]:
+                    best[key] = (j, score)
+                questions_of_node = attribution.setdefault(key, [])
+                if i not in questions_of_node:
+                    questions_of_node.append(i)
+
+        ranked = sorted(best.items(), key=lambda item: -item[1][1])[: self._top_k]
+        _set_retriever_stats(self, {
+            "questions": len(questions),
+            "question_hits": int(hits.size),
+            "attribution": {str(self._nodes[j].metadata.get("key")): attribution[key] for key, (j, _) in ranked},
+        })
+        return [NodeWithScore(node=self._nodes[j], score=score) for _, (j, score) in ranked]
+
+    def _retrieve(self, query_bundle):
+        questions = [q for q in query_bundle.embedding_strs if q.strip()]
+        return self._merge(questions, embed_queries(self._embed_model, questions))
+
+    async def _aretrieve(self, query_bundle):
+        questions = [q for q in query_bundle.embedding_strs if q.strip()]
+        return self._merge(questions, await aembed_queries(self._embed_model, questions))
+
+
+def get_multi_query_stats(retriever):
+    """
+    Return the sub-question count and per-node attribution of the last retrieval of a
+    MultiQueryRetriever, also when wrapped by a PruningRetriever ({} for other retrievers).
+    """
+    if isinstance(retriever, PruningRetriever):
+        retriever = retriever._retriever
+    if not isinstance(retriever, MultiQueryRetriever):
+        return {}
+    stats = retriever.last_stats
+    return {"questions": stats.get("questions", 0), "question_hits": stats.get("question_hits", 0), "attribution": dict(stats.get("attribution", {}))}
+
+
+def prune_nodes(results, embed_model=None, score_gap=prune_score_gap, min_score=prune_min_score,
+                duplicate_threshold=prune_duplicate_threshold, token_budget=prune_token_budget, min_nodes=prune_min_nodes):
+    """
+    Select the context passed to synthesis from a ranked retrieval result.
+
+    The ranking is cut at the first score drop larger than `score_gap` times the top score, or at the
+    first score below `min_score`. Near-duplicate sentences (cosine similarity of their embeddings at
+    least `duplicate_threshold` with a higher ranked kept sentence) are dropped, and the remaining
+    ones are kept in rank order up to `token_budget` tokens.
+
+    Args:
+    - results (list[NodeWithScore]): The retrieved nodes, best first.
+    - embed_model (optional): Used to embed nodes without an embedding (through the embedding cache).
+      Without it, only nodes with an embedding are deduplicated.
+    - min_nodes (int): Number of top nodes that are never pruned by the score cut or the budget.
+
+    Returns:
+    - tuple: The kept nodes and the number of nodes pruned by each stage.
+    """
+    stats = {"retrieved": len(results), "pruned_score": 0, "pruned_duplicate": 0, "pruned_budget": 0}
+    if not results:
+        return results, {**stats, "kept": 0}
+
+    # Score cut
+    scores = np.array([r.score or 0.0 for r in results], dtype=np.float32)
+    order = np.argsort(-scores, kind="stable")
+    results, scores = [results[i] for i in order], scores[order]
+    cut = len(results)
+    if score_gap is not None and scores[0] > 0:
+        gaps = np.flatnonzero((scores[:-1] - scores[1:]) > score_gap * scores[0])
+        if gaps.size:
+            cut = int(gaps[0]) + 1
+    if min_score is not None:
+        cut = min(cut, int(np.sum(scores >= min_score)))
+    cut = max(cut, min(min_nodes, len(results)))
+    stats["pruned_score"] = len(results) - cut
+    results = results[:cut]
+
+    # Near-duplicate removal on the embeddings, greedy in rank order
+    if duplicate_threshold is not None and len(results) > 1:
+        embeddings = [r.node.embedding for r in results]
+        missing = [i for i, e in enumerate(embeddings) if e is None]
+        if missing and embed_model is not None:
+            texts = [results[i].node.get_content(metadata_mode=MetadataMode.EMBED) for i in missing]
+            for i, embedding in zip(missing, embed_texts(embed_model, texts)):
+                embeddings[i] = embedding
+        rows = [i for i, e in enumerate(embeddings) if e is not None]
+        if len(rows) > 1:
+            matrix = np.asarray([embeddings[i] for i in rows], dtype=np.float32)
+            matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+            similarity = matrix @ matrix.T
+            keep = np.ones(len(rows), dtype=bool)
+            for i in range(len(rows)):
+                if keep[i]:
+                    keep[i + 1:] &= similarity[i, i + 1:] < duplicate_threshold
+            dropped = {rows[i] for i in np.flatnonzero(~keep)}
+            stats["pruned_duplicate"] = len(dropped)
+            results = [r for i, r in enumerate(results) if i not in dropped]
+
+    # Token budget
+    if token_budget is not None:
+        tokens = np.cumsum([count_tokens(r.node.get_content(metadata_mode=MetadataMode.LLM)) for r in results])
+        keep = max(int(np.sum(tokens <= token_budget)), min(min_nodes, len(results)))
+        stats["pruned_budget"] = len(results) - keep
+        results = results[:keep]
+
+    stats["kept"] = len(results)
+    return results, stats
+
+
+# Retriever types whose scores are cosine similarities. The score cut of `prune_nodes` is only
+# meaningful on those: BM25 scores are unbounded and RRF scores are around 1/60.
+COSINE_SCORE_RETRIEVERS = {"base", "auto_merger", "multi_query"}
+
+
+class PruningRetriever(BaseRetriever):
+    """
+    Wraps a retriever with the adaptive context selection of `prune_nodes`.
+
+    The retriever's `top_k` is the upper bound of the context; the pruning stats of the last retrieval
+    in the current thread or task are available as `last_stats`. For retriever types whose scores are
+    not cosine similarities, the score cut is disabled and only duplicates and the token budget prune.
+    """
+
+    def __init__(self, retriever, embed_model=None, retriever_type="base", **prune_kwargs):
+        super().__init__()
+        self._retriever = retriever
+        self._embed_model = embed_model
+        if retriever_type not in COSINE_SCORE_RETRIEVERS:
+            prune_kwargs = {**prune_kwargs, "score_gap": None, "min_score": None}
+        self._prune_kwargs = prune_kwargs
+
+    @property
+    def last_stats(self):
+        return _last_retriever_stats(self)
+
+    def _prune(self, results):
+        results, stats = prune_nodes(results, self._embed_model, **self._prune_kwargs)
+        _set_retriever_stats(self, stats)
+        record(nodes_pruned=stats["retrieved"] - stats["kept"])
+        return results
+
+    def _retrieve(self, query_bundle):
+        return self._prune(self._retriever.retrieve(query_bundle))
+
+    async def _aretrieve(self, query_bundle):
+        return self._prune(await self._retriever.aretrieve(query_bundle))
+
+
+def get_pruning_stats(retriever):
+    """
+    Return the pruning stats of the last retrieval of a PruningRetriever ({} for other retrievers).
+    """
+    return dict(retriever.last_stats) if isinstance(retriever, PruningRetriever) else {}
 
 
 # Function to build a retriever for a specific case
-def build_retriever(index, nodes, retriever_type, top_k=5):
+def build_retriever(index, nodes, retriever_type, top_k=5, embed_model=None):
     """
     Build a retriever for a specific retriever type.
 
     Args:
     - index (VectorStoreIndex): The VectorStoreIndex instance of the documents or nodes.
     - nodes (list): The list of nodes to use for the retriever.
-    - retriever_type (str): The type of retriever to use -- base, bm25, or auto_merger.
+    - retriever_type (str): The type of retriever to use -- base, bm25, auto_merger, hybrid (BM25 + dense)
+      or multi_query (one dense retrieval per sub-question, merged).
     - top_k (int, optional): The number of top results to return. Defaults to 5.
+    - embed_model (optional): The embedding model, required by the multi_query retriever.
 
     Returns:
     - retriever (Retriever): The built retriever of the specific type.
@@ -32,8 +319,24 @@ def build_retriever(index, nodes, retriever_type, top_k=5):
             language="english",
         )
 
+    elif retriever_type == "hybrid":
+        # Both retrievers rank every node, the fusion picks the top_k
+        dense_retriever = index.as_retriever(similarity_top_k=len(nodes))
+        bm25_retriever = BM25Retriever.from_defaults(
+            nodes=nodes,
+            similarity_top_k=len(nodes),
+            stemmer= Stemmer.Stemmer("english"),
+            language="english",
+        )
+        return HybridRetriever(dense_retriever, bm25_retriever, top_k=top_k, dense_weight=hybrid_dense_weight, fusion=hybrid_fusion)
+
+    elif retriever_type == "multi_query":
+        if embed_model is None:
+            raise ValueError("The multi_query retriever needs an embed_model.")
+        return MultiQueryRetriever(nodes, embed_model, top_k=top_k)
+
     else:
-        raise ValueError("Invalid retriever_type. Choose from: 'base', 'auto_merger', 'bm25'.")
+        raise ValueError("Invalid retriever_type. Choose from: 'base', 'auto_merger', 'bm25', 'hybrid', 'multi_query'.")
 
 
 # Function to retrieve nodes for a specific case
@@ -0,0 +1,211 @@
+import re
+import sys
+import json
+import time
+import random
+import asyncio
+import hashlib
+import argparse
+import itertools
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from llama_index.core.llms import CustomLLM, CompletionResponse, LLMMetadata
+from llama_index.core.llms.callbacks import llm_completion_callback
+from llama_index.core.bridge.pydantic import Field, PrivateAttr
+from config import llm_context_window, llm_num_output
+
+_WORDS = (
+    "the patient notes indicate treatment was adjusted and follow up is recommended to review "
+    "symptoms medication response blood pressure and any side effects with the care team"
+).split()
+
+# Markers of the single-case and batched relevance prompts of `question_relevance.py`
+RELEVANCE_MARKER = 'Just say "Yes" or "No"'
+BATCH_RELEVANCE_MARKER = "mapping every case number to"
+_BATCH_CASE = re.compile(r"^## Case (\d+)\n(.*?)(?=^## Case \d+\n|^# Output Format)", re.MULTILINE | re.DOTALL)
+
+
+class SimulatedLLM(CustomLLM):
+    """
+    Deterministic local stand-in for the Ollama and OpenRouter LLMs, for offline load tests.
+
+    Each call waits a first-token latency and then emits tokens at a token rate, both drawn from
+    log-normal distributions. The answer is seeded by the prompt; the latency, errors and stalls are
+    seeded by the prompt and the call number, so repeats of a prompt get independent timings while
+    the same sequence of calls still produces the same timings and answers on every run. Relevance
+    prompts are answered "Yes" or "No"; batched relevance prompts get a JSON object with one verdict
+    per case, each seeded by its case section.
+
+    Args:
+    - first_token_latency (float): Median seconds before the first token.
+    - tokens_per_second (float): Median generation speed.
+    - latency_sigma (float): Log-normal spread of the latency and token rate (0 = constant).
+    - num_tokens (int): Tokens per generated answer.
+    - relevant_ratio (float): Share of relevance prompts answered "Yes".
+    - error_rate (float): Share of calls that raise, to exercise the error handling.
+    - stall_rate (float): Share of calls that hang for `stall_seconds` before answering, like a stuck
+      LLM call. A retried or hedged call is a new call, so it may not stall.
+    - seed (int): Seed mixed into every random generator.
+    """
+
+    first_token_latency: float = Field(default=0.5)
+    tokens_per_second: float = Field(default=30.0)
+    latency_sigma: float = Field(default=0.25)
+    num_tokens: int = Field(default=120)
+    relevant_ratio: float = Field(default=0.9)
+    error_rate: float = Field(default=0.0)
+    stall_rate: float = Field(default=0.0)
+    stall_seconds: float = Field(default=60.0)
+    seed: int = Field(default=0)
+    context_window: int = Field(default=llm_context_window)
+    num_output: int = Field(default=llm_num_output)
+
+    _calls = PrivateAttr(default_factory=itertools.count)
+    _calls_lock = PrivateAttr(default_factory=threading.Lock)
+
+    @classmethod
+    def class_name(cls):
+        return "SimulatedLLM"
+
+    @property
+    def metadata(self):
+        return LLMMetadata(context_window=self.context_window, num_output=self.num_output, model_name="simulated")
+
+    def _rng(self, *parts):
+        digest = hashlib.sha256("\x00".join(str(part) for part in (self.seed, *parts)).encode("utf-8")).digest()
+        return random.Random(int.from_bytes(digest[:8], "big"))
+
+    def _plan(self, prompt):
+        # The answer depends on the prompt only; the timing and failures of a call also on its number,
+        # so that a prompt replayed many times gets a distribution of latencies and errors
+        with self._calls_lock:
+            call = next(self._calls)
+        rng = self._rng("call", call, prompt)
+        if rng.random() < self.error_rate:
+            raise RuntimeError("Simulated LLM failure")
+        first_token = self.first_token_latency * rng.lognormvariate(0, self.latency_sigma)
+        if self.stall_rate and rng.random() < self.stall_rate:
+            first_token += self.stall_seconds
+        token_delay = 1 / (self.tokens_per_second * rng.lognormvariate(0, self.latency_sigma))
+
+        answer_rng = self._rng("answer", prompt)
+        if BATCH_RELEVANCE_MARKER in prompt:
+            verdicts = [
+                f'"{number}": "{"Yes" if self._rng("answer", case).random() < self.relevant_ratio else "No"}"'
+                for number, case in _BATCH_CASE.findall(prompt)
+            ]
+            tokens = ["{", *[(", " if i else "") + verdict for i, verdict in enumerate(verdicts)], "}"]
+        elif RELEVANCE_MARKER in prompt:
+            tokens = ["Yes" if answer_rng.random() < self.relevant_ratio else "No"]
+        else:
+            tokens = [(" " if i else "") + answer_rng.choice(_WORDS) for i in range(self.num_tokens)]
+        return first_token, token_delay, tokens
+
+    @llm_completion_callback()
+    def complete(self, prompt, formatted=False, **kwargs):
+        first_token, token_delay, tokens = self._plan(prompt)
+        time.sleep(first_token + token_delay * len(tokens))
+        return CompletionResponse(text="".join(tokens))
+
+    @llm_completion_callback()
+    def stream_complete(self, prompt, formatted=False, **kwargs):
+        first_token, token_delay, tokens = self._plan(prompt)
+
+        def gen():
+            time.sleep(first_token)
+            text = ""
+            for token in tokens:
+                time.sleep(token_delay)
+                text += token
+                yield CompletionResponse(text=text, delta=token)
+        return gen()
+
+    @llm_completion_callback()
+    async def acomplete(self, prompt, formatted=False, **kwargs):
+        first_token, token_delay, tokens = self._plan(prompt)
+        await asyncio.sleep(first_token + token_delay * len(tokens))
+        return CompletionResponse(text="".join(tokens))
+
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    """Serves the Ollama generate API and the OpenAI-compatible chat completions API from a SimulatedLLM."""
+
+    llm = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if self.path.endswith("/api/generate"):
+            prompt, chat = request.get("prompt", ""), False
+        elif self.path.endswith("/chat/completions"):
+            prompt, chat = "\n".join(m.get("content", "") for m in request.get("messages", [])), True
+        else:
+            return self._send_json(404, {"error": "not found"})
+
+        try:
+            if not request.get("stream"):
+                text = self.llm.complete(prompt).text
+                data = {"choices": [{"message": {"role": "assistant", "content": text}}]} if chat else {"response": text, "done": True}
+                return self._send_json(200, data)
+            stream = self.llm.stream_complete(prompt)
+            first = next(stream, None)
+        except RuntimeError as e:
+            return self._send_json(503, {"error": str(e)})
+
+        # Streamed as newline-delimited JSON (Ollama) or server-sent events (OpenAI)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream" if chat else "application/x-ndjson")
+        self.end_headers()
+        for chunk in itertools.chain([first] if first else [], stream):
+            if chat:
+                line = "data: " + json.dumps({"choices": [{"delta": {"content": chunk.delta}}]}) + "\n\n"
+            else:
+                line = json.dumps({"response": chunk.delta, "done": False}) + "\n"
+            self.wfile.write(line.encode("utf-8"))
+            self.wfile.flush()
+        self.wfile.write(b"data: [DONE]\n\n" if chat else (json.dumps({"response": "", "done": True}) + "\n").encode("utf-8"))
+
+
+def serve(llm, host="127.0.0.1", port=11434):
+    """
+    Serve a SimulatedLLM over HTTP as a local stand-in for the Ollama and OpenRouter servers.
+
+    Point `ollama_base_url` at "http://host:port" and `openrouter_base_url` at "http://host:port/v1"
+    to run the LLM gateway (retries, hedging, fallback) against it.
+    """
+    handler = type("StandInHandler", (_StandInHandler,), {"llm": llm})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a simulated LLM over the Ollama and OpenAI-compatible HTTP APIs.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11434)
+    parser.add_argument("--first-token-latency", type=float, default=0.5)
+    parser.add_argument("--tokens-per-second", type=float, default=30.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--stall-rate", type=float, default=0.0)
+    parser.add_argument("--stall-seconds", type=float, default=60.0)
+    args = parser.parse_args(sys.argv[1:])
+
+    llm = SimulatedLLM(
+        first_token_latency=args.first_token_latency,
+        tokens_per_second=args.tokens_per_second,
+        error_rate=args.error_rate,
+        stall_rate=args.stall_rate,
+        stall_seconds=args.stall_seconds,
+    )
+    print(f"Simulated LLM listening on http://{args.host}:{args.port}")
+    serve(llm, args.host, args.port).serve_forever()
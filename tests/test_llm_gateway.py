@@ -0,0 +1,143 @@
+import time
+import asyncio
+import threading
+import pytest
+
+httpx = pytest.importorskip("httpx")
+pytest.importorskip("llama_index.core")
+
+from llama_index.core.bridge.pydantic import Field, PrivateAttr
+import llm_gateway
+from llm_gateway import LLMGateway, OllamaBackend, OpenAICompatibleBackend
+from simulated_llm import SimulatedLLM, serve
+from tracing import request_trace
+
+
+class ScriptedLLM(SimulatedLLM):
+    """A SimulatedLLM whose first `failures` calls fail and whose call n takes `latencies[n]` seconds."""
+
+    failures: int = Field(default=0)
+    latencies: list = Field(default_factory=list)
+
+    _received = PrivateAttr(default_factory=list)
+
+    def _plan(self, prompt):
+        with self._calls_lock:
+            call = next(self._calls)
+            self._received.append(time.perf_counter())
+        if call < self.failures:
+            raise RuntimeError("Scripted failure")
+        first_token = self.latencies[call] if call < len(self.latencies) else 0.0
+        return first_token, 0.0, ["answer", f" {call}"]
+
+    @property
+    def received(self):
+        return list(self._received)
+
+
+@pytest.fixture
+def stand_in():
+    servers = []
+
+    def start(**kwargs):
+        llm = ScriptedLLM(**kwargs)
+        server = serve(llm, port=0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return llm, f"http://127.0.0.1:{server.server_address[1]}"
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(llm_gateway, "_backoff", lambda attempt: 0.0)
+
+
+def test_retries_retryable_errors(stand_in):
+    llm, url = stand_in(failures=2)
+    gateway = LLMGateway([OllamaBackend("ollama", url, "m")], max_retries=2, hedging=False)
+    with request_trace("test") as trace:
+        assert gateway.complete("question").text == "answer 2"
+    assert len(llm.received) == 3
+    assert trace.counters["llm_retries"] == 2
+
+
+def test_falls_back_to_the_next_backend(stand_in):
+    failing, failing_url = stand_in(failures=100)
+    fallback, fallback_url = stand_in()
+    gateway = LLMGateway([
+        OpenAICompatibleBackend("openrouter", failing_url + "/v1", "m"),
+        OllamaBackend("ollama", fallback_url, "m"),
+    ], max_retries=1, hedging=False)
+    with request_trace("test") as trace:
+        assert gateway.complete("question").text == "answer 0"
+    assert len(failing.received) == 2
+    assert len(fallback.received) == 1
+    assert trace.counters["llm_fallbacks"] == 1
+
+
+def test_read_timeouts_are_not_retried(stand_in):
+    slow, slow_url = stand_in(latencies=[1.0])
+    fallback, fallback_url = stand_in()
+    gateway = LLMGateway([
+        OllamaBackend("ollama", slow_url, "m", timeout=0.2),
+        OllamaBackend("ollama", fallback_url, "m"),
+    ], max_retries=2, hedging=False)
+    start = time.perf_counter()
+    assert gateway.complete("question").text == "answer 0"
+    assert time.perf_counter() - start < 1.0
+    assert len(slow.received) == 1
+
+
+def test_no_hedge_before_the_delay(stand_in):
+    llm, url = stand_in()
+    gateway = LLMGateway([OllamaBackend("ollama", url, "m")], hedging=True, hedge_delay=0.5)
+    with request_trace("test") as trace:
+        assert gateway.complete("question").text == "answer 0"
+    time.sleep(0.6)
+    assert len(llm.received) == 1
+    assert "llm_hedged" not in trace.counters
+
+
+def test_hedge_after_the_delay_and_cancel_the_loser(stand_in):
+    llm, url = stand_in(latencies=[2.0, 0.0])
+    backend = OllamaBackend("ollama", url, "m", max_concurrency=2)
+    gateway = LLMGateway([backend], hedging=True, hedge_delay=0.3)
+    start = time.perf_counter()
+    with request_trace("test") as trace:
+        assert gateway.complete("question").text == "answer 1"
+    assert time.perf_counter() - start < 1.5
+    first, second = llm.received
+    assert second - first >= 0.3
+    assert trace.counters["llm_hedged"] == 1
+    # The stalled first call no longer holds its concurrency slot
+    assert backend._slots.acquire(blocking=False)
+    assert backend._slots.acquire(blocking=False)
+
+
+def test_async_stream_with_fallback(stand_in):
+    failing, failing_url = stand_in(failures=100)
+    fallback, fallback_url = stand_in()
+    backends = [OllamaBackend("ollama", failing_url, "m"), OllamaBackend("ollama", fallback_url, "m")]
+    gateway = LLMGateway(backends, max_retries=0, hedging=False)
+
+    async def run():
+        try:
+            return [chunk.delta async for chunk in await gateway.astream_complete("question")]
+        finally:
+            for backend in backends:
+                await backend.aclose()
+
+    assert "".join(asyncio.run(run())) == "answer 0"
+    assert len(failing.received) == 1
+
+
+def test_ollama_payload_sets_the_context_window():
+    backend = OllamaBackend("ollama", "http://127.0.0.1:1", "m", context_window=4096, num_output=256)
+    options = backend._payload("question", stream=False)["options"]
+    assert options["num_ctx"] == 4096
+    assert options["num_predict"] == 256
@@ -0,0 +1,237 @@
+import json
+import math
+import time
+import uuid
+import asyncio
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from config import quiet_mode, trace_export_path
+
+# Tracing of the EHR workflow: one trace per request, with a span per graph node and per embedding/LLM
+# call inside it. Counters (tokens, LLM calls, nodes embedded, cache hits) are attached to the innermost
+# span. Finished traces are exported as JSON lines and aggregated into latency histograms.
+
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+_current_span = contextvars.ContextVar("current_span", default=None)
+_quiet = quiet_mode
+_export_path = trace_export_path
+_export_lock = threading.Lock()
+_latencies = {}
+_latencies_lock = threading.Lock()
+MAX_SAMPLES = 10000
+
+
+def set_quiet(quiet=True):
+    """Switch the Rich step/agent output of the workflow off (quiet) or on."""
+    global _quiet
+    _quiet = quiet
+
+
+def is_quiet():
+    return _quiet
+
+
+def set_export_path(path):
+    """Set the JSON lines file finished traces are appended to (None disables the export)."""
+    global _export_path
+    _export_path = path
+
+
+def percentile(values, q):
+    """
+    Nearest-rank percentile of a list of values.
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, math.ceil(q / 100 * len(ordered)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+class Span:
+    def __init__(self, name, parent, attributes):
+        self.name = name
+        self.parent = parent
+        self.attributes = dict(attributes)
+        self.counters = {}
+        self.start = time.perf_counter()
+        self.duration = None
+
+    def to_dict(self, trace_start):
+        return {
+            "name": self.name,
+            "parent": self.parent.name if self.parent else None,
+            "start": self.start - trace_start,
+            "duration": self.duration,
+            "attributes": self.attributes,
+            "counters": self.counters,
+        }
+
+
+class Trace:
+    def __init__(self, name, attributes):
+        self.trace_id = uuid.uuid4().hex
+        self.name = name
+        self.attributes = dict(attributes)
+        self.timestamp = time.time()
+        self.start = time.perf_counter()
+        self.duration = None
+        self.spans = []
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def add_span(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    def add_counters(self, counters):
+        with self._lock:
+            for key, value in counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "timestamp": self.timestamp,
+            "duration": self.duration,
+            "attributes": self.attributes,
+            "counters": self.counters,
+            "spans": [span.to_dict(self.start) for span in self.spans],
+        }
+
+
+def _observe(name, duration):
+    with _latencies_lock:
+        _latencies.setdefault(name, deque(maxlen=MAX_SAMPLES)).append(duration)
+
+
+def _export(trace):
+    if not _export_path:
+        return
+    with _export_lock:
+        with open(_export_path, "a") as f:
+            f.write(json.dumps(trace.to_dict(), default=str) + "\n")
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+def start_trace(name, **attributes):
+    """
+    Start a trace without making it current; use `resume_trace` to record into it and `finish_trace` to end it.
+    """
+    return Trace(name, attributes)
+
+
+@contextmanager
+def resume_trace(trace):
+    """
+    Make an existing trace current for the duration of the block, e.g. while a response is streamed.
+    """
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+
+
+def finish_trace(trace):
+    """
+    End a trace: record its total latency and export it.
+    """
+    trace.duration = time.perf_counter() - trace.start
+    _observe(trace.name, trace.duration)
+    _export(trace)
+
+
+@contextmanager
+def request_trace(name, **attributes):
+    """
+    Trace one request (e.g. one `process_query` call). Spans and counters recorded inside belong to it.
+    """
+    trace = start_trace(name, **attributes)
+    try:
+        with resume_trace(trace):
+            yield trace
+    finally:
+        finish_trace(trace)
+
+
+@contextmanager
+def span(name, **attributes):
+    """
+    Time a block inside the current trace. Without an active trace the block only feeds the histograms.
+    """
+    trace = _current_trace.get()
+    current = Span(name, _current_span.get(), attributes)
+    token = _current_span.set(current)
+    try:
+        yield current
+    finally:
+        current.duration = time.perf_counter() - current.start
+        _current_span.reset(token)
+        _observe(name, current.duration)
+        if trace is not None:
+            trace.add_span(current)
+
+
+def record(**counters):
+    """
+    Add counters (e.g. llm_calls=1, prompt_tokens=812, nodes_embedded=4, cache_hits=12) to the
+    innermost span and to the totals of the current trace.
+    """
+    current = _current_span.get()
+    if current is not None:
+        for key, value in counters.items():
+            current.counters[key] = current.counters.get(key, 0) + value
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add_counters(counters)
+
+
+def trace_node(step_name, node_fn):
+    """
+    Wrap a graph node (sync or async) in a span named after the step; usable as `wrap_node` of `build_workflow`.
+    """
+    if asyncio.iscoroutinefunction(node_fn):
+        async def async_wrapped(state):
+            with span(step_name):
+                return await node_fn(state)
+        return async_wrapped
+
+    def wrapped(state):
+        with span(step_name):
+            return node_fn(state)
+    return wrapped
+
+
+def latency_summary():
+    """
+    Aggregate the recorded latencies per span/trace name.
+
+    Returns:
+        Dict of name -> {"count", "mean", "p50", "p95", "p99", "max"} in seconds.
+    """
+    with _latencies_lock:
+        samples = {name: list(values) for name, values in _latencies.items()}
+    return {
+        name: {
+            "count": len(values),
+            "mean": sum(values) / len(values),
+            "p50": percentile(values, 50),
+            "p95": percentile(values, 95),
+            "p99": percentile(values, 99),
+            "max": max(values),
+        }
+        for name, values in samples.items()
+        if values
+    }
+
+
+def reset_latencies():
+    with _latencies_lock:
+        _latencies.clear()
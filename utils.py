@@ -1,40 +1,66 @@
-from llama_index.core.schema import Document
 from langchain.embeddings import HuggingFaceEmbeddings
-from config import embed_models
-from llama_index.llms.ollama import Ollama
+from config import embed_models, relevance_llm_model, llm_model, relevance_fallback_to_ollama, embed_backend, embed_quantize, embed_batch_size, embed_threads
+from llm_gateway import create_gateway
 from llama_index.core.node_parser import SentenceSplitter
 from llama_index.embeddings.langchain import LangchainEmbedding
+from embedding_cache import attach_embeddings
+from vector_db import note_excerpt_docs
 
-def load_embed_model(embed_model_name):
+def load_embed_model(embed_model_name, backend=embed_backend, quantize=embed_quantize, batch_size=embed_batch_size, threads=embed_threads):
     """
     Embedding model function to be used in the index.
+
+    Args:
+    embed_model_name (str): A key of `config.embed_models`.
+    backend (str): "torch" (HuggingFace/PyTorch) or "onnx" (ONNX Runtime through fastembed, CPU-optimized).
+    quantize (bool): With the "onnx" backend, use int8-quantized weights.
+    batch_size (int): Number of texts per forward pass.
+    threads (int, optional): With the "onnx" backend, number of ONNX Runtime threads.
     """
-    if embed_model_name in embed_models.keys():
+    if backend not in ("torch", "onnx"):
+        raise ValueError(f"Invalid embedding backend {backend}. Choose from: 'torch', 'onnx'.")
+    if embed_model_name in embed_models.keys() and backend == "onnx":
+        from onnx_embedding import OnnxEmbedding
+        return OnnxEmbedding(embed_models[embed_model_name], quantize=quantize, embed_batch_size=batch_size, threads=threads)
+    elif embed_model_name in embed_models.keys():
         lc_embed_model = HuggingFaceEmbeddings(
             model_name=embed_models[embed_model_name]
         )
-        return LangchainEmbedding(lc_embed_model)
+        return LangchainEmbedding(lc_embed_model, model_name=embed_models[embed_model_name], embed_batch_size=batch_size)
     else:
         raise ValueError(f"Embedding model {embed_model_name} not found in embed models list. Please check and retry again.")
     
-def create_docs_n_nodes(note_excerpts):
+def create_docs_n_nodes(note_excerpts, embed_model=None, embedding_cache=None):
     """
     Create a list of documents and nodes from a dictionary of notes.
     
     Args:
     note_excerpts (dict): A dictionary where keys are node names and values are text notes.
+    embed_model (optional): If given, the nodes are embedded up front, encoding only the sentences
+        missing from the embedding cache.
+    embedding_cache (EmbeddingCache, optional): The cache to use. Defaults to the process-wide cache.
 
     Returns:
     list: A list of documents and nodes.
     """
-    docs = [Document(text=sentence, metadata={"key": key}) for key, sentence in note_excerpts.items()]
+    docs = note_excerpt_docs(note_excerpts)
     node_parser = SentenceSplitter(chunk_size=2048, chunk_overlap=0)
     nodes = node_parser.get_nodes_from_documents(docs)
+    if embed_model is not None:
+        attach_embeddings(nodes, embed_model, embedding_cache)
     return docs, nodes
 
 def initialise_llm(llm_model):
     """"
-    Initialises the LLM to be used for response generation."
+    Initialises the LLM to be used for response generation (the local Ollama server, through the LLM gateway)."
     """
-    return Ollama(model=llm_model, request_timeout=120.0)
+    return create_gateway(["ollama"], [llm_model])
 
+def initialise_relevance_llm():
+    """
+    Initialises the OpenRouter LLM used for the question relevance check, falling back to the local
+    Ollama model when OpenRouter fails (through the LLM gateway).
+    """
+    if relevance_fallback_to_ollama:
+        return create_gateway(["openrouter", "ollama"], [relevance_llm_model, llm_model])
+    return create_gateway(["openrouter"], [relevance_llm_model])
@@ -1,6 +1,39 @@
+import os
+import json
+import time
+import atexit
+import asyncio
+import hashlib
+import contextlib
+import threading
 import chromadb
+from filelock import FileLock
 from llama_index.core import StorageContext, VectorStoreIndex
+from llama_index.core.schema import Document
+from llama_index.core.node_parser import SentenceSplitter
 from llama_index.vector_stores.chroma import ChromaVectorStore
+from embedding_cache import attach_embeddings, aattach_embeddings, text_hash
+from numpy_vector_store import NumpyVectorStore
+
+COLLECTION_PREFIX = "notes_"
+# Version of the text the sentences are embedded from, part of the fingerprint so that collections
+# embedded from another text (e.g. including the "key: N" metadata) are not reused
+EMBED_TEXT_VERSION = "sentence"
+COLLECTION_TTL_SECONDS = 24 * 60 * 60
+MAX_COLLECTIONS = 256
+REAP_INTERVAL_SECONDS = 5 * 60
+USAGE_FILE = "collection_usage.json"
+USAGE_FLUSH_SECONDS = 30
+LOCK_DIR = "locks"
+
+_collection_locks = {}
+_collection_locks_guard = threading.Lock()
+_usage_lock = threading.Lock()
+# Collection usage recorded since the last write of each usage file (usage path -> name -> timestamp)
+_pending_usage = {}
+_last_usage_flush = {}
+_reap_lock = threading.Lock()
+_last_reap = 0.0
 
 def initialize_chroma_client(chroma_db_path):
     """Initialize a Chroma client with the given database path.
@@ -14,35 +47,382 @@ def initialize_chroma_client(chroma_db_path):
     return chroma_client
 
 
-def create_index(chroma_client, docs, embed_model, collection_name="note_excerpts"):
+def note_set_fingerprint(docs, embed_model):
     """
-    Creates a new index with the given documents in ChromaDB. If the collection already exists, it deletes it first.
-    
+    Fingerprint a note set together with the embedding model used to index it.
+
+    Args:
+        docs: The documents of the note set (each with a "key" metadata entry).
+        embed_model: The embedding model used for the index.
+
+    Returns:
+        A Chroma-compatible collection name derived from the fingerprint.
+    """
+    digest = hashlib.sha256(getattr(embed_model, "model_name", "unknown").encode("utf-8"))
+    digest.update(b"\x02" + EMBED_TEXT_VERSION.encode("utf-8"))
+    for doc in sorted(docs, key=lambda d: str(d.metadata.get("key", ""))):
+        digest.update(b"\x00" + str(doc.metadata.get("key", "")).encode("utf-8"))
+        digest.update(b"\x01" + doc.text.encode("utf-8"))
+    return COLLECTION_PREFIX + digest.hexdigest()[:40]
+
+
+def _persist_dir(chroma_client):
+    settings = chroma_client.get_settings()
+    return settings.persist_directory if getattr(settings, "is_persistent", True) else None
+
+
+@contextlib.contextmanager
+def _collection_lock(chroma_client, collection_name):
+    # The thread lock serializes the threads of this process, the file lock the processes sharing the Chroma directory
+    with _collection_locks_guard:
+        lock = _collection_locks.setdefault(collection_name, threading.Lock())
+    persist_dir = _persist_dir(chroma_client)
+    with lock:
+        if not persist_dir:
+            yield
+            return
+        os.makedirs(os.path.join(persist_dir, LOCK_DIR), exist_ok=True)
+        with FileLock(os.path.join(persist_dir, LOCK_DIR, f"{collection_name}.lock")):
+            yield
+
+
+def _collection_names(chroma_client):
+    # Depending on the chromadb version, list_collections returns names or Collection objects
+    return [c if isinstance(c, str) else c.name for c in chroma_client.list_collections()]
+
+
+def _usage_path(chroma_client):
+    persist_dir = _persist_dir(chroma_client)
+    return os.path.join(persist_dir, USAGE_FILE) if persist_dir else None
+
+
+def _load_usage(path):
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_usage(path, usage):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "w") as f:
+            json.dump(usage, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Warning: Could not save collection usage: {e}")
+
+
+@contextlib.contextmanager
+def _locked_usage(path):
+    # The usage file is read-modify-written by every process sharing the Chroma directory
+    with _usage_lock, FileLock(f"{path}.lock"):
+        yield
+
+
+def _flush_usage(path):
+    # Merge the pending usage into the usage file; the caller holds `_locked_usage(path)`
+    usage = _load_usage(path)
+    for name, ts in _pending_usage.pop(path, {}).items():
+        usage[name] = max(ts, usage.get(name, 0.0))
+    _last_usage_flush[path] = time.time()
+    _save_usage(path, usage)
+    return usage
+
+
+def flush_collection_usage():
+    """Write the collection usage recorded since the last write to the usage files."""
+    for path in list(_pending_usage):
+        with _locked_usage(path):
+            _flush_usage(path)
+
+
+atexit.register(flush_collection_usage)
+
+
+def touch_collection(chroma_client, collection_name):
+    """
+    Record that a collection was just used, for the TTL/LRU reaper.
+
+    The usage is kept in memory and written to the usage file at most every `USAGE_FLUSH_SECONDS`,
+    so that the query path does not rewrite the file on every request.
+    """
+    path = _usage_path(chroma_client)
+    if not path:
+        return
+    with _usage_lock:
+        _pending_usage.setdefault(path, {})[collection_name] = time.time()
+        due = time.time() - _last_usage_flush.get(path, 0.0) >= USAGE_FLUSH_SECONDS
+    if due:
+        with _locked_usage(path):
+            _flush_usage(path)
+
+
+def reap_collections(chroma_client, ttl_seconds=COLLECTION_TTL_SECONDS, max_collections=MAX_COLLECTIONS, keep=()):
+    """
+    Delete per-note-set collections that have not been used within `ttl_seconds`, and the least
+    recently used ones beyond `max_collections`.
+
     Args:
         chroma_client: The ChromaDB client instance.
+        ttl_seconds: Maximum idle time of a collection.
+        max_collections: Maximum number of per-note-set collections to keep.
+        keep: Collection names that must not be deleted.
+
+    Returns:
+        The list of deleted collection names.
+    """
+    now = time.time()
+    path = _usage_path(chroma_client)
+    with _locked_usage(path) if path else _usage_lock:
+        usage = _flush_usage(path) if path else {}
+        names = [name for name in _collection_names(chroma_client) if name.startswith(COLLECTION_PREFIX)]
+        # Collections without a usage record are treated as just used, so that we never delete a build in progress
+        last_used = {name: usage.get(name, now) for name in names}
+        by_recency = sorted(names, key=lambda name: last_used[name], reverse=True)
+
+        stale = {name for name in names if now - last_used[name] > ttl_seconds}
+        stale.update(by_recency[max_collections:])
+        stale.difference_update(keep)
+
+        deleted = []
+        for name in stale:
+            with _collection_lock(chroma_client, name):
+                try:
+                    chroma_client.delete_collection(name)
+                    deleted.append(name)
+                except Exception as e:
+                    print(f"Warning: Could not delete collection {name}: {e}")
+            usage.pop(name, None)
+        # Drop usage records of collections that no longer exist
+        usage = {name: ts for name, ts in usage.items() if name in last_used and name not in stale}
+        if path:
+            _save_usage(path, usage)
+    return deleted
+
+
+def _maybe_reap(chroma_client, keep):
+    global _last_reap
+    with _reap_lock:
+        if time.time() - _last_reap < REAP_INTERVAL_SECONDS:
+            return
+        _last_reap = time.time()
+    try:
+        reap_collections(chroma_client, keep=keep)
+    except Exception as e:
+        print(f"Warning: Could not reap collections: {e}")
+
+
+def create_numpy_index(docs, embed_model, nodes=None, embedding_cache=None):
+    """
+    Create an in-memory index of the given documents backed by a NumpyVectorStore.
+
+    Args:
         docs: The documents to be indexed.
         embed_model: The embedding model to use.
-        collection_name: The name of the collection (default is "note_excerpts").
-    
+        nodes: The nodes parsed from `docs`. Parsed from `docs` if not given.
+        embedding_cache: The EmbeddingCache to use. Defaults to the process-wide cache.
+
     Returns:
-        The created VectorStoreIndex instance.
+        The VectorStoreIndex instance.
     """
-    # Delete existing collection if it exists
-    try:
-        existing_collections = chroma_client.list_collections()
+    if nodes is None:
+        nodes = SentenceSplitter(chunk_size=2048, chunk_overlap=0).get_nodes_from_documents(docs)
+    attach_embeddings(nodes, embed_model, embedding_cache)
+    storage_context = StorageContext.from_defaults(vector_store=NumpyVectorStore())
+    return VectorStoreIndex(nodes, storage_context=storage_context, embed_model=embed_model)
 
-        if "note_excerpts" in existing_collections:
-            chroma_client.delete_collection("note_excerpts")
-    
-    except Exception as e:
-        print(f"Warning: Could not delete collection {collection_name}: {e}")
-    
-    # Create a new collection
-    chroma_collection = chroma_client.get_or_create_collection(collection_name)
+
+def create_index(chroma_client, docs, embed_model, collection_name=None, nodes=None, embedding_cache=None, backend="chroma"):
+    """
+    Get or create the index of the given documents in ChromaDB, or in memory with the "numpy" backend.
+
+    By default the collection is named after a fingerprint of the note set and embedding model, so
+    repeated queries on the same notes reuse the existing collection and concurrent requests on
+    different notes never overwrite each other. If an explicit `collection_name` is given, that
+    collection is deleted and rebuilt instead.
+    Embeddings are looked up in the embedding cache first, so only unseen sentences are encoded.
     
-    # Setup vector store and storage context
-    vector_store = ChromaVectorStore(chroma_collection=chroma_collection)
-    storage_context = StorageContext.from_defaults(vector_store=vector_store)
+    Args:
+        chroma_client: The ChromaDB client instance.
+        docs: The documents to be indexed.
+        embed_model: The embedding model to use.
+        collection_name: The name of the collection to rebuild (default is the note set fingerprint).
+        nodes: The nodes parsed from `docs` (e.g. from `create_docs_n_nodes`). Parsed from `docs` if not given.
+        embedding_cache: The EmbeddingCache to use. Defaults to the process-wide cache.
+        backend: "chroma" (persistent) or "numpy" (in-memory exact search, no disk I/O; `chroma_client` is unused).
     
-    # Create and return the index
-    return VectorStoreIndex.from_documents(docs, storage_context=storage_context, embed_model=embed_model)
+    Returns:
+        The VectorStoreIndex instance.
+    """
+    if backend == "numpy":
+        return create_numpy_index(docs, embed_model, nodes, embedding_cache)
+    elif backend != "chroma":
+        raise ValueError("Invalid backend. Choose from: 'chroma', 'numpy'.")
+
+    rebuild = collection_name is not None
+    if collection_name is None:
+        collection_name = note_set_fingerprint(docs, embed_model)
+
+    if nodes is None:
+        nodes = SentenceSplitter(chunk_size=2048, chunk_overlap=0).get_nodes_from_documents(docs)
+
+    with _collection_lock(chroma_client, collection_name):
+        if rebuild:
+            # Delete existing collection if it exists
+            try:
+                if collection_name in _collection_names(chroma_client):
+                    chroma_client.delete_collection(collection_name)
+            except Exception as e:
+                print(f"Warning: Could not delete collection {collection_name}: {e}")
+
+        chroma_collection = chroma_client.get_or_create_collection(collection_name)
+        vector_store = ChromaVectorStore(chroma_collection=chroma_collection)
+
+        if not rebuild and chroma_collection.count() == len(nodes):
+            # The note set was indexed before, reuse it without embedding anything
+            index = VectorStoreIndex.from_vector_store(vector_store, embed_model=embed_model)
+        else:
+            if chroma_collection.count():
+                # Leftover of an interrupted build, start from an empty collection
+                chroma_client.delete_collection(collection_name)
+                chroma_collection = chroma_client.get_or_create_collection(collection_name)
+                vector_store = ChromaVectorStore(chroma_collection=chroma_collection)
+
+            # Setup storage context
+            storage_context = StorageContext.from_defaults(vector_store=vector_store)
+
+            # Only nodes without an embedding are sent to the encoder by the index
+            attach_embeddings(nodes, embed_model, embedding_cache)
+            index = VectorStoreIndex(nodes, storage_context=storage_context, embed_model=embed_model)
+
+    if not rebuild:
+        touch_collection(chroma_client, collection_name)
+        _maybe_reap(chroma_client, keep=(collection_name,))
+    return index
+
+
+def _is_indexed(chroma_client, collection_name, num_nodes):
+    if collection_name not in _collection_names(chroma_client):
+        return False
+    return chroma_client.get_collection(collection_name).count() == num_nodes
+
+
+async def acreate_index(chroma_client, docs, embed_model, collection_name=None, nodes=None, embedding_cache=None, backend="chroma"):
+    """
+    Async version of `create_index`.
+
+    Cache misses are embedded with the async embedding API; the ChromaDB calls are synchronous
+    and run in a worker thread so they do not block the event loop.
+    """
+    if nodes is None:
+        nodes = SentenceSplitter(chunk_size=2048, chunk_overlap=0).get_nodes_from_documents(docs)
+
+    reusable = backend == "chroma" and collection_name is None and await asyncio.to_thread(
+        _is_indexed, chroma_client, note_set_fingerprint(docs, embed_model), len(nodes)
+    )
+    if not reusable:
+        await aattach_embeddings(nodes, embed_model, embedding_cache)
+
+    if backend == "numpy":
+        # Embeddings are attached already, building the in-memory index is cheap
+        return create_numpy_index(docs, embed_model, nodes, embedding_cache)
+    return await asyncio.to_thread(
+        create_index, chroma_client, docs, embed_model, collection_name, nodes, embedding_cache, backend
+    )
+
+
+def diff_note_excerpts(old_excerpts, new_excerpts):
+    """
+    Compare two versions of a note set by sentence content rather than by key, so that a line
+    inserted mid-note does not count every later line as changed.
+
+    Returns:
+        Tuple of the keys of the added sentences (in `new_excerpts`) and of the removed sentences
+        (in `old_excerpts`); an edited sentence is both removed and added.
+    """
+    old_hashes = {text_hash(text) for text in old_excerpts.values()}
+    new_hashes = {text_hash(text) for text in new_excerpts.values()}
+    added = [key for key, text in new_excerpts.items() if text_hash(text) not in old_hashes]
+    removed = [key for key, text in old_excerpts.items() if text_hash(text) not in new_hashes]
+    return added, removed
+
+
+def note_excerpt_docs(note_excerpts):
+    """
+    Create one document per note sentence. The "key" metadata is not part of the embedded text, so
+    a sentence has the same embedding (and embedding cache entry) whatever its position.
+    """
+    return [Document(text=sentence, metadata={"key": key}, excluded_embed_metadata_keys=["key"]) for key, sentence in note_excerpts.items()]
+
+
+def note_excerpts_fingerprint(note_excerpts, embed_model):
+    """
+    Fingerprint of a note set given as a dict of key -> sentence (see `note_set_fingerprint`).
+    """
+    return note_set_fingerprint(note_excerpt_docs(note_excerpts), embed_model)
+
+
+def _previous_embeddings(chroma_client, index, nodes, old_excerpts, embed_model, backend):
+    # Vectors of the previous sentences by normalized-text hash, read without modifying the previous nodes or index
+    found = {text_hash(node.get_content()): node.embedding for node in nodes if node.embedding is not None}
+    if backend == "numpy":
+        found.update({text_hash(node.get_content()): node.embedding for node in index.vector_store.nodes if node.embedding is not None})
+    elif len(found) < len({text_hash(text) for text in old_excerpts.values()}):
+        try:
+            collection = chroma_client.get_collection(note_excerpts_fingerprint(old_excerpts, embed_model))
+            stored = collection.get(include=["embeddings", "documents"])
+            for document, embedding in zip(stored["documents"], stored["embeddings"]):
+                found.setdefault(text_hash(document), [float(value) for value in embedding])
+        except Exception as e:
+            # E.g. the old collection was reaped meanwhile: the embedding cache covers the rest
+            print(f"Warning: Could not read the previous embeddings: {e}")
+    return found
+
+
+def update_index(chroma_client, index, nodes, old_excerpts, new_excerpts, embed_model, embedding_cache=None, backend="chroma"):
+    """
+    Build the index of an edited note set from the index built by `create_index` for the previous version.
+
+    Sentences are matched by their normalized text, not by their key, so only added or edited
+    sentences are embedded, wherever they are inserted; the vectors of the other sentences are copied
+    from the previous nodes or index. Indexing itself is not incremental: the previous index, its
+    nodes and its Chroma collection are left untouched, since other sessions and cached retrievers
+    may still serve the previous note set, so every vector is written to the collection of the new
+    note set's fingerprint (as `create_index` would), and BM25 retrievers are rebuilt for the new
+    note set when first used.
+
+    Args:
+        chroma_client: The ChromaDB client instance (unused with the "numpy" backend).
+        index: The index of `old_excerpts`.
+        nodes: The nodes of `old_excerpts`.
+        old_excerpts: The note set the index was built from (dict of key -> sentence).
+        new_excerpts: The edited note set.
+        embed_model: The embedding model of the index.
+        embedding_cache: The EmbeddingCache to use. Defaults to the process-wide cache.
+        backend: "chroma" or "numpy", as given to `create_index`.
+
+    Returns:
+        Tuple of the new index, its nodes and a dict with the number of added, removed and unchanged sentences.
+    """
+    if backend not in ("chroma", "numpy"):
+        raise ValueError("Invalid backend. Choose from: 'chroma', 'numpy'.")
+    added, removed = diff_note_excerpts(old_excerpts, new_excerpts)
+    changes = {"added": len(added), "removed": len(removed), "unchanged": len(new_excerpts) - len(added)}
+    if new_excerpts == old_excerpts:
+        return index, nodes, changes
+
+    docs = note_excerpt_docs(new_excerpts)
+    new_nodes = SentenceSplitter(chunk_size=2048, chunk_overlap=0).get_nodes_from_documents(docs)
+    previous = _previous_embeddings(chroma_client, index, nodes, old_excerpts, embed_model, backend) if len(added) < len(new_excerpts) else {}
+    for node in new_nodes:
+        node.embedding = previous.get(text_hash(node.get_content()))
+    # Only the added and edited sentences (and any vector that could not be read back) reach the encoder
+    attach_embeddings(new_nodes, embed_model, embedding_cache)
+
+    if backend == "numpy":
+        return create_numpy_index(docs, embed_model, new_nodes, embedding_cache), new_nodes, changes
+    return create_index(chroma_client, docs, embed_model, nodes=new_nodes, embedding_cache=embedding_cache), new_nodes, changes